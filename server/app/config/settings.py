@@ -1,5 +1,5 @@
 from functools import lru_cache
-from typing import Literal
+from typing import Any, Literal
 
 from llama_index.vector_stores.milvus import DEFAULT_DOC_ID_KEY, DEFAULT_EMBEDDING_KEY
 from pydantic import AnyHttpUrl, Field, MongoDsn, RedisDsn
@@ -38,6 +38,79 @@ class AppSettings(BaseSettings):
     embedding_hf_model_name: str = "BAAI/bge-small-en-v1.5"
 
 
+class LLMSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="llm_")
+
+    generation_workers: int = Field(
+        4,
+        ge=1,
+        description=(
+            "The number of threads generating the tokens of the async chat. The "
+            "streams waiting for a thread hold no thread of the server."
+        ),
+    )
+    concurrent_generations: int = Field(
+        1,
+        ge=1,
+        description=(
+            "The number of generations running at once on the LLM. The others "
+            "wait in its queue."
+        ),
+    )
+    max_queue: int = Field(
+        16,
+        ge=0,
+        description="The number of requests waiting for the LLM, before a 429.",
+    )
+    max_queue_wait: float = Field(
+        60,
+        gt=0,
+        description=(
+            "The longest estimated wait, in seconds, accepted for a new request "
+            "before a 429."
+        ),
+    )
+    prompt_cache_bytes: int = Field(
+        512 * 2**20,
+        ge=0,
+        description=(
+            "The memory, in bytes, of the llama.cpp evaluation states cached by "
+            "prompt. A prompt sharing a prefix with a cached one, as the system "
+            "prompt or the history of a chat, only evaluates the tokens after it. "
+            "A state holds the KV cache of its prompt, about 128 KiB per token with "
+            "the default Mistral 7B, so up to about 500 MB for a prompt filling the "
+            "3900 tokens context. The copy of the prompt logits kept with each "
+            "state, about as large, is not counted. The least recently used states "
+            "are evicted first. 0 disables the cache."
+        ),
+    )
+
+
+class ModelServerSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="model_server_")
+
+    enabled: bool = Field(
+        False,
+        description=(
+            "Load the LLM and the embedding model once, in the model server process, "
+            "instead of in every worker. The workers then call it through the Unix "
+            "socket `local_data/model_server.sock`."
+        ),
+    )
+    timeout: float = Field(
+        600,
+        gt=0,
+        description="The seconds to wait for a response, or a token, of the server.",
+    )
+    startup_timeout: float = Field(
+        300,
+        gt=0,
+        description=(
+            "The seconds to wait for the server to listen, while it loads the models."
+        ),
+    )
+
+
 class RedisSettings(BaseSettings):
     model_config = SettingsConfigDict(env_prefix="redis_")
 
@@ -57,9 +130,88 @@ class MilvusSettings(BaseSettings):
     embedding_field: str = DEFAULT_EMBEDDING_KEY
     doc_id_field: str = DEFAULT_DOC_ID_KEY
     similarity_metric: str = "IP"
-    consistency_level: str = "Strong"
+    consistency_level: str = Field(
+        "Strong",
+        description=(
+            "The default consistency level of the searches, set on the collection "
+            "when it is created. A request can use another one."
+        ),
+    )
     overwrite: bool = False
     text_key: str | None = None
+    index_type: Literal[
+        "AUTOINDEX", "FLAT", "IVF_FLAT", "IVF_SQ8", "IVF_PQ", "HNSW"
+    ] = Field(
+        "AUTOINDEX",
+        description=(
+            "The type of the vector index, built when the collection is created. "
+            "Run `python -m benchmarks.milvus_index` to compare their recall and "
+            "latency on your data."
+        ),
+    )
+    index_params: dict[str, Any] = Field(
+        default_factory=dict,
+        description=(
+            "The build parameters of the vector index, as JSON, such as "
+            '`{"M": 16, "efConstruction": 200}` for HNSW or `{"nlist": 1024}` '
+            "for IVF_FLAT."
+        ),
+    )
+    search_params: dict[str, Any] = Field(
+        default_factory=dict,
+        description=(
+            "The search parameters of the vector index, as JSON, such as "
+            '`{"ef": 64}` for HNSW or `{"nprobe": 16}` for the IVF indexes.'
+        ),
+    )
+
+
+class VectorStoreSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="vector_store_")
+
+    mode: Literal["milvus", "mmap"] = Field(
+        "milvus",
+        description=(
+            "The vector store to use:\n"
+            "If `milvus` - search in the Milvus collection configured in `MILVUS_*`.\n"
+            "If `mmap` - keep the embeddings in a memory-mapped matrix under "
+            "`local_data/vectors`, searched in process. It needs no other service, "
+            "for single-node and test deployments."
+        ),
+    )
+    dtype: Literal["float32", "float16"] = Field(
+        "float32",
+        description=(
+            "The type of the embeddings stored by the `mmap` store. float16 halves "
+            "the size of the matrix, for a small loss of precision. Only used when "
+            "the store is created."
+        ),
+    )
+    ivf_lists: int = Field(
+        0,
+        ge=0,
+        description=(
+            "The number of lists the `mmap` store partitions the embeddings into, "
+            "to only score a part of them. 0 searches all the embeddings, exactly."
+        ),
+    )
+    ivf_probes: int = Field(
+        8,
+        ge=1,
+        description=(
+            "The number of lists scored by the `mmap` store, when partitioned. "
+            "The more lists, the better the recall and the slower the search."
+        ),
+    )
+    compact_dead_fraction: float = Field(
+        0.3,
+        ge=0,
+        le=1,
+        description=(
+            "The fraction of deleted embeddings above which the `mmap` store "
+            "rewrites its files without them, when persisted. 1 never compacts."
+        ),
+    )
 
 
 class S3Settings(BaseSettings):
@@ -97,14 +249,268 @@ class EmbeddingSettings(BaseSettings):
             "Do not set it higher than your number of threads of your CPU."
         ),
     )
+    ingest_upsert: bool = Field(
+        True,
+        description=(
+            "If enabled, re-ingesting a changed document only embeds and inserts "
+            "its new or changed chunks, and deletes the chunks it no longer has.\n"
+            "If disabled, all the chunks of a changed document are replaced."
+        ),
+    )
+    ingest_queue_size: int = Field(
+        4,
+        description=(
+            "In `parallel` mode, the number of files buffered between two stages "
+            "of the ingestion pipeline (parsing, embedding and insertion).\n"
+            "A stage waits when the next one is that many files behind, which "
+            "bounds the memory used by a bulk ingestion."
+        ),
+    )
+    ingest_embed_batch_size: int = Field(
+        256,
+        description=(
+            "In `parallel` mode, the number of nodes, possibly from several files, "
+            "sent together to the embedding model.\n"
+            "A smaller batch is sent when no other file is ready to be embedded."
+        ),
+    )
+
+
+class IngestSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="ingest_")
+
+    max_upload_size: int = Field(
+        256 * 1024 * 1024,
+        description=(
+            "The maximum size, in bytes, of a single uploaded file.\n"
+            "It is enforced while the request body is received and written to "
+            "disk, so an upload is rejected as soon as it goes over the limit, "
+            "before the rest of the body is read.\n"
+            "Set it to 0 to disable the limit."
+        ),
+    )
+    upload_chunk_size: int = Field(
+        1024 * 1024,
+        description=(
+            "The size, in bytes, of the chunks used to copy the files extracted "
+            "from an uploaded archive to disk.\n"
+            "Only one chunk per file is held in memory at a time."
+        ),
+    )
+    max_archive_files: int = Field(
+        1000,
+        description="The maximum number of files extracted from an uploaded archive.",
+    )
+    max_archive_size: int = Field(
+        1024 * 1024 * 1024,
+        description=(
+            "The maximum total size, in bytes, of the files extracted from an "
+            "uploaded archive. Set it to 0 to disable the limit."
+        ),
+    )
+    job_workers: int = Field(
+        2,
+        description=(
+            "The number of ingestion jobs run concurrently by each process.\n"
+            "Each job goes through the configured ingest component, so use the "
+            "`parallel` ingest mode to parse and embed on several cores."
+        ),
+    )
+    job_max_pending: int = Field(
+        16,
+        description=(
+            "The maximum number of queued and running ingestion jobs per process.\n"
+            "New jobs are rejected with a 429 once it is reached."
+        ),
+    )
+    job_ttl: int = Field(
+        24 * 60 * 60,
+        description="How long, in seconds, the state of a job is kept in Redis.",
+    )
+    bulk_concurrency: int = Field(
+        1,
+        description=(
+            "The number of bulk ingestions (several files, archives or bucket "
+            "objects) run at the same time by each process. The others wait "
+            "for their turn, while single file ingestions always run right away."
+        ),
+    )
+    bulk_workers: int = Field(
+        1,
+        description=(
+            "The number of parsing processes a bulk ingestion keeps busy, at most "
+            "`count_workers`. The remaining ones are left for single file "
+            "ingestions and the chat."
+        ),
+    )
+    bulk_max_pause: float = Field(
+        30.0,
+        description=(
+            "Between two batches, a bulk ingestion waits for the running single "
+            "file ingestions to be done, for at most this many seconds."
+        ),
+    )
+    bucket_max_objects: int = Field(
+        1000,
+        description="The maximum number of bucket objects ingested by a request.",
+    )
+    bucket_prefetch: int = Field(
+        4,
+        description=(
+            "The number of bucket objects downloaded concurrently when ingesting "
+            "from the bucket."
+        ),
+    )
+    bucket_batch_size: int = Field(
+        16,
+        description=(
+            "The number of bucket objects handed over together to the ingest "
+            "component. The next batch is downloaded while a batch is ingested."
+        ),
+    )
+    persist_every: int = Field(
+        20,
+        description=(
+            "The number of changes to the index after which it is persisted.\n"
+            "Set it to 1 to persist after every ingested file."
+        ),
+    )
+    persist_interval: float = Field(
+        30.0,
+        description=(
+            "The maximum time, in seconds, a change to the index waits to be "
+            "persisted. Set it to 0 to only persist on `persist_every` and on "
+            "shutdown."
+        ),
+    )
+    persist_log: bool = Field(
+        True,
+        description=(
+            "Append every change to the index to a log synced to disk, so the "
+            "changes not yet persisted are replayed after a crash."
+        ),
+    )
+
+
+class CacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="cache_")
+
+    embedding_max_entries: int = Field(
+        10_000,
+        description="The maximum number of query embeddings cached by each process.",
+    )
+    embedding_max_bytes: int = Field(
+        64 * 1024 * 1024,
+        description=(
+            "The maximum size, in bytes, of the query embeddings cached by each "
+            "process. Set it to 0 to only bound the number of entries."
+        ),
+    )
+    embedding_ttl: int = Field(
+        24 * 60 * 60,
+        description="How long, in seconds, a query embedding stays cached.",
+    )
+    embedding_redis: bool = Field(
+        False,
+        description=(
+            "Also cache the query embeddings in Redis, to share them between the "
+            "processes and keep them across restarts."
+        ),
+    )
+    retrieval_enabled: bool = Field(
+        True,
+        description=(
+            "Cache the results of the vector searches in Redis. The cache is "
+            "invalidated whenever a document is ingested or deleted."
+        ),
+    )
+    retrieval_ttl: int = Field(
+        60 * 60,
+        description="How long, in seconds, the result of a vector search stays cached.",
+    )
+
+
+class RetrievalSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="retrieval_")
+
+    hybrid: bool = Field(
+        True,
+        description=(
+            "Index the text of the nodes in a BM25 index at ingest time, and fuse "
+            "its results with the ones of the vector search, so exact terms such "
+            "as identifiers and error codes are found even with a small top k."
+        ),
+    )
+    hybrid_candidates: int = Field(
+        20,
+        description=(
+            "The number of results taken from each of the vector search and the "
+            "BM25 index before fusing them into the top k."
+        ),
+    )
+    hybrid_postings_per_term: int = Field(
+        1000,
+        ge=1,
+        description=(
+            "The number of best postings read for each term of a query from the "
+            "BM25 index. The other nodes containing a frequent term are ignored, "
+            "which bounds the cost of a query on a large corpus."
+        ),
+    )
+    rrf_k: int = Field(
+        60,
+        description=(
+            "The constant of the reciprocal rank fusion. The higher it is, the "
+            "less the first results of each search weigh."
+        ),
+    )
+    chat_consistency_level: str = Field(
+        "Bounded",
+        description=(
+            "The consistency level of the vector searches of the chat. Bounded "
+            "staleness does not wait for the latest writes, which a chat can miss "
+            "for a few seconds. Its results are not cached, but it is answered by "
+            "the cached results of the Strong searches."
+        ),
+    )
+    diversity: bool = Field(
+        True,
+        description=(
+            "Reorder the retrieved nodes with maximal marginal relevance and drop "
+            "the near duplicates before they are sent to the LLM, so overlapping "
+            "sentence windows do not fill the prompt with the same context."
+        ),
+    )
+    mmr_lambda: float = Field(
+        0.7,
+        ge=0,
+        le=1,
+        description=(
+            "The weight of the relevance to the query against the novelty in the "
+            "maximal marginal relevance. 1 keeps the order of the retrieval."
+        ),
+    )
+    duplicate_threshold: float = Field(
+        0.95,
+        description=(
+            "The cosine similarity above which a node is a near duplicate of a node "
+            "already selected, and is dropped."
+        ),
+    )
 
 
 mongo_settings = MongoSettings()
 jwt_settings = JwtSettings()
 app_settings = AppSettings()
 redis_settings = RedisSettings()
+llm_settings = LLMSettings()
+model_server_settings = ModelServerSettings()
 milvus_settings = MilvusSettings()
+vector_store_settings = VectorStoreSettings()
 s3_settings = S3Settings()
+ingest_settings = IngestSettings()
+cache_settings = CacheSettings()
+retrieval_settings = RetrievalSettings()
 
 
 @lru_cache
@@ -112,11 +518,26 @@ def get_app_settings() -> AppSettings:
     return AppSettings()
 
 
+@lru_cache
+def get_llm_settings() -> LLMSettings:
+    return LLMSettings()
+
+
+@lru_cache
+def get_model_server_settings() -> ModelServerSettings:
+    return ModelServerSettings()
+
+
 @lru_cache
 def get_milvus_settings() -> MilvusSettings:
     return MilvusSettings()
 
 
+@lru_cache
+def get_vector_store_settings() -> VectorStoreSettings:
+    return VectorStoreSettings()
+
+
 @lru_cache
 def get_s3_settings() -> S3Settings:
     return S3Settings()
@@ -132,6 +553,21 @@ def get_jwt_settings() -> JwtSettings:
     return JwtSettings()
 
 
+@lru_cache
+def get_ingest_settings() -> IngestSettings:
+    return IngestSettings()
+
+
+@lru_cache
+def get_cache_settings() -> CacheSettings:
+    return CacheSettings()
+
+
+@lru_cache
+def get_retrieval_settings() -> RetrievalSettings:
+    return RetrievalSettings()
+
+
 @lru_cache
 def get_embeddings_settings() -> EmbeddingSettings:
     return EmbeddingSettings(mode="local")
@@ -6,8 +6,9 @@ from pymilvus.orm.connections import synchronized
 
 class ContextFilter(BaseModel):
     docs_ids: list[str] | None = Field(
-        examples=[["c202d5e6-7b69-4869-81cc-dd574ee8ee11"]]
+        None, examples=[["c202d5e6-7b69-4869-81cc-dd574ee8ee11"]]
     )
+    file_names: list[str] | None = Field(None, examples=[["Sales Report Q3 2023.pdf"]])
 
 
 # TODO: This is untested
@@ -0,0 +1,112 @@
+import numpy as np
+import numpy.typing as npt
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from app.config.settings import RetrievalSettings, get_retrieval_settings
+
+
+def _normalize(vectors: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def mmr_select(
+    query_embedding: npt.ArrayLike,
+    embeddings: npt.ArrayLike,
+    mmr_lambda: float = 0.7,
+    duplicate_threshold: float = 0.95,
+    top_n: int | None = None,
+) -> list[int]:
+    """Select the rows of `embeddings` by maximal marginal relevance.
+
+    Each step selects the row maximizing `mmr_lambda * relevance - (1 -
+    mmr_lambda) * redundancy`, the redundancy being its highest cosine
+    similarity to the rows already selected. The rows more similar than
+    `duplicate_threshold` to a selected row are dropped.
+
+    All the similarities are computed at once, as two matrix products.
+    """
+    matrix = _normalize(np.asarray(embeddings, dtype=np.float32))
+    if matrix.ndim != 2 or len(matrix) == 0:
+        return []
+    query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+    relevance = matrix @ query
+    similarities = matrix @ matrix.T
+
+    count_rows = len(matrix)
+    top_n = count_rows if top_n is None else min(top_n, count_rows)
+    redundancy = np.zeros(count_rows, dtype=np.float32)
+    remaining = np.ones(count_rows, dtype=bool)
+    selected: list[int] = []
+    while len(selected) < top_n and remaining.any():
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        best = int(np.argmax(np.where(remaining, scores, -np.inf)))
+        selected.append(best)
+        remaining[best] = False
+        redundancy = np.maximum(redundancy, similarities[best])
+        remaining &= redundancy < duplicate_threshold
+    return selected
+
+
+class DiversityPostProcessor(BaseNodePostprocessor):
+    """Reorder the nodes by maximal marginal relevance, without near duplicates.
+
+    The nodes keep the embedding returned by the vector search; the others,
+    such as the ones only found by the BM25 index, are embedded in one batch.
+    """
+
+    mmr_lambda: float = Field(0.7)
+    duplicate_threshold: float = Field(0.95)
+    top_n: int | None = Field(None)
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        settings: RetrievalSettings = get_retrieval_settings(),
+        top_n: int | None = None,
+    ) -> None:
+        super().__init__(
+            mmr_lambda=settings.mmr_lambda,
+            duplicate_threshold=settings.duplicate_threshold,
+            top_n=top_n,
+        )
+        self._embed_model = embed_model
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "DiversityPostProcessor"
+
+    def _postprocess_nodes(
+        self,
+        nodes: list[NodeWithScore],
+        query_bundle: QueryBundle | None = None,
+    ) -> list[NodeWithScore]:
+        if query_bundle is None or len(nodes) < 2:
+            return nodes[: self.top_n]
+
+        query_embedding = query_bundle.embedding
+        if query_embedding is None:
+            query_embedding = self._embed_model.get_query_embedding(
+                query_bundle.query_str
+            )
+        missing = [n.node for n in nodes if n.node.embedding is None]
+        if missing:
+            embeddings = self._embed_model.get_text_embedding_batch(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in missing]
+            )
+            for node, embedding in zip(missing, embeddings):
+                node.embedding = embedding
+
+        selected = mmr_select(
+            query_embedding,
+            [n.node.embedding for n in nodes],
+            self.mmr_lambda,
+            self.duplicate_threshold,
+            self.top_n,
+        )
+        return [nodes[i] for i in selected]
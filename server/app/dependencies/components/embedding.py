@@ -2,16 +2,47 @@ from functools import lru_cache
 
 from llama_index import MockEmbedding
 from llama_index.embeddings.base import BaseEmbedding
+from redis import Redis
 
-from app.config.settings import AppSettings, get_app_settings
+from app.config.settings import (
+    AppSettings,
+    CacheSettings,
+    ModelServerSettings,
+    RedisSettings,
+    get_app_settings,
+    get_cache_settings,
+    get_model_server_settings,
+    get_redis_settings,
+)
+from app.dependencies.components.embedding_cache import (
+    CachedQueryEmbedding,
+    EmbeddingCache,
+)
+from app.dependencies.components.model_server import (
+    ModelServerClient,
+    RemoteEmbedding,
+)
 from app.paths import models_cache_path
 
 
 class EmbeddingComponent:
     embedding_model: BaseEmbedding
+    # The same model, caching the embeddings of the queries
+    query_embedding_model: BaseEmbedding
 
-    def __init__(self, app_settings: AppSettings = get_app_settings()) -> None:
-        if app_settings.fastapi_env != "testing":
+    def __init__(
+        self,
+        app_settings: AppSettings = get_app_settings(),
+        cache_settings: CacheSettings = get_cache_settings(),
+        redis_settings: RedisSettings = get_redis_settings(),
+        model_server_settings: ModelServerSettings = get_model_server_settings(),
+    ) -> None:
+        if model_server_settings.enabled:
+            self.embedding_model = RemoteEmbedding(
+                ModelServerClient(settings=model_server_settings),
+                model_name=app_settings.embedding_hf_model_name,
+            )
+        elif app_settings.fastapi_env != "testing":
             from llama_index.embeddings import HuggingFaceEmbedding
 
             self.embedding_model = HuggingFaceEmbedding(
@@ -21,6 +52,14 @@ class EmbeddingComponent:
         else:
             self.embedding_model = MockEmbedding(384)
 
+        redis = None
+        if cache_settings.embedding_redis:
+            redis = Redis.from_url(str(redis_settings.dsn))
+        self.query_embedding_model = CachedQueryEmbedding(
+            self.embedding_model,
+            EmbeddingCache(self.embedding_model.model_name, cache_settings, redis),
+        )
+
 
 @lru_cache
 def get_embeddings_component() -> EmbeddingComponent:
@@ -0,0 +1,211 @@
+import hashlib
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Any, cast
+
+import structlog.stdlib
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+from llama_index.embeddings.huggingface_utils import format_query
+from redis import Redis, RedisError
+
+from app.config.settings import CacheSettings, get_cache_settings
+
+logger = structlog.stdlib.get_logger(__name__)
+
+
+def normalize_query(text: str) -> str:
+    """Normalize the unicode and the whitespaces of a query.
+
+    The case is kept, as it matters to cased embedding models.
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def embed_queries(
+    embedding_model: BaseEmbedding, queries: list[str]
+) -> list[Embedding]:
+    """Embed several queries, in a single batch when the model allows it."""
+    if hasattr(embedding_model, "get_query_embedding_batch"):
+        return embedding_model.get_query_embedding_batch(queries)
+    if hasattr(embedding_model, "_embed") and hasattr(
+        embedding_model, "query_instruction"
+    ):
+        # HuggingFace models embed a batch of sentences in one forward pass
+        return embedding_model._embed(
+            [
+                format_query(
+                    query,
+                    embedding_model.model_name,
+                    embedding_model.query_instruction,
+                )
+                for query in queries
+            ]
+        )
+    return [embedding_model._get_query_embedding(query) for query in queries]
+
+
+class EmbeddingCache:
+    """Cache of embeddings, keyed by model name and normalized text.
+
+    Embeddings are kept in an in-process LRU, bounded by `embedding_max_entries`
+    and `embedding_max_bytes`, and, if enabled, in Redis where they are shared
+    by all the processes. Both tiers expire entries after `embedding_ttl`.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        settings: CacheSettings = get_cache_settings(),
+        redis: Redis | None = None,
+    ) -> None:
+        self.model_name = model_name
+        self.settings = settings
+        self._redis = redis
+        self._lock = threading.Lock()
+        # key -> (expires at, packed embedding), least recently used first
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha256(normalize_query(text).encode()).hexdigest()
+        return f"embedding-cache:{self.model_name}:{digest}"
+
+    def get(self, text: str) -> Embedding | None:
+        key = self._key(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return array("d", entry[1]).tolist()
+
+        data = None
+        if self._redis is not None:
+            try:
+                data = self._redis.get(key)
+            except RedisError:
+                logger.warning("Could not read the embedding cache from Redis")
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.redis_hits += 1
+            self._store(key, data)
+        return array("d", data).tolist()
+
+    def put(self, text: str, embedding: Embedding) -> None:
+        key = self._key(text)
+        data = array("d", embedding).tobytes()
+        with self._lock:
+            self._store(key, data)
+        if self._redis is not None:
+            try:
+                self._redis.set(key, data, ex=self.settings.embedding_ttl)
+            except RedisError:
+                logger.warning("Could not write the embedding cache to Redis")
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+    def _store(self, key: str, data: bytes) -> None:
+        """Store an entry, evicting the least recently used ones if needed.
+
+        Must be called with the lock held.
+        """
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous[1])
+        self._entries[key] = (time.monotonic() + self.settings.embedding_ttl, data)
+        self._size += len(data)
+        max_bytes = self.settings.embedding_max_bytes
+        while self._entries and (
+            len(self._entries) > self.settings.embedding_max_entries
+            or (max_bytes and self._size > max_bytes)
+        ):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+
+class CachedQueryEmbedding(BaseEmbedding):
+    """Embedding model caching the query embeddings of another one.
+
+    Only the queries go through the cache, the texts are embedded directly.
+    """
+
+    _embedding_model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(
+        self, embedding_model: BaseEmbedding, cache: EmbeddingCache, **kwargs: Any
+    ) -> None:
+        super().__init__(
+            model_name=embedding_model.model_name,
+            embed_batch_size=embedding_model.embed_batch_size,
+            callback_manager=embedding_model.callback_manager,
+            **kwargs,
+        )
+        self._embedding_model = embedding_model
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedQueryEmbedding"
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        embedding = self._cache.get(query)
+        if embedding is None:
+            embedding = self._embedding_model._get_query_embedding(query)
+            self._cache.put(query, embedding)
+        logger.debug("Query embedding cache", **self._cache.stats())
+        return embedding
+
+    def get_query_embedding_batch(self, queries: list[str]) -> list[Embedding]:
+        """Embed several queries, the ones not cached in a single batch."""
+        embeddings = [self._cache.get(query) for query in queries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = embed_queries(
+                self._embedding_model, [queries[i] for i in missing]
+            )
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+                self._cache.put(queries[i], embedding)
+        logger.debug("Query embedding cache", **self._cache.stats())
+        return cast(list[Embedding], embeddings)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        embedding = self._cache.get(query)
+        if embedding is None:
+            embedding = await self._embedding_model._aget_query_embedding(query)
+            self._cache.put(query, embedding)
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embedding_model._get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return await self._embedding_model._aget_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: list[str]) -> list[Embedding]:
+        return self._embedding_model._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts: list[str]) -> list[Embedding]:
+        return await self._embedding_model._aget_text_embeddings(texts)
@@ -1,12 +1,18 @@
 import abc
+import contextvars
+import hashlib
 import itertools
 import logging
 import multiprocessing
 import multiprocessing.pool
 import os
+import queue
 import threading
+import uuid
+from collections import Counter, deque
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Iterator
 
 import structlog.stdlib
 from llama_index import (
@@ -17,16 +23,45 @@ from llama_index import (
     load_index_from_storage,
 )
 from llama_index.data_structs import IndexDict
+from llama_index.embeddings.base import BaseEmbedding
 from llama_index.indices.base import BaseIndex
 from llama_index.ingestion import run_transformations
 from llama_index.readers import JSONReader, StringIterableReader
 from llama_index.readers.file.base import DEFAULT_FILE_READER_CLS
+from llama_index.schema import BaseNode, NodeRelationship, TextNode
+from llama_index.storage.docstore import KVDocumentStore
+from llama_index.storage.docstore.types import RefDocInfo
+from llama_index.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.storage.kvstore import RedisKVStore, SimpleKVStore
+from llama_index.storage.kvstore.types import BaseKVStore
+from llama_index.vector_stores import MilvusVectorStore, SimpleVectorStore
+from llama_index.vector_stores.types import VectorStore
 
-from app.config.settings import EmbeddingSettings, get_embeddings_settings
-from app.paths import local_data_path
+from app.config.settings import (
+    EmbeddingSettings,
+    get_embeddings_settings,
+    get_ingest_settings,
+)
+from app.dependencies.components.ingest_persist import IndexPersister
+from app.dependencies.components.ingest_scheduler import (
+    parse_workers,
+    preemption_point,
+)
+from app.dependencies.components.ingest_tracking import ingest_stage
+from app.dependencies.components.mmap_vector_store import MmapVectorStore
+from app.dependencies.components.node_store import get_nodes
+from app.dependencies.components.retrieval_cache import RetrievalCache
+from app.dependencies.components.sparse_index import SparseIndex
+from app.paths import ingest_log_path, local_data_path
 
 logger = structlog.stdlib.get_logger(__name__)
 
+# Collection of the KV store keeping track of the ingested files, by file name
+INGESTED_FILES_COLLECTION = "ingest/files"
+DOCUMENT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "ssr-ai-chat/documents")
+# Number of nodes deleted per request when upserting a document
+DELETE_BATCH_SIZE = 1000
+
 # Patching the default file reader to support other file types
 FILE_READER_CLS = DEFAULT_FILE_READER_CLS.copy()
 FILE_READER_CLS.update(
@@ -48,11 +83,61 @@ class IngestionHelper:
         file_name: str, file_data: Path
     ) -> list[Document]:
         documents = IngestionHelper._load_file_to_documents(file_name, file_data)
-        for document in documents:
+        for position, document in enumerate(documents):
             document.metadata["file_name"] = file_name
+            # A stable id lets a re-ingested file be matched with what is stored
+            document.id_ = IngestionHelper.document_id(file_name, position)
         IngestionHelper._exclude_metadata(documents)
+        for document in documents:
+            # The hash is computed when the document is created,
+            # refresh it now that the metadata is final
+            document.hash = IngestionHelper.content_hash(document)
         return documents
 
+    @staticmethod
+    def document_id(file_name: str, position: int) -> str:
+        return str(uuid.uuid5(DOCUMENT_ID_NAMESPACE, f"{file_name}:{position}"))
+
+    @staticmethod
+    def content_hash(node: TextNode) -> str:
+        # Same identity as llama-index uses for its own hashes
+        doc_identity = str(node.text) + str(node.metadata)
+        return hashlib.sha256(doc_identity.encode("utf-8", "surrogatepass")).hexdigest()
+
+    @staticmethod
+    def assign_node_ids(nodes: list[BaseNode]) -> None:
+        """Derive the id of the nodes from their document and content.
+
+        The nodes of a re-ingested document keep their id as long as their
+        content does not change, so they can be matched with the stored ones.
+        The previous/next relationships are updated with the new ids.
+        """
+        node_ids: dict[str, str] = {}
+        occurrences: Counter[tuple[str | None, str]] = Counter()
+        for node in nodes:
+            assert isinstance(node, TextNode), "Only text nodes can be upserted"
+            key = (node.ref_doc_id, IngestionHelper.content_hash(node))
+            node_ids[node.node_id] = str(
+                uuid.uuid5(
+                    DOCUMENT_ID_NAMESPACE, f"{key[0]}:{key[1]}:{occurrences[key]}"
+                )
+            )
+            occurrences[key] += 1
+        for node in nodes:
+            node.id_ = node_ids[node.node_id]
+            for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+                related_node = node.relationships.get(relationship)
+                if related_node is not None and related_node.node_id in node_ids:
+                    related_node.node_id = node_ids[related_node.node_id]
+
+    @staticmethod
+    def file_hash(file_data: Path) -> str:
+        file_hash = hashlib.sha256()
+        with file_data.open("rb") as file:
+            while chunk := file.read(1024 * 1024):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
     @staticmethod
     def _load_file_to_documents(file_name: str, file_data: Path) -> list[Document]:
         logger.debug("Transforming file_name=%s into documents", file_name)
@@ -105,6 +190,9 @@ class BaseIngestComponent(abc.ABC):
     def delete(self, doc_id: str) -> None:
         pass
 
+    def close(self) -> None:
+        """Release the resources of the component, on shutdown."""
+
 
 class BaseIngestComponentWithIndex(BaseIngestComponent, abc.ABC):
     def __init__(
@@ -117,10 +205,26 @@ class BaseIngestComponentWithIndex(BaseIngestComponent, abc.ABC):
         super().__init__(storage_context, service_context, *args, **kwargs)
 
         self.show_progress = True
+        # Keeps track of the ingested files, to skip the unchanged ones
+        self._kv_store: BaseKVStore = kwargs.get("kv_store") or SimpleKVStore()
+        # Only embed and insert the nodes of a changed document that did change
+        self.upsert: bool = kwargs.get("upsert", True)
+        # Invalidated whenever the index changes
+        self._retrieval_cache: RetrievalCache | None = kwargs.get("retrieval_cache")
+        # BM25 index of the text of the nodes, kept in sync with the index
+        self._sparse_index: SparseIndex | None = kwargs.get("sparse_index")
         self._index_thread_lock = (
             threading.Lock()
         )  # Thread lock! Not Multiprocessing lock
         self._index = self._initialize_index()
+        self._persister = IndexPersister(
+            self._save_index,
+            self._index_thread_lock,
+            settings=kwargs.get("ingest_settings") or get_ingest_settings(),
+            log_dir=ingest_log_path,
+        )
+        self._replay_log()
+        self._backfill_sparse_index()
 
     def _initialize_index(self) -> BaseIndex[IndexDict]:
         """Initialize the index from the storage context."""
@@ -148,13 +252,326 @@ class BaseIngestComponentWithIndex(BaseIngestComponent, abc.ABC):
     def _save_index(self) -> None:
         self._index.storage_context.persist(persist_dir=local_data_path)
 
+    def _replay_log(self) -> None:
+        """Apply the changes logged, but not persisted, by crashed processes."""
+        with self._index_thread_lock:
+            count_changes = 0
+            for record in self._persister.orphan_records():
+                self._apply_changes(_IndexChanges.from_dict(record), replay=True)
+                count_changes += 1
+            if count_changes:
+                logger.info("Replayed count=%s logged index changes", count_changes)
+                self._persister.persist()
+                self._invalidate_retrievals()
+
+    def _backfill_sparse_index(self) -> None:
+        """Index the nodes ingested before the sparse index was enabled."""
+        if self._sparse_index is None or self._sparse_index.count_nodes():
+            return
+        node_ids = list(self._index.index_struct.nodes_dict.values())
+        if not node_ids:
+            return
+        logger.info("Backfilling the sparse index with count=%s nodes", len(node_ids))
+        with self._index_thread_lock:
+            for start in range(0, len(node_ids), DELETE_BATCH_SIZE):
+                batch = node_ids[start : start + DELETE_BATCH_SIZE]
+                nodes = get_nodes(self._index.docstore, batch)
+                self._sparse_index.add(list(nodes.values()))
+
     def delete(self, doc_id: str) -> None:
         with self._index_thread_lock:
             # Delete the document from the index
+            self._commit_changes(_IndexChanges(deleted_doc_ids=[doc_id]))
+
+    def close(self) -> None:
+        self._persister.close()
+
+    def _ingested_file_documents(
+        self, file_name: str, file_hash: str
+    ) -> list[Document] | None:
+        """Get the documents of a file already ingested with the same content.
+
+        Returns None if the file has to be ingested, because it is new, it has
+        changed, or some of its documents have been deleted since.
+        """
+        record = self._kv_store.get(file_name, collection=INGESTED_FILES_COLLECTION)
+        if record is None or record["file_hash"] != file_hash:
+            return None
+        documents = [
+            Document(id_=document["doc_id"], metadata=document["metadata"])
+            for document in record["documents"]
+        ]
+        docstore = self._index.docstore
+        if any(docstore.get_document_hash(doc.doc_id) is None for doc in documents):
+            return None
+        logger.info("Skipping unchanged file_name=%s", file_name)
+        return documents
+
+    def _split_ingested_files(
+        self, files: list[tuple[str, Path]]
+    ) -> tuple[list[Document], list[tuple[str, Path]], dict[str, str]]:
+        """Split the files into the ones already ingested and the ones to ingest.
+
+        Returns the documents of the already ingested files, the files to
+        ingest, and the hashes of the files to ingest, by file name.
+        """
+        ingested_documents: list[Document] = []
+        new_files: list[tuple[str, Path]] = []
+        file_hashes: dict[str, str] = {}
+        for file_name, file_data in files:
+            with ingest_stage("hash"):
+                file_hash = IngestionHelper.file_hash(file_data)
+            documents = self._ingested_file_documents(file_name, file_hash)
+            if documents is None:
+                new_files.append((file_name, file_data))
+                file_hashes[file_name] = file_hash
+            else:
+                ingested_documents.extend(documents)
+        return ingested_documents, new_files, file_hashes
+
+    def _changed_documents(self, documents: list[Document]) -> list[Document]:
+        """Filter out the documents already stored with the same content."""
+        docstore = self._index.docstore
+        changed_documents = [
+            document
+            for document in documents
+            if docstore.get_document_hash(document.doc_id) != document.hash
+        ]
+        logger.debug(
+            "Skipping count=%s unchanged documents",
+            len(documents) - len(changed_documents),
+        )
+        return changed_documents
+
+    def _plan_replacements(
+        self, changes: "_IndexChanges", documents: list[Document], nodes: list[BaseNode]
+    ) -> None:
+        """Replace the stored version of the documents with all their new nodes."""
+        docstore = self._index.docstore
+        for document in documents:
+            if docstore.get_document_hash(document.doc_id) is not None:
+                logger.debug("Replacing changed doc_id=%s", document.doc_id)
+                changes.deleted_doc_ids.append(document.doc_id)
+        changes.new_nodes = nodes
+
+    def _plan_files(
+        self,
+        changes: "_IndexChanges",
+        documents: list[Document],
+        file_hashes: dict[str, str],
+    ) -> None:
+        """Record the ingested files and drop the documents they no longer have."""
+        files_documents: dict[str, list[Document]] = {}
+        for document in documents:
+            file_name = document.metadata["file_name"]
+            files_documents.setdefault(file_name, []).append(document)
+
+        for file_name, file_documents in files_documents.items():
+            doc_ids = {document.doc_id for document in file_documents}
+            previous_record = self._kv_store.get(
+                file_name, collection=INGESTED_FILES_COLLECTION
+            )
+            if previous_record is not None:
+                changes.deleted_doc_ids.extend(
+                    document["doc_id"]
+                    for document in previous_record["documents"]
+                    if document["doc_id"] not in doc_ids
+                )
+            changes.files[file_name] = {
+                "file_hash": file_hashes.get(file_name),
+                "documents": [
+                    {"doc_id": document.doc_id, "metadata": document.metadata}
+                    for document in file_documents
+                ],
+            }
+
+    def _transform_documents(self, documents: list[Document]) -> list[BaseNode]:
+        """Transform the documents into nodes, embedding only the nodes to insert.
+
+        When upserting, the nodes already stored keep their id and are returned
+        without an embedding.
+        """
+        nodes, new_nodes = self._split_documents(documents)
+        self._embed_nodes(new_nodes)
+        return nodes
+
+    def _split_documents(
+        self, documents: list[Document]
+    ) -> tuple[list[BaseNode], list[BaseNode]]:
+        """Split the documents into nodes, without embedding them.
+
+        Returns all the nodes of the documents, and the ones to embed.
+        """
+        nodes = run_transformations(
+            documents,  # type: ignore[arg-type]
+            [
+                transformation
+                for transformation in self.service_context.transformations
+                if not isinstance(transformation, BaseEmbedding)
+            ],
+            show_progress=self.show_progress,
+        )
+        if not self.upsert:
+            return nodes, nodes
+
+        IngestionHelper.assign_node_ids(nodes)
+        stored_node_ids = set(
+            itertools.chain.from_iterable(self._stored_node_ids(documents).values())
+        )
+        new_nodes = [node for node in nodes if node.node_id not in stored_node_ids]
+        logger.info(
+            "Embedding count=%s new nodes out of count=%s", len(new_nodes), len(nodes)
+        )
+        return nodes, new_nodes
+
+    def _embed_nodes(self, nodes: list[BaseNode]) -> None:
+        run_transformations(
+            nodes,
+            [
+                transformation
+                for transformation in self.service_context.transformations
+                if isinstance(transformation, BaseEmbedding)
+            ],
+            show_progress=self.show_progress,
+        )
+
+    def _stored_node_ids(self, documents: list[Document]) -> dict[str, list[str]]:
+        stored_node_ids = {}
+        for document in documents:
+            ref_doc_info = self._index.docstore.get_ref_doc_info(document.doc_id)
+            if ref_doc_info is not None:
+                stored_node_ids[document.doc_id] = ref_doc_info.node_ids
+        return stored_node_ids
+
+    def _plan_upsert(
+        self, changes: "_IndexChanges", documents: list[Document], nodes: list[BaseNode]
+    ) -> None:
+        """Insert the new nodes of the documents and delete the vanished ones."""
+        docstore = self._index.docstore
+        assert isinstance(docstore, KVDocumentStore), "Upsert needs a KV docstore"
+        stored_node_ids = self._stored_node_ids(documents)
+        stored_ids = set(itertools.chain.from_iterable(stored_node_ids.values()))
+        node_ids = {node.node_id for node in nodes}
+        changes.deleted_node_ids = [
+            node_id
+            for document_node_ids in stored_node_ids.values()
+            for node_id in document_node_ids
+            if node_id not in node_ids
+        ]
+        changes.new_nodes = [node for node in nodes if node.node_id not in stored_ids]
+
+        # The kept nodes next to a new or vanished one have new neighbours
+        moved_node_ids = set()
+        for node_id in changes.deleted_node_ids:
+            vanished_node = docstore.get_document(node_id, raise_error=False)
+            if vanished_node is not None:
+                moved_node_ids.update(_neighbour_ids(vanished_node))
+        for node in changes.new_nodes:
+            moved_node_ids.update(_neighbour_ids(node))
+        changes.moved_nodes = [
+            node
+            for node in nodes
+            if node.node_id in stored_ids and node.node_id in moved_node_ids
+        ]
+        logger.info(
+            "Upserting count=%s new nodes, deleting count=%s vanished nodes",
+            len(changes.new_nodes),
+            len(changes.deleted_node_ids),
+        )
+
+        # Keep the nodes of each document in order, without the vanished ones
+        documents_nodes: dict[str, list[str]] = {}
+        for node in nodes:
+            documents_nodes.setdefault(node.ref_doc_id or "", []).append(node.node_id)
+        for document in documents:
+            changes.ref_doc_infos[document.doc_id] = RefDocInfo(
+                node_ids=documents_nodes.get(document.doc_id, []),
+                metadata=document.metadata,
+            )
+
+    def _apply_changes(self, changes: "_IndexChanges", replay: bool = False) -> None:
+        """Apply changes to the index and its stores.
+
+        Applying the same changes again has no effect, so they can be replayed
+        from the log whether or not they had been applied before a crash.
+
+        Must be called with the index lock held.
+        """
+        docstore = self._index.docstore
+        for doc_id in changes.deleted_doc_ids:
+            ref_doc_info = docstore.get_ref_doc_info(doc_id)
+            if self._sparse_index is not None and ref_doc_info is not None:
+                self._sparse_index.delete(ref_doc_info.node_ids)
             self._index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        deleted_node_ids = changes.deleted_node_ids
+        if replay:
+            # Don't insert the nodes twice in the vector store
+            deleted_node_ids = deleted_node_ids + [
+                node.node_id for node in changes.new_nodes
+            ]
+        if deleted_node_ids:
+            assert isinstance(docstore, KVDocumentStore), "Needs a KV docstore"
+            _delete_vector_store_nodes(self._index.vector_store, deleted_node_ids)
+            _delete_docstore_nodes(docstore, deleted_node_ids)
+            for node_id in deleted_node_ids:
+                if node_id in self._index.index_struct.nodes_dict:
+                    self._index.index_struct.delete(node_id)
+            self.storage_context.index_store.add_index_struct(self._index.index_struct)
+            if self._sparse_index is not None:
+                self._sparse_index.delete(deleted_node_ids)
+        docstore.add_documents(changes.moved_nodes)
+        logger.info("Inserting count=%s nodes in the index", len(changes.new_nodes))
+        self._index.insert_nodes(changes.new_nodes, show_progress=True)
+        if self._sparse_index is not None:
+            self._sparse_index.add(changes.new_nodes)
+        for doc_id, ref_doc_info in changes.ref_doc_infos.items():
+            assert isinstance(docstore, KVDocumentStore), "Needs a KV docstore"
+            docstore._kvstore.put(
+                doc_id, ref_doc_info.to_dict(), collection=docstore._ref_doc_collection
+            )
+        for doc_id, doc_hash in changes.document_hashes.items():
+            docstore.set_document_hash(doc_id, doc_hash)
+        for file_name, record in changes.files.items():
+            self._kv_store.put(file_name, record, collection=INGESTED_FILES_COLLECTION)
+
+    def _invalidate_retrievals(self) -> None:
+        if self._retrieval_cache is not None:
+            self._retrieval_cache.invalidate()
+
+    def _commit_changes(self, changes: "_IndexChanges") -> None:
+        """Log the changes, apply them, and persist the index if it is due.
 
-            # Save the index
-            self._save_index()
+        Must be called with the index lock held.
+        """
+        with ingest_stage("insert", cancellable=False):
+            self._persister.log(changes.to_dict())
+            self._apply_changes(changes)
+            self._invalidate_retrievals()
+        with ingest_stage("persist", cancellable=False):
+            self._persister.changed()
+
+    def _insert_documents(
+        self,
+        documents: list[Document],
+        changed_documents: list[Document],
+        nodes: list[BaseNode],
+        file_hashes: dict[str, str],
+    ) -> None:
+        """Insert the nodes of the changed documents in the index.
+
+        Must be called with the index lock held.
+        """
+        changes = _IndexChanges(
+            document_hashes={
+                document.doc_id: document.hash for document in changed_documents
+            }
+        )
+        if self.upsert:
+            self._plan_upsert(changes, changed_documents, nodes)
+        else:
+            self._plan_replacements(changes, changed_documents, nodes)
+        self._plan_files(changes, documents, file_hashes)
+        self._commit_changes(changes)
 
 
 class SimpleIngestComponent(BaseIngestComponentWithIndex):
@@ -169,31 +586,47 @@ class SimpleIngestComponent(BaseIngestComponentWithIndex):
 
     def ingest(self, file_name: str, file_data: Path) -> list[Document]:
         logger.info("Ingesting file_name=%s", file_name)
-        documents = IngestionHelper.transform_file_into_documents(file_name, file_data)
+        ingested_documents, new_files, file_hashes = self._split_ingested_files(
+            [(file_name, file_data)]
+        )
+        if not new_files:
+            return ingested_documents
+        with ingest_stage("parse"):
+            documents = IngestionHelper.transform_file_into_documents(
+                file_name, file_data
+            )
         logger.info(
             "Transformed file=%s into count=%s documents", file_name, len(documents)
         )
         logger.debug("Saving the documents in the index and doc store")
-        return self._save_docs(documents)
+        return self._save_docs(documents, file_hashes)
 
     def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[Document]:
-        saved_documents = []
-        for file_name, file_data in files:
-            documents = IngestionHelper.transform_file_into_documents(
-                file_name, file_data
-            )
-            saved_documents.extend(self._save_docs(documents))
+        saved_documents, new_files, file_hashes = self._split_ingested_files(files)
+        for file_name, file_data in new_files:
+            preemption_point()
+            with ingest_stage("parse"):
+                documents = IngestionHelper.transform_file_into_documents(
+                    file_name, file_data
+                )
+            saved_documents.extend(self._save_docs(documents, file_hashes))
         return saved_documents
 
-    def _save_docs(self, documents: list[Document]) -> list[Document]:
-        logger.debug("Transforming count=%s documents into nodes", len(documents))
+    def _save_docs(
+        self, documents: list[Document], file_hashes: dict[str, str]
+    ) -> list[Document]:
+        changed_documents = self._changed_documents(documents)
+        logger.debug(
+            "Transforming count=%s documents into nodes", len(changed_documents)
+        )
         with self._index_thread_lock:
-            for document in documents:
-                self._index.insert(document, show_progress=True)
-            logger.debug("Persisting the index and nodes")
-            # persist the index and nodes
-            self._save_index()
-            logger.debug("Persisted the index and nodes")
+            with ingest_stage("transform"):
+                nodes = [
+                    node
+                    for document in changed_documents
+                    for node in self._transform_documents([document])
+                ]
+            self._insert_documents(documents, changed_documents, nodes, file_hashes)
         return documents
 
 
@@ -226,47 +659,50 @@ class BatchIngestComponent(BaseIngestComponentWithIndex):
 
     def ingest(self, file_name: str, file_data: Path) -> list[Document]:
         logger.info("Ingesting file_name=%s", file_name)
-        documents = IngestionHelper.transform_file_into_documents(file_name, file_data)
+        ingested_documents, new_files, file_hashes = self._split_ingested_files(
+            [(file_name, file_data)]
+        )
+        if not new_files:
+            return ingested_documents
+        with ingest_stage("parse"):
+            documents = IngestionHelper.transform_file_into_documents(
+                file_name, file_data
+            )
         logger.info(
             "Transformed file into documents", file_name=file_name, count=len(documents)
         )
         logger.debug("Saving the documents in the index and doc store")
-        return self._save_docs(documents)
+        return self._save_docs(documents, file_hashes)
 
     def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[Document]:
+        ingested_documents, new_files, file_hashes = self._split_ingested_files(files)
         documents = list(
             itertools.chain.from_iterable(
-                self._file_to_documents_work_pool.starmap(
-                    IngestionHelper.transform_file_into_documents, files
+                _parse_files(
+                    self._file_to_documents_work_pool, new_files, self.count_workers
                 )
             )
         )
         logger.info(
             "Transformed count=%s files into count=%s documents",
-            len(files),
+            len(new_files),
             len(documents),
         )
-        return self._save_docs(documents)
+        preemption_point()
+        return ingested_documents + self._save_docs(documents, file_hashes)
 
-    def _save_docs(self, documents: list[Document]) -> list[Document]:
-        logger.debug("Transforming count=%s documents into nodes", len(documents))
-        nodes = run_transformations(
-            documents,  # type: ignore[arg-type]
-            self.service_context.transformations,
-            show_progress=self.show_progress,
+    def _save_docs(
+        self, documents: list[Document], file_hashes: dict[str, str]
+    ) -> list[Document]:
+        changed_documents = self._changed_documents(documents)
+        logger.debug(
+            "Transforming count=%s documents into nodes", len(changed_documents)
         )
+        with ingest_stage("transform"):
+            nodes = self._transform_documents(changed_documents)
         # Locking the index to avoid concurrent writes
         with self._index_thread_lock:
-            logger.info("Inserting count=%s nodes in the index", len(nodes))
-            self._index.insert_nodes(nodes, show_progress=True)
-            for document in documents:
-                self._index.docstore.set_document_hash(
-                    document.get_doc_id(), document.hash
-                )
-            logger.debug("Persisting the index and nodes")
-            # persist the index and nodes
-            self._save_index()
-            logger.debug("Persisted the index and nodes")
+            self._insert_documents(documents, changed_documents, nodes, file_hashes)
         return documents
 
 
@@ -275,6 +711,12 @@ class ParallelizedIngestComponent(BaseIngestComponentWithIndex):
 
     This use the CPU and GPU in parallel (both running at the same time), and
     reduce the memory pressure by not loading all the files in memory at the same time.
+
+    Bulk ingestion goes through a pipeline of stages connected by bounded
+    queues: files are parsed in the process pool, split into nodes, embedded
+    in batches mixing several files, and inserted in the index. Each stage
+    works on the next files while the following stage is busy, and blocks
+    when it is too far ahead.
     """
 
     def __init__(
@@ -293,91 +735,363 @@ class ParallelizedIngestComponent(BaseIngestComponentWithIndex):
         ), "Embeddings must be in the transformations"
         assert count_workers > 0, "count_workers must be > 0"
         self.count_workers = count_workers
+        self.queue_size: int = kwargs.get("queue_size", 4)
+        self.embed_batch_size: int = kwargs.get("embed_batch_size", 256)
         # We are doing our own multiprocessing
         # To do not collide with the multiprocessing of huggingface, we disable it
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-        self._ingest_work_pool = multiprocessing.pool.ThreadPool(
-            processes=self.count_workers
-        )
-
         self._file_to_documents_work_pool = multiprocessing.Pool(
             processes=self.count_workers
         )
 
     def ingest(self, file_name: str, file_data: Path) -> list[Document]:
         logger.info("Ingesting file_name=%s", file_name)
+        ingested_documents, new_files, file_hashes = self._split_ingested_files(
+            [(file_name, file_data)]
+        )
+        if not new_files:
+            return ingested_documents
         # Running in a single (1) process to release the current
         # thread, and take a dedicated CPU core for computation
-        documents = self._file_to_documents_work_pool.apply(
-            IngestionHelper.transform_file_into_documents, (file_name, file_data)
-        )
+        with ingest_stage("parse"):
+            documents = self._file_to_documents_work_pool.apply(
+                IngestionHelper.transform_file_into_documents, (file_name, file_data)
+            )
         logger.info(
             "Transformed file=%s into count=%s documents", file_name, len(documents)
         )
         logger.debug("Saving the documents in the index and doc store")
-        return self._save_docs(documents)
+        return self._save_docs(documents, file_hashes)
 
     def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[Document]:
-        # Lightweight threads, used for parallelize the
-        # underlying IO calls made in the ingestion
+        ingested_documents, new_files, file_hashes = self._split_ingested_files(files)
+        if not new_files:
+            return ingested_documents
 
-        documents = list(
-            itertools.chain.from_iterable(
-                self._ingest_work_pool.starmap(self.ingest, files)
+        split_queue: queue.Queue[_SplitFile | object] = queue.Queue(self.queue_size)
+        embedded_queue: queue.Queue[_SplitFile | object] = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        errors: list[BaseException] = []
+        stages = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self._run_stage, self._split_stage, new_files, split_queue),
+                kwargs={"stop": stop, "errors": errors},
+                name="ingest-split",
+            ),
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self._run_stage, self._embed_stage, split_queue, embedded_queue),
+                kwargs={"stop": stop, "errors": errors},
+                name="ingest-embed",
+            ),
+        ]
+        for stage in stages:
+            stage.start()
+
+        # The insertion stage runs in the calling thread
+        documents = []
+        try:
+            for split_file in _consume(embedded_queue, stop):
+                preemption_point()
+                with self._index_thread_lock:
+                    self._insert_documents(
+                        split_file.documents,
+                        split_file.changed_documents,
+                        split_file.nodes,
+                        file_hashes,
+                    )
+                documents.extend(split_file.documents)
+        finally:
+            stop.set()
+            for stage in stages:
+                stage.join()
+        if errors:
+            raise errors[0]
+        return ingested_documents + documents
+
+    @staticmethod
+    def _run_stage(
+        stage: Callable[[Any, queue.Queue, threading.Event], None],
+        stage_input: Any,
+        output: queue.Queue,
+        stop: threading.Event,
+        errors: list[BaseException],
+    ) -> None:
+        try:
+            stage(stage_input, output, stop)
+            _produce(output, _END_OF_STAGE, stop)
+        except BaseException as e:
+            logger.exception("Ingestion pipeline stage failed")
+            errors.append(e)
+            stop.set()
+
+    def _split_stage(
+        self,
+        files: list[tuple[str, Path]],
+        output: queue.Queue,
+        stop: threading.Event,
+    ) -> None:
+        for documents in _parse_files(
+            self._file_to_documents_work_pool, files, self.count_workers
+        ):
+            if stop.is_set():
+                return
+            changed_documents = self._changed_documents(documents)
+            with ingest_stage("split"):
+                nodes, new_nodes = self._split_documents(changed_documents)
+            _produce(
+                output,
+                _SplitFile(documents, changed_documents, nodes, new_nodes),
+                stop,
             )
-        )
-        return documents
 
-    def _save_docs(self, documents: list[Document]) -> list[Document]:
-        logger.debug("Transforming count=%s documents into nodes", len(documents))
-        nodes = run_transformations(
-            documents,  # type: ignore[arg-type]
-            self.service_context.transformations,
-            show_progress=self.show_progress,
+    def _embed_stage(
+        self,
+        split_queue: queue.Queue,
+        output: queue.Queue,
+        stop: threading.Event,
+    ) -> None:
+        batch: list[_SplitFile] = []
+
+        def embed_batch() -> None:
+            nodes = [node for split_file in batch for node in split_file.new_nodes]
+            logger.debug(
+                "Embedding count=%s nodes of count=%s files", len(nodes), len(batch)
+            )
+            preemption_point()
+            with ingest_stage("embed"):
+                self._embed_nodes(nodes)
+            for split_file in batch:
+                _produce(output, split_file, stop)
+            batch.clear()
+
+        count_nodes = 0
+        for split_file in _consume(split_queue, stop):
+            batch.append(split_file)
+            count_nodes += len(split_file.new_nodes)
+            # Don't wait for a full batch if the embeddings would be idle
+            if count_nodes >= self.embed_batch_size or split_queue.empty():
+                embed_batch()
+                count_nodes = 0
+        if batch:
+            embed_batch()
+
+    def _save_docs(
+        self, documents: list[Document], file_hashes: dict[str, str]
+    ) -> list[Document]:
+        changed_documents = self._changed_documents(documents)
+        logger.debug(
+            "Transforming count=%s documents into nodes", len(changed_documents)
         )
+        with ingest_stage("transform"):
+            nodes = self._transform_documents(changed_documents)
         # Locking the index to avoid concurrent writes
         with self._index_thread_lock:
-            logger.info("Inserting count=%s nodes in the index", len(nodes))
-            self._index.insert_nodes(nodes, show_progress=True)
-            for document in documents:
-                self._index.docstore.set_document_hash(
-                    document.get_doc_id(), document.hash
-                )
-            logger.debug("Persisting the index and nodes")
-            # persist the index and nodes
-            self._save_index()
-            logger.debug("Persisted the index and nodes")
+            self._insert_documents(documents, changed_documents, nodes, file_hashes)
         return documents
 
     def __del__(self) -> None:
         # We need to do the appropriate cleanup of the multiprocessing pools
         # when the object is deleted. Using root logger to avoid
         # the logger to be deleted before the pool
-        logging.debug("Closing the ingest work pool")
-        self._ingest_work_pool.close()
-        self._ingest_work_pool.join()
-        self._ingest_work_pool.terminate()
         logging.debug("Closing the file to documents work pool")
         self._file_to_documents_work_pool.close()
         self._file_to_documents_work_pool.join()
         self._file_to_documents_work_pool.terminate()
 
 
+@dataclass
+class _IndexChanges:
+    """Changes made to the index by a single ingestion or deletion."""
+
+    # Documents deleted with all their nodes
+    deleted_doc_ids: list[str] = field(default_factory=list)
+    # Nodes of upserted documents that they no longer have
+    deleted_node_ids: list[str] = field(default_factory=list)
+    # Nodes to insert, with their embedding
+    new_nodes: list[BaseNode] = field(default_factory=list)
+    # Nodes already inserted, whose relationships changed
+    moved_nodes: list[BaseNode] = field(default_factory=list)
+    ref_doc_infos: dict[str, RefDocInfo] = field(default_factory=dict)
+    document_hashes: dict[str, str] = field(default_factory=dict)
+    # Records of the ingested files, by file name
+    files: dict[str, dict[str, Any]] = field(default_factory=dict)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "deleted_doc_ids": self.deleted_doc_ids,
+            "deleted_node_ids": self.deleted_node_ids,
+            "new_nodes": [doc_to_json(node) for node in self.new_nodes],
+            "moved_nodes": [doc_to_json(node) for node in self.moved_nodes],
+            "ref_doc_infos": {
+                doc_id: ref_doc_info.to_dict()
+                for doc_id, ref_doc_info in self.ref_doc_infos.items()
+            },
+            "document_hashes": self.document_hashes,
+            "files": self.files,
+        }
+
+    @classmethod
+    def from_dict(cls, changes: dict[str, Any]) -> "_IndexChanges":
+        return cls(
+            deleted_doc_ids=changes["deleted_doc_ids"],
+            deleted_node_ids=changes["deleted_node_ids"],
+            new_nodes=[json_to_doc(node) for node in changes["new_nodes"]],
+            moved_nodes=[json_to_doc(node) for node in changes["moved_nodes"]],
+            ref_doc_infos={
+                doc_id: RefDocInfo(**ref_doc_info)
+                for doc_id, ref_doc_info in changes["ref_doc_infos"].items()
+            },
+            document_hashes=changes["document_hashes"],
+            files=changes["files"],
+        )
+
+
+@dataclass
+class _SplitFile:
+    """The documents of a file, going through the ingestion pipeline."""
+
+    documents: list[Document]
+    changed_documents: list[Document]
+    nodes: list[BaseNode]
+    new_nodes: list[BaseNode]
+
+
+# Put by a pipeline stage in its output queue once it is done
+_END_OF_STAGE = object()
+
+
+def _produce(output: queue.Queue, item: object, stop: threading.Event) -> None:
+    """Put an item in the queue, blocking while it is full."""
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _consume(stage_input: queue.Queue, stop: threading.Event) -> Iterator[Any]:
+    """Get the items of the queue until the previous stage is done."""
+    while True:
+        try:
+            item = stage_input.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return
+            continue
+        if item is _END_OF_STAGE:
+            return
+        yield item
+
+
+def _parse_files(
+    pool: multiprocessing.pool.Pool,
+    files: list[tuple[str, Path]],
+    count_workers: int,
+) -> Iterator[list[Document]]:
+    """Parse the files in the process pool, yielding their documents in order.
+
+    Only a few files are submitted ahead, so the parsed documents don't pile up
+    in memory while the caller is busy, and bulk ingestions stay within their
+    budget of parsing processes.
+    """
+    pending: deque[multiprocessing.pool.AsyncResult] = deque()
+    remaining_files = iter(files)
+    for file in itertools.islice(remaining_files, parse_workers(count_workers)):
+        pending.append(
+            pool.apply_async(IngestionHelper.transform_file_into_documents, file)
+        )
+    while pending:
+        with ingest_stage("parse"):
+            documents = pending.popleft().get()
+        for file in itertools.islice(remaining_files, 1):
+            pending.append(
+                pool.apply_async(IngestionHelper.transform_file_into_documents, file)
+            )
+        yield documents
+
+
+def _neighbour_ids(node: BaseNode) -> list[str]:
+    return [
+        related_node.node_id
+        for relationship, related_node in node.relationships.items()
+        if relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT)
+        and not isinstance(related_node, list)
+    ]
+
+
+def _delete_vector_store_nodes(vector_store: VectorStore, node_ids: list[str]) -> None:
+    """Delete nodes from the vector store by id, in batches."""
+    if isinstance(vector_store, MilvusVectorStore):
+        for start in range(0, len(node_ids), DELETE_BATCH_SIZE):
+            vector_store.milvusclient.delete(
+                collection_name=vector_store.collection_name,
+                pks=node_ids[start : start + DELETE_BATCH_SIZE],
+            )
+    elif isinstance(vector_store, MmapVectorStore):
+        vector_store.delete_nodes(node_ids)
+    elif isinstance(vector_store, SimpleVectorStore):
+        data = vector_store._data
+        for node_id in node_ids:
+            data.embedding_dict.pop(node_id, None)
+            data.text_id_to_ref_doc_id.pop(node_id, None)
+            if data.metadata_dict is not None:
+                data.metadata_dict.pop(node_id, None)
+    else:
+        raise NotImplementedError(
+            f"Deleting nodes from {type(vector_store).__name__} is not supported"
+        )
+
+
+def _delete_docstore_nodes(docstore: KVDocumentStore, node_ids: list[str]) -> None:
+    """Delete nodes from the docstore, leaving the documents info untouched."""
+    kvstore = docstore._kvstore
+    if isinstance(kvstore, RedisKVStore):
+        # One round trip per batch, instead of several per node
+        for start in range(0, len(node_ids), DELETE_BATCH_SIZE):
+            batch = node_ids[start : start + DELETE_BATCH_SIZE]
+            pipeline = kvstore._redis_client.pipeline(transaction=False)
+            pipeline.hdel(docstore._node_collection, *batch)
+            pipeline.hdel(docstore._metadata_collection, *batch)
+            pipeline.execute()
+    else:
+        for node_id in node_ids:
+            docstore.delete_document(
+                node_id, raise_error=False, remove_ref_doc_node=False
+            )
+
+
 def get_ingestion_component(
     storage_context: StorageContext,
     service_context: ServiceContext,
     settings: EmbeddingSettings,
+    kv_store: BaseKVStore | None = None,
+    retrieval_cache: RetrievalCache | None = None,
+    sparse_index: SparseIndex | None = None,
 ) -> BaseIngestComponent:
     """Get the ingestion component for the given configuration."""
     ingest_mode = settings.ingest_mode
+    kwargs = {
+        "kv_store": kv_store,
+        "upsert": settings.ingest_upsert,
+        "retrieval_cache": retrieval_cache,
+        "sparse_index": sparse_index,
+    }
     if ingest_mode == "batch":
         return BatchIngestComponent(
-            storage_context, service_context, settings.count_workers
+            storage_context, service_context, settings.count_workers, **kwargs
         )
     elif ingest_mode == "parallel":
         return ParallelizedIngestComponent(
-            storage_context, service_context, settings.count_workers
+            storage_context,
+            service_context,
+            settings.count_workers,
+            queue_size=settings.ingest_queue_size,
+            embed_batch_size=settings.ingest_embed_batch_size,
+            **kwargs,
         )
     else:
-        return SimpleIngestComponent(storage_context, service_context)
+        return SimpleIngestComponent(storage_context, service_context, **kwargs)
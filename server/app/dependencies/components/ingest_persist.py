@@ -0,0 +1,159 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import IO, Any, Callable, Iterator
+
+import structlog.stdlib
+
+from app.config.settings import IngestSettings, get_ingest_settings
+from app.paths import ingest_log_path
+
+logger = structlog.stdlib.get_logger(__name__)
+
+
+class IndexPersister:
+    """Debounce the persistence of the index, and log the changes in between.
+
+    Persisting the storage context rewrites all of its stores, so it is done
+    every `persist_every` changes, `persist_interval` seconds after the first
+    change that was not persisted, and on `close`.
+
+    Every change is appended to a log file, and synced to disk, before being
+    applied. The log only holds the changes since the last persistence: it is
+    truncated once they are persisted. Each process has its own log, locked
+    for the lifetime of the process, so the logs left behind by a process that
+    crashed can be found and replayed by the next one.
+    """
+
+    def __init__(
+        self,
+        persist: Callable[[], None],
+        lock: threading.Lock,
+        settings: IngestSettings = get_ingest_settings(),
+        log_dir: Path = ingest_log_path,
+    ) -> None:
+        self._persist = persist
+        # Lock of the index, held by the callers of `log` and `changed`
+        self._lock = lock
+        self.settings = settings
+        self._log_dir = log_dir
+        self._count_changes = 0
+        self._first_change_at: float | None = None
+        # Logs of crashed processes, deleted once their changes are persisted.
+        # They stay open, and locked, until then, so that no other process
+        # replays them again in between.
+        self._orphan_logs: list[IO[bytes]] = []
+        self._log_file = None
+        if settings.persist_log:
+            log_dir.mkdir(parents=True, exist_ok=True)
+            log_name = f"{os.getpid()}-{uuid.uuid4().hex}.jsonl"
+            self._log_file = (log_dir / log_name).open("ab")
+            fcntl.flock(self._log_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self._closed = threading.Event()
+        self._timer: threading.Thread | None = None
+        if settings.persist_interval > 0:
+            self._timer = threading.Thread(
+                target=self._persist_periodically, name="index-persister", daemon=True
+            )
+            self._timer.start()
+
+    def orphan_records(self) -> Iterator[dict[str, Any]]:
+        """Read the changes logged by processes that are not running anymore.
+
+        The logs are kept locked, and deleted by the next `persist` once the
+        replayed changes are persisted.
+        """
+        if self._log_file is None:
+            return
+        for log_file in sorted(self._log_dir.glob("*.jsonl")):
+            file = log_file.open("rb")
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # The log of a running process, including ours
+                file.close()
+                continue
+            try:
+                logger.info("Replaying orphan ingest log", log_file=log_file.name)
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # The process crashed while writing this last record,
+                        # so the change has never been acknowledged
+                        logger.warning("Skipping truncated ingest log record")
+            except BaseException:
+                # Not fully replayed, left for the next process
+                file.close()
+                raise
+            self._orphan_logs.append(file)
+
+    def log(self, record: dict[str, Any]) -> None:
+        """Durably log a change, before applying it.
+
+        Must be called with the index lock held.
+        """
+        if self._log_file is None:
+            return
+        self._log_file.write(json.dumps(record).encode() + b"\n")
+        self._log_file.flush()
+        os.fsync(self._log_file.fileno())
+
+    def changed(self) -> None:
+        """Count an applied change, and persist if there are too many of them.
+
+        Must be called with the index lock held.
+        """
+        self._count_changes += 1
+        if self._first_change_at is None:
+            self._first_change_at = time.monotonic()
+        if self._count_changes >= self.settings.persist_every:
+            self.persist()
+
+    def persist(self) -> None:
+        """Persist the index now, and truncate the log.
+
+        Must be called with the index lock held.
+        """
+        logger.debug("Persisting the index and nodes", changes=self._count_changes)
+        self._persist()
+        self._count_changes = 0
+        self._first_change_at = None
+        if self._log_file is not None:
+            self._log_file.truncate(0)
+            os.fsync(self._log_file.fileno())
+        for file in self._orphan_logs:
+            # Deleted before being unlocked
+            Path(file.name).unlink(missing_ok=True)
+            file.close()
+        self._orphan_logs = []
+        logger.debug("Persisted the index and nodes")
+
+    def close(self) -> None:
+        """Persist the pending changes, and stop logging."""
+        self._closed.set()
+        with self._lock:
+            if self._count_changes:
+                self.persist()
+            for file in self._orphan_logs:
+                file.close()
+            self._orphan_logs = []
+            if self._log_file is not None:
+                self._log_file.close()
+                Path(self._log_file.name).unlink(missing_ok=True)
+                self._log_file = None
+
+    def _persist_periodically(self) -> None:
+        interval = self.settings.persist_interval
+        while not self._closed.wait(min(interval, 1.0)):
+            first_change_at = self._first_change_at
+            if first_change_at is None or time.monotonic() - first_change_at < interval:
+                continue
+            with self._lock:
+                if self._count_changes and not self._closed.is_set():
+                    self.persist()
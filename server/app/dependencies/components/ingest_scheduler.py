@@ -0,0 +1,93 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Iterator
+
+import structlog.stdlib
+
+from app.config.settings import IngestSettings, get_ingest_settings
+
+logger = structlog.stdlib.get_logger(__name__)
+
+_current_scheduler: ContextVar["IngestScheduler | None"] = ContextVar(
+    "ingest_scheduler", default=None
+)
+
+
+class IngestScheduler:
+    """Give interactive ingestions priority over the bulk ones.
+
+    Interactive ingestions (a single file, usually uploaded from the UI) run
+    right away. Bulk ingestions run in their own lane, where at most
+    `bulk_concurrency` of them run at the same time and each only keeps
+    `bulk_workers` parsing processes busy.
+
+    Bulk work is split in batches by the ingest components, which call
+    `preemption_point` between two batches: a bulk ingestion then waits for
+    the interactive ingestions to be done, for at most `bulk_max_pause`
+    seconds so it is never starved.
+    """
+
+    def __init__(self, settings: IngestSettings = get_ingest_settings()) -> None:
+        self.settings = settings
+        self._bulk_slots = threading.BoundedSemaphore(settings.bulk_concurrency)
+        self._interactive_done = threading.Condition()
+        self._count_interactive = 0
+
+    @contextmanager
+    def interactive(self) -> Iterator[None]:
+        with self._interactive_done:
+            self._count_interactive += 1
+        try:
+            yield
+        finally:
+            with self._interactive_done:
+                self._count_interactive -= 1
+                self._interactive_done.notify_all()
+
+    @contextmanager
+    def bulk(self) -> Iterator[None]:
+        with self._bulk_slots:
+            token = _current_scheduler.set(self)
+            try:
+                self.yield_to_interactive()
+                yield
+            finally:
+                _current_scheduler.reset(token)
+
+    def yield_to_interactive(self) -> None:
+        """Wait for the running interactive ingestions, up to `bulk_max_pause`."""
+        with self._interactive_done:
+            if not self._count_interactive:
+                return
+            start = time.perf_counter()
+            self._interactive_done.wait_for(
+                lambda: self._count_interactive == 0,
+                timeout=self.settings.bulk_max_pause,
+            )
+        logger.debug(
+            "Bulk ingestion paused for interactive ingestions",
+            elapsed=time.perf_counter() - start,
+        )
+
+
+def preemption_point() -> None:
+    """Let interactive ingestions go first, when called from bulk work."""
+    scheduler = _current_scheduler.get()
+    if scheduler is not None:
+        scheduler.yield_to_interactive()
+
+
+def parse_workers(count_workers: int) -> int:
+    """The number of parsing processes the current ingestion can keep busy."""
+    scheduler = _current_scheduler.get()
+    if scheduler is None:
+        return count_workers
+    return max(1, min(count_workers, scheduler.settings.bulk_workers))
+
+
+@lru_cache
+def get_ingest_scheduler() -> IngestScheduler:
+    return IngestScheduler()
@@ -0,0 +1,60 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Iterator
+
+
+class IngestCancelledError(Exception):
+    """Raised inside an ingestion whose job has been cancelled."""
+
+
+@dataclass
+class IngestTracker:
+    """Book-keeping of a single ingestion: stage timings and cancellation.
+
+    The ingest components report their stages through `ingest_stage`, which
+    is a no-op unless a tracker has been installed with `track_ingestion`.
+    """
+
+    is_cancelled: Callable[[], bool] = lambda: False
+    timings: dict[str, float] = field(default_factory=dict)
+
+
+_current_tracker: ContextVar[IngestTracker | None] = ContextVar(
+    "ingest_tracker", default=None
+)
+
+
+@contextmanager
+def track_ingestion(tracker: IngestTracker) -> Iterator[IngestTracker]:
+    token = _current_tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _current_tracker.reset(token)
+
+
+@contextmanager
+def ingest_stage(name: str, cancellable: bool = True) -> Iterator[None]:
+    """Time a stage of the current ingestion.
+
+    Cancellation is checked before entering a `cancellable` stage. Stages that
+    write to the index are not cancellable, so a cancelled ingestion never
+    leaves half of a file behind.
+
+    :raises IngestCancelledError: if the current ingestion has been cancelled
+    """
+    tracker = _current_tracker.get()
+    if tracker is None:
+        yield
+        return
+
+    if cancellable and tracker.is_cancelled():
+        raise IngestCancelledError(f"Ingestion cancelled before stage={name}")
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        tracker.timings[name] = tracker.timings.get(name, 0.0) + elapsed
@@ -1,32 +1,164 @@
-from functools import lru_cache
-from typing import Annotated
+import asyncio
+import threading
+from collections.abc import AsyncGenerator, Awaitable, Callable, Iterator
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import aclosing
+from functools import lru_cache, partial
+from typing import Annotated, Any, TypeVar, cast
 
+import structlog.stdlib
 from fastapi import Depends
-from llama_index.llms import MockLLM
+from llama_index.constants import DEFAULT_NUM_OUTPUTS
+from llama_index.llms import (
+    ChatMessage,
+    ChatResponse,
+    CompletionResponse,
+    LLMMetadata,
+    MockLLM,
+)
 from llama_index.llms.base import LLM
 from llama_index.llms.llama_utils import completion_to_prompt, messages_to_prompt
 from pydantic import BaseModel
 
-from app.config.settings import AppSettings, get_app_settings
+from app.config.settings import (
+    AppSettings,
+    LLMSettings,
+    ModelServerSettings,
+    get_app_settings,
+    get_llm_settings,
+    get_model_server_settings,
+)
+from app.dependencies.components.llm_scheduler import Admission, LLMScheduler
+from app.dependencies.components.model_server import ModelServerClient, RemoteLLM
 from app.paths import models_path
 
+logger = structlog.stdlib.get_logger(__name__)
+
+T = TypeVar("T")
+
+# llama2 has a context window of 4096 tokens,
+# but we set it lower to allow for some wiggle room
+CONTEXT_WINDOW = 3900
+
+
+async def iterate_in_executor(
+    iterator: Iterator[T],
+    executor: Executor,
+    on_closed: Callable[[], None] | None = None,
+) -> AsyncGenerator[T, None]:
+    """Iterate a blocking iterator in an executor, one item at a time.
+
+    The event loop is free while an item is computed, and no thread is held
+    between two items. Once done, the iterator is closed in the executor, then
+    `on_closed` is called there.
+    """
+    done = object()
+    pending: Future[T | object] | None = None
+    try:
+        while True:
+            pending = executor.submit(next, iterator, done)
+            item = await asyncio.wrap_future(pending)
+            if item is done:
+                return
+            yield cast(T, item)
+    finally:
+
+        def close() -> None:
+            try:
+                if hasattr(iterator, "close"):
+                    iterator.close()
+            finally:
+                if on_closed is not None:
+                    on_closed()
+
+        if pending is None:
+            executor.submit(close)
+        else:
+            # Once the item being computed, if any, is done
+            pending.add_done_callback(lambda _: executor.submit(close))
+
+
+class _AdmittedStream(AsyncGenerator[str, None]):
+    """A stream giving back its place in the queue if closed before started.
+
+    An async generator closed before being started does not run any of its
+    code, so it can not do it itself.
+    """
+
+    def __init__(self, stream: AsyncGenerator[str, None], admission: Admission) -> None:
+        self._stream = stream
+        self._admission = admission
+
+    def asend(self, value: None) -> Awaitable[str]:
+        return self._stream.asend(value)
+
+    def athrow(self, *args: Any) -> Awaitable[str]:
+        return self._stream.athrow(*args)
+
+    async def aclose(self) -> None:
+        self._admission.cancel()
+        await self._stream.aclose()
+
+
+class GenerationStats:
+    """Counters of the generations stopped before their end.
+
+    A generation is aborted when its stream is closed early, when its client
+    disconnects. The tokens saved are the ones left in its budget of
+    `max_new_tokens`, an upper bound of what it would have generated.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.aborted = 0
+        self.tokens_generated = 0
+        self.tokens_saved = 0
+
+    def record_abort(self, tokens_generated: int, max_tokens: int) -> None:
+        with self._lock:
+            self.aborted += 1
+            self.tokens_generated += tokens_generated
+            self.tokens_saved += max(max_tokens - tokens_generated, 0)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "aborted": self.aborted,
+                "tokens_generated": self.tokens_generated,
+                "tokens_saved": self.tokens_saved,
+            }
+
 
 class LLMComponent:
     llm: LLM
+    # Runs the blocking generation of the async API
+    generation_executor: Executor
+    # Queues the generations of the async API
+    scheduler: LLMScheduler
 
     def __init__(
         self,
         app_settings: AppSettings = get_app_settings(),
+        llm_settings: LLMSettings = get_llm_settings(),
+        model_server_settings: ModelServerSettings = get_model_server_settings(),
     ) -> None:
         from llama_index.llms import LlamaCPP
 
-        if app_settings.fastapi_env != "testing":
+        model_path = str(models_path / app_settings.llm_hf_model_file)
+        if model_server_settings.enabled:
+            self.llm = RemoteLLM(
+                ModelServerClient(settings=model_server_settings),
+                LLMMetadata(
+                    context_window=CONTEXT_WINDOW,
+                    num_output=DEFAULT_NUM_OUTPUTS,
+                    model_name=model_path,
+                ),
+            )
+        elif app_settings.fastapi_env != "testing":
             self.llm = LlamaCPP(
-                model_path=str(models_path / app_settings.llm_hf_model_file),
+                model_path=model_path,
                 temperature=0.1,
-                # llama2 has a context window of 4096 tokens,
-                # but we set it lower to allow for some wiggle room
-                context_window=3900,
+                context_window=CONTEXT_WINDOW,
                 generate_kwargs={},
                 # All to GPU
                 model_kwargs={"n_gpu_layers": -1},
@@ -35,9 +167,141 @@ class LLMComponent:
                 completion_to_prompt=completion_to_prompt,
                 verbose=True,
             )
+            if llm_settings.prompt_cache_bytes:
+                from llama_cpp import LlamaRAMCache
+
+                # The states are saved after each generation, keyed by their
+                # tokens. A prompt starting with the tokens of a cached state,
+                # as a system prompt or the history of a chat, is evaluated
+                # from that state.
+                self.llm._model.set_cache(
+                    LlamaRAMCache(capacity_bytes=llm_settings.prompt_cache_bytes)
+                )
         else:
             self.llm = MockLLM()
 
+        self.generation_executor = ThreadPoolExecutor(
+            max_workers=llm_settings.generation_workers,
+            thread_name_prefix="llm-generation",
+        )
+        self.generation_stats = GenerationStats()
+        self.scheduler = LLMScheduler(llm_settings)
+
+    def astream_chat(
+        self,
+        messages: list[ChatMessage],
+        user: str = "",
+        admission: Admission | None = None,
+    ) -> AsyncGenerator[str, None]:
+        """Stream the deltas of a chat, generated in the generation executor.
+
+        The request should be admitted by the scheduler before, its stream
+        waits for its turn once started. Closing the stream stops the
+        generation after the token being generated, and frees its thread and
+        its slot for the next one, or its place in the queue if not started.
+        """
+        return self._astream(partial(self.llm.stream_chat, messages), user, admission)
+
+    def astream_complete(
+        self,
+        prompt: str,
+        formatted: bool = False,
+        user: str = "",
+        admission: Admission | None = None,
+    ) -> AsyncGenerator[str, None]:
+        """Stream the deltas of a completion, as `astream_chat`."""
+        return self._astream(
+            partial(self.llm.stream_complete, prompt, formatted=formatted),
+            user,
+            admission,
+        )
+
+    async def achat(
+        self,
+        messages: list[ChatMessage],
+        user: str = "",
+        admission: Admission | None = None,
+    ) -> ChatResponse:
+        """Generate a chat response in the generation executor, in turn.
+
+        The request should be admitted by the scheduler before.
+        """
+        return await self._agenerate(partial(self.llm.chat, messages), user, admission)
+
+    async def acomplete(
+        self,
+        prompt: str,
+        formatted: bool = False,
+        user: str = "",
+        admission: Admission | None = None,
+    ) -> CompletionResponse:
+        """Generate a completion, as `achat`."""
+        return await self._agenerate(
+            partial(self.llm.complete, prompt, formatted=formatted), user, admission
+        )
+
+    def _astream(
+        self,
+        start: Callable[[], Iterator[ChatResponse | CompletionResponse]],
+        user: str,
+        admission: Admission | None,
+    ) -> AsyncGenerator[str, None]:
+        stream = self._agenerate_stream(start, user, admission)
+        if admission is None:
+            return stream
+        return _AdmittedStream(stream, admission)
+
+    async def _agenerate_stream(
+        self,
+        start: Callable[[], Iterator[ChatResponse | CompletionResponse]],
+        user: str,
+        admission: Admission | None,
+    ) -> AsyncGenerator[str, None]:
+        tokens = 0
+        acquired = None
+        try:
+            acquired = await self.scheduler.acquire(user, admission)
+            responses = await asyncio.wrap_future(
+                self.generation_executor.submit(start)
+            )
+            # The slot is released by the executor, once the LLM is no longer used
+            release, acquired = self._release_callback(acquired), None
+            async with aclosing(
+                iterate_in_executor(responses, self.generation_executor, release)
+            ) as stream:
+                async for response in stream:
+                    tokens += 1
+                    yield response.delta or ""
+        except (GeneratorExit, asyncio.CancelledError):
+            self.generation_stats.record_abort(tokens, self.llm.metadata.num_output)
+            logger.info("Generation aborted", **self.generation_stats.stats())
+            raise
+        finally:
+            if acquired is not None:
+                self.scheduler.release(acquired)
+
+    async def _agenerate(
+        self, generate: Callable[[], T], user: str, admission: Admission | None
+    ) -> T:
+        acquired = await self.scheduler.acquire(user, admission)
+        try:
+            future = self.generation_executor.submit(generate)
+        except BaseException:
+            self.scheduler.release(acquired)
+            raise
+        release = self._release_callback(acquired)
+        future.add_done_callback(lambda _: release())
+        return await asyncio.wrap_future(future)
+
+    def _release_callback(self, acquired: float) -> Callable[[], None]:
+        """Release a slot of the scheduler from any thread."""
+        loop = asyncio.get_running_loop()
+
+        def release() -> None:
+            loop.call_soon_threadsafe(self.scheduler.release, acquired)
+
+        return release
+
 
 @lru_cache
 def get_llm_component() -> LLMComponent:
@@ -0,0 +1,172 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+
+import structlog.stdlib
+
+from app.config.settings import LLMSettings, get_llm_settings
+
+logger = structlog.stdlib.get_logger(__name__)
+
+# Weight of the last generation in the average duration
+DURATION_SMOOTHING = 0.2
+
+
+class LLMBusyError(Exception):
+    """The LLM queue is full, or its wait is longer than accepted."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"The LLM is busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Admission:
+    """A place in the queue, reserved by `LLMScheduler.admit`.
+
+    The place is taken by `LLMScheduler.acquire`, or given back with `cancel`
+    when the generation is not started.
+    """
+
+    def __init__(self, scheduler: "LLMScheduler") -> None:
+        self._scheduler = scheduler
+        self.reserved = True
+
+    def cancel(self) -> None:
+        """Give the place back, if not taken yet."""
+        if self.reserved:
+            self.reserved = False
+            self._scheduler._reserved -= 1
+
+
+class LLMScheduler:
+    """Schedule the generations sharing the LLM.
+
+    At most `concurrent_generations` generations run at once, the others wait
+    in a queue of at most `max_queue` requests. The queue is FIFO for each
+    user, and the users are served in turn, so a user sending many requests
+    only delays their own.
+
+    A request reserves its place when admitted, so the requests admitted but
+    not started yet count in the queue.
+
+    The scheduler is not thread safe, it must be used from the event loop.
+    """
+
+    def __init__(self, settings: LLMSettings = get_llm_settings()) -> None:
+        self.settings = settings
+        self._running = 0
+        # user -> their waiting requests, the next user to serve first
+        self._waiters: OrderedDict[str, deque[asyncio.Future[None]]] = OrderedDict()
+        self._queued = 0
+        # The places reserved by the admitted requests, not acquired yet
+        self._reserved = 0
+        self._average_duration = 0.0
+        self.last_wait = 0.0
+        self.rejected = 0
+
+    def estimated_wait(self) -> float:
+        """The seconds a new request would wait for a generation slot."""
+        waiting = self._waiting()
+        if waiting < 0:
+            return 0.0
+        turns = waiting // self.settings.concurrent_generations + 1
+        return turns * self._average_duration
+
+    def admit(self) -> Admission:
+        """Reserve a place in the queue for a new request.
+
+        :return: the reservation, to pass to `acquire`, or to cancel if the
+            generation is not started
+        :raises LLMBusyError: if the queue is full or the estimated wait is
+            longer than `max_queue_wait`
+        """
+        estimated_wait = self.estimated_wait()
+        if (
+            self._waiting() >= self.settings.max_queue
+            or estimated_wait > self.settings.max_queue_wait
+        ):
+            self.rejected += 1
+            retry_after = max(math.ceil(estimated_wait or self._average_duration), 1)
+            logger.warning("LLM busy", retry_after=retry_after, **self.stats())
+            raise LLMBusyError(retry_after)
+        self._reserved += 1
+        return Admission(self)
+
+    async def acquire(self, user: str, admission: Admission | None = None) -> float:
+        """Wait for a generation slot, and take it.
+
+        The requests must be admitted before, for the queue to stay bounded,
+        except the ones already admitted elsewhere, as by the workers of the
+        model server.
+
+        :return: when the slot was acquired, to pass to `release`
+        """
+        start = time.monotonic()
+        if admission is not None:
+            # The reserved place is now the one of the running or queued request
+            admission.cancel()
+        if self._running < self.settings.concurrent_generations and not self._queued:
+            self._running += 1
+        else:
+            await self._wait(user)
+        acquired = time.monotonic()
+        self.last_wait = acquired - start
+        logger.debug("LLM slot acquired", **self.stats())
+        return acquired
+
+    def release(self, acquired: float) -> None:
+        """Give back a slot, once its generation is done."""
+        self._average_duration += DURATION_SMOOTHING * (
+            time.monotonic() - acquired - self._average_duration
+        )
+        self._hand_over()
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "running": self._running,
+            "queued": self._queued + self._reserved,
+            "last_wait": round(self.last_wait, 3),
+            "estimated_wait": round(self.estimated_wait(), 3),
+            "rejected": self.rejected,
+        }
+
+    def _waiting(self) -> int:
+        """The requests waiting, or about to, less the free slots."""
+        free = self.settings.concurrent_generations - self._running
+        return self._queued + self._reserved - free
+
+    async def _wait(self, user: str) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user, deque()).append(waiter)
+        self._queued += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just before the cancellation
+                self._hand_over()
+            else:
+                waiters = self._waiters.get(user)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+                    self._queued -= 1
+                    if not waiters:
+                        del self._waiters[user]
+            raise
+
+    def _hand_over(self) -> None:
+        """Hand the slot over to the next user in turn, or free it."""
+        while self._waiters:
+            user, waiters = next(iter(self._waiters.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._waiters.move_to_end(user)
+            else:
+                del self._waiters[user]
+            # Skip the requests cancelled while queued
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._running -= 1
@@ -0,0 +1,613 @@
+import fcntl
+import json
+import os
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any, Literal
+
+import fsspec
+import numpy as np
+import numpy.typing as npt
+import structlog.stdlib
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.types import (
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+
+from app.dependencies.base import ContextFilter
+
+logger = structlog.stdlib.get_logger(__name__)
+
+HEADER_FILE = "header.json"
+EMBEDDINGS_FILE = "embeddings.bin"
+NODES_FILE = "nodes.jsonl"
+ROWS_FILE = "rows.jsonl"
+CENTROIDS_FILE = "centroids.npy"
+LOCK_FILE = "write.lock"
+# Held to read the files, and exclusively to switch to the compacted ones
+FILES_LOCK_FILE = "files.lock"
+
+# The scores are computed on blocks of rows, cast to float32 one at a time
+SCORE_BLOCK_SIZE = 65_536
+# An IVF is only trained once each list would get this many rows
+IVF_MIN_ROWS_PER_LIST = 39
+IVF_SAMPLE_ROWS_PER_LIST = 256
+IVF_ITERATIONS = 10
+
+
+def _normalize(vectors: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def train_ivf(
+    vectors: npt.NDArray[np.float32], count_lists: int, seed: int = 0
+) -> npt.NDArray[np.float32]:
+    """Train the centroids of an IVF with a spherical k-means."""
+    rng = np.random.default_rng(seed)
+    vectors = _normalize(vectors)
+    centroids = vectors[rng.choice(len(vectors), count_lists, replace=False)]
+    for _ in range(IVF_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = ~sums.any(axis=1)
+        # An empty list restarts from a random vector
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids.astype(np.float32)
+
+
+class MmapVectorStore(VectorStore):
+    """Vector store keeping the embeddings in a memory-mapped matrix on disk.
+
+    The embeddings are the rows of a float32 (or float16) matrix, appended to
+    `embeddings.bin`. `rows.jsonl` logs which node each row holds, and the
+    deleted rows; the nodes themselves are in `nodes.jsonl`, read only for
+    the results. Opening the store maps the matrix without reading it.
+
+    Searches are exact, by blocks of matrix products, unless `ivf_lists` is
+    set: the rows are then partitioned around trained centroids, and only the
+    `ivf_probes` lists closest to the queries are scored.
+
+    A single process writes at a time, under a file lock. The other processes
+    pick the new rows up on their next search.
+
+    The deleted rows stay in the files until `persist` compacts them, once
+    they are more than `compact_dead_fraction` of the rows. The compacted
+    files are numbered by the epoch of the header, which is written last, so
+    an interrupted compaction leaves the files in use untouched.
+    """
+
+    stores_text: bool = True
+    stores_node: bool = True
+    flat_metadata: bool = False
+
+    def __init__(
+        self,
+        path: Path,
+        dtype: Literal["float32", "float16"] = "float32",
+        ivf_lists: int = 0,
+        ivf_probes: int = 8,
+        compact_dead_fraction: float = 0.3,
+    ) -> None:
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        self.compact_dead_fraction = compact_dead_fraction
+        self._lock = threading.RLock()
+
+        self._dtype = np.dtype(dtype)
+        self._dim: int | None = None
+        self._epoch = 0
+        self._header_version: tuple[int, int] | None = None
+        self._reset()
+        self._refresh()
+
+    def _reset(self) -> None:
+        """Forget the rows read, to read the files of a new epoch."""
+        self._matrix: npt.NDArray[Any] = np.empty((0, 0), self._dtype)
+        # Tables indexed by row, None for the rows deleted or never logged
+        self._ids: list[str | None] = []
+        self._nodes: list[tuple[int, int] | None] = []
+        self._alive = np.zeros(0, dtype=bool)
+        self._row_by_id: dict[str, int] = {}
+        self._rows_by_doc_id: dict[str, set[int]] = {}
+        self._rows_by_file_name: dict[str, set[int]] = {}
+        self._doc_ids: list[str | None] = []
+        self._file_names: list[str | None] = []
+        self._rows_read = 0
+        # Kept open, so the searches still read it once compacted
+        self._nodes_file: IO[bytes] | None = None
+
+        self._centroids: npt.NDArray[np.float32] | None = None
+        self._centroids_mtime = 0.0
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._trained_count = 0
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def add(self, nodes: list[BaseNode], **add_kwargs: Any) -> list[str]:
+        """Append the embeddings of the nodes, replacing the ones stored before."""
+        if not nodes:
+            return []
+        embeddings = np.asarray([node.get_embedding() for node in nodes], self._dtype)
+        with self._write_lock():
+            if self._dim is None:
+                self._dim = embeddings.shape[1]
+                self._write_header(self._epoch)
+            if embeddings.shape[1] != self._dim:
+                raise ValueError(
+                    f"Expected embeddings of dimension {self._dim}, "
+                    f"got {embeddings.shape[1]}"
+                )
+
+            records: list[dict[str, Any]] = [
+                {"op": "delete", "row": self._row_by_id[node.node_id]}
+                for node in nodes
+                if node.node_id in self._row_by_id
+            ]
+            with open(self._file(NODES_FILE), "ab") as nodes_file:
+                offset = nodes_file.tell()
+                for node in nodes:
+                    line = json.dumps(
+                        node_to_metadata_dict(node, remove_text=False)
+                    ).encode()
+                    nodes_file.write(line + b"\n")
+                    records.append(
+                        {
+                            "op": "add",
+                            "id": node.node_id,
+                            "doc_id": node.ref_doc_id,
+                            "file_name": node.metadata.get("file_name"),
+                            "offset": offset,
+                            "length": len(line),
+                        }
+                    )
+                    offset += len(line) + 1
+            first_row = len(self._ids)
+            with open(self._file(EMBEDDINGS_FILE), "ab") as embeddings_file:
+                # Drop the rows of an interrupted add, which were never logged
+                embeddings_file.truncate(first_row * self._dim * self._dtype.itemsize)
+                embeddings_file.write(embeddings.tobytes())
+            row = first_row
+            for record in records:
+                if record["op"] == "add":
+                    record["row"] = row
+                    row += 1
+            # The rows only exist once logged
+            self._append_records(records)
+            self._refresh()
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Delete the nodes of a document."""
+        with self._write_lock():
+            rows = self._rows_by_doc_id.get(ref_doc_id, set())
+            self._append_records([{"op": "delete", "row": row} for row in rows])
+            self._refresh()
+
+    def delete_nodes(self, node_ids: list[str]) -> None:
+        with self._write_lock():
+            self._append_records(
+                [
+                    {"op": "delete", "row": self._row_by_id[node_id]}
+                    for node_id in node_ids
+                    if node_id in self._row_by_id
+                ]
+            )
+            self._refresh()
+
+    def persist(
+        self, persist_path: str, fs: fsspec.AbstractFileSystem | None = None
+    ) -> None:
+        """Sync the files to disk, then compact them and train the IVF if due.
+
+        The store writes to its own directory, not to `persist_path`.
+        """
+        with self._write_lock():
+            for name in (NODES_FILE, EMBEDDINGS_FILE, ROWS_FILE):
+                if self._file(name).exists():
+                    with open(self._file(name), "rb+") as file:
+                        os.fsync(file.fileno())
+            self._compact()
+            self._train_ivf()
+
+    def query(
+        self,
+        query: VectorStoreQuery,
+        context_filter: ContextFilter | None = None,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        """Search the top k most similar nodes matching the context filter."""
+        return self.query_batch([query], context_filter)[0]
+
+    def query_batch(
+        self,
+        queries: list[VectorStoreQuery],
+        context_filter: ContextFilter | None = None,
+        **kwargs: Any,
+    ) -> list[VectorStoreQueryResult]:
+        """Search several query embeddings at once, with the same matrix products.
+
+        The queries share the filters of the first one.
+        """
+        if not queries:
+            return []
+        query = queries[0]
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"{type(self).__name__} does not support {query.mode}.")
+
+        query_matrix = np.asarray([q.query_embedding for q in queries], np.float32)
+        with self._lock:
+            self._refresh()
+            # The rows of this epoch, in case the files are compacted meanwhile
+            matrix = self._matrix
+            alive = self._alive
+            locations = self._nodes
+            nodes_file = self._nodes_file
+            rows = self._filtered_rows(query, context_filter)
+            if rows is None and self._centroids is not None:
+                rows = self._probed_rows(query_matrix)
+
+        if rows is None:
+            scores = np.empty((len(queries), len(matrix)), np.float32)
+            for start in range(0, len(matrix), SCORE_BLOCK_SIZE):
+                block = matrix[start : start + SCORE_BLOCK_SIZE]
+                scores[:, start : start + len(block)] = query_matrix @ block.T
+            scores[:, ~alive[: len(matrix)]] = -np.inf
+            rows = np.arange(len(matrix))
+        else:
+            scores = query_matrix @ matrix[rows].astype(np.float32).T
+
+        results = []
+        with self._lock:
+            for query, query_scores in zip(queries, scores):
+                top_k = min(query.similarity_top_k, len(rows))
+                if top_k == 0:
+                    results.append(
+                        VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+                    )
+                    continue
+                top = np.argpartition(-query_scores, top_k - 1)[:top_k]
+                top = top[np.argsort(-query_scores[top])]
+                top = top[np.isfinite(query_scores[top])]
+                results.append(
+                    self._to_query_result(
+                        nodes_file, locations, matrix, rows[top], query_scores[top]
+                    )
+                )
+        return results
+
+    def _to_query_result(
+        self,
+        nodes_file: IO[bytes] | None,
+        locations: list[tuple[int, int] | None],
+        matrix: npt.NDArray[Any],
+        rows: npt.NDArray[np.int64],
+        scores: npt.NDArray[np.float32],
+    ) -> VectorStoreQueryResult:
+        nodes = []
+        similarities = []
+        ids = []
+        for row, score in zip(rows, scores):
+            location = locations[row]
+            if nodes_file is None or location is None:
+                # Deleted since it was scored
+                continue
+            offset, length = location
+            nodes_file.seek(offset)
+            node = metadata_dict_to_node(json.loads(nodes_file.read(length)))
+            node.embedding = matrix[row].astype(np.float32).tolist()
+            nodes.append(node)
+            similarities.append(float(score))
+            ids.append(node.node_id)
+        return VectorStoreQueryResult(nodes=nodes, similarities=similarities, ids=ids)
+
+    def _filtered_rows(
+        self, query: VectorStoreQuery, context_filter: ContextFilter | None
+    ) -> npt.NDArray[np.int64] | None:
+        """The rows matching the filters, None when nothing is filtered on."""
+        selections: list[set[int]] = []
+        if context_filter is not None and context_filter.docs_ids is not None:
+            selections.append(
+                self._rows_of(self._rows_by_doc_id, context_filter.docs_ids)
+            )
+        if context_filter is not None and context_filter.file_names is not None:
+            selections.append(
+                self._rows_of(self._rows_by_file_name, context_filter.file_names)
+            )
+        if query.doc_ids:
+            selections.append(self._rows_of(self._rows_by_doc_id, query.doc_ids))
+        if query.node_ids:
+            selections.append(
+                {self._row_by_id[i] for i in query.node_ids if i in self._row_by_id}
+            )
+        if query.filters is not None:
+            for metadata_filter in query.filters.filters:
+                if metadata_filter.key == "doc_id":
+                    index = self._rows_by_doc_id
+                elif metadata_filter.key == "file_name":
+                    index = self._rows_by_file_name
+                else:
+                    raise ValueError(
+                        f"{type(self).__name__} can only filter on doc_id and "
+                        f"file_name, not {metadata_filter.key}"
+                    )
+                selections.append(self._rows_of(index, [str(metadata_filter.value)]))
+        if not selections:
+            return None
+        return np.fromiter(sorted(set.intersection(*selections)), dtype=np.int64)
+
+    @staticmethod
+    def _rows_of(index: dict[str, set[int]], keys: list[str]) -> set[int]:
+        return set().union(*(index.get(key, set()) for key in keys))
+
+    def _probed_rows(self, query_matrix: npt.NDArray[np.float32]) -> npt.NDArray[Any]:
+        """The rows of the IVF lists closest to any of the queries."""
+        assert self._centroids is not None
+        count_probes = min(self.ivf_probes, len(self._centroids))
+        closest = np.argsort(-(query_matrix @ self._centroids.T), axis=1)
+        probes = np.unique(closest[:, :count_probes])
+        count_rows = len(self._assignments)
+        return np.flatnonzero(
+            np.isin(self._assignments, probes) & self._alive[:count_rows]
+        )
+
+    def _train_ivf(self) -> None:
+        alive_rows = np.flatnonzero(self._alive)
+        if self.ivf_lists <= 0 or len(alive_rows) < (
+            IVF_MIN_ROWS_PER_LIST * self.ivf_lists
+        ):
+            return
+        # Trained again once the corpus doubled
+        if self._centroids is not None and len(alive_rows) < 2 * self._trained_count:
+            return
+        rng = np.random.default_rng(0)
+        count_samples = min(len(alive_rows), IVF_SAMPLE_ROWS_PER_LIST * self.ivf_lists)
+        sample = np.sort(rng.choice(alive_rows, count_samples, replace=False))
+        centroids = train_ivf(self._matrix[sample].astype(np.float32), self.ivf_lists)
+        tmp_path = self.path / f"{CENTROIDS_FILE}.tmp"
+        with open(tmp_path, "wb") as tmp_file:
+            np.save(tmp_file, centroids)
+        os.replace(tmp_path, self.path / CENTROIDS_FILE)
+        logger.info(
+            "Trained an IVF of %s lists on %s rows", self.ivf_lists, len(alive_rows)
+        )
+        self._refresh()
+
+    def _compact(self) -> None:
+        """Rewrite the files without the deleted rows, if they are too many.
+
+        The rows are renumbered, so the other processes read the compacted
+        files from scratch once they see the new epoch in the header.
+        """
+        count_rows = len(self._ids)
+        alive_rows = np.flatnonzero(self._alive)
+        if (
+            not count_rows
+            or (count_rows - len(alive_rows)) / count_rows <= self.compact_dead_fraction
+        ):
+            return
+        epoch = self._epoch + 1
+        records: list[dict[str, Any]] = []
+        with open(self._file(NODES_FILE), "rb") as old_nodes_file, open(
+            self._file(NODES_FILE, epoch), "wb"
+        ) as nodes_file:
+            for new_row, row in enumerate(alive_rows):
+                location = self._nodes[row]
+                assert location is not None
+                offset, length = location
+                old_nodes_file.seek(offset)
+                records.append(
+                    {
+                        "op": "add",
+                        "row": new_row,
+                        "id": self._ids[row],
+                        "doc_id": self._doc_ids[row],
+                        "file_name": self._file_names[row],
+                        "offset": nodes_file.tell(),
+                        "length": length,
+                    }
+                )
+                nodes_file.write(old_nodes_file.read(length) + b"\n")
+            os.fsync(nodes_file.fileno())
+        with open(self._file(EMBEDDINGS_FILE, epoch), "wb") as embeddings_file:
+            for start in range(0, len(alive_rows), SCORE_BLOCK_SIZE):
+                block = self._matrix[alive_rows[start : start + SCORE_BLOCK_SIZE]]
+                embeddings_file.write(block.tobytes())
+            os.fsync(embeddings_file.fileno())
+        with open(self._file(ROWS_FILE, epoch), "wb") as rows_file:
+            rows_file.write(
+                b"".join(json.dumps(record).encode() + b"\n" for record in records)
+            )
+            os.fsync(rows_file.fileno())
+
+        with self._files_lock(fcntl.LOCK_EX):
+            self._write_header(epoch)
+            for name in (NODES_FILE, EMBEDDINGS_FILE, ROWS_FILE):
+                self._file(name).unlink(missing_ok=True)
+        logger.info(
+            "Compacted the vector store from %s to %s rows", count_rows, len(records)
+        )
+        self._refresh()
+
+    def _file(self, name: str, epoch: int | None = None) -> Path:
+        """The file of the current, or given, epoch."""
+        epoch = self._epoch if epoch is None else epoch
+        if epoch == 0:
+            return self.path / name
+        stem, suffix = name.split(".", 1)
+        return self.path / f"{stem}.{epoch}.{suffix}"
+
+    def _write_header(self, epoch: int) -> None:
+        tmp_path = self.path / f"{HEADER_FILE}.tmp"
+        tmp_path.write_text(
+            json.dumps({"dim": self._dim, "dtype": self._dtype.name, "epoch": epoch})
+        )
+        os.replace(tmp_path, self.path / HEADER_FILE)
+
+    @contextmanager
+    def _files_lock(self, operation: int) -> Iterator[None]:
+        with open(self.path / FILES_LOCK_FILE, "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        with self._lock, open(self.path / LOCK_FILE, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Start from the rows written by the other processes
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append_records(self, records: list[dict[str, Any]]) -> None:
+        if not records:
+            return
+        with open(self._file(ROWS_FILE), "ab") as rows_file:
+            rows_file.write(
+                b"".join(json.dumps(record).encode() + b"\n" for record in records)
+            )
+
+    def _refresh(self) -> None:
+        """Catch up with the rows logged, and the IVF trained, since last time."""
+        with self._lock, self._files_lock(fcntl.LOCK_SH):
+            self._read_header()
+            self._read_records()
+            self._map_matrix()
+            self._load_centroids()
+
+    def _read_header(self) -> None:
+        header_path = self.path / HEADER_FILE
+        try:
+            stat = header_path.stat()
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns) == self._header_version:
+            return
+        header = json.loads(header_path.read_text())
+        self._header_version = (stat.st_ino, stat.st_mtime_ns)
+        if self._dim is None and header["dtype"] != self._dtype.name:
+            logger.warning(
+                "The vector store at %s holds %s embeddings, not %s",
+                self.path,
+                header["dtype"],
+                self._dtype.name,
+            )
+        self._dim = header["dim"]
+        self._dtype = np.dtype(header["dtype"])
+        epoch = header.get("epoch", 0)
+        if epoch != self._epoch:
+            # The files were compacted, and their rows renumbered
+            self._epoch = epoch
+            self._reset()
+
+    def _read_records(self) -> None:
+        rows_path = self._file(ROWS_FILE)
+        if not rows_path.exists() or rows_path.stat().st_size <= self._rows_read:
+            return
+        with open(rows_path, "rb") as rows_file:
+            rows_file.seek(self._rows_read)
+            data = rows_file.read()
+        # A line still being written is read next time
+        data = data[: data.rfind(b"\n") + 1]
+        self._rows_read += len(data)
+        for line in data.splitlines():
+            record = json.loads(line)
+            if record["op"] == "add":
+                self._add_row(record)
+            else:
+                self._delete_row(record["row"])
+        if self._nodes_file is None:
+            self._nodes_file = open(self._file(NODES_FILE), "rb")
+
+    def _add_row(self, record: dict[str, Any]) -> None:
+        row = record["row"]
+        missing = row + 1 - len(self._ids)
+        if missing > 0:
+            for table in (self._ids, self._nodes, self._doc_ids, self._file_names):
+                table.extend([None] * missing)
+            self._alive = np.concatenate([self._alive, np.zeros(missing, bool)])
+        self._ids[row] = record["id"]
+        self._nodes[row] = (record["offset"], record["length"])
+        self._doc_ids[row] = record["doc_id"]
+        self._file_names[row] = record["file_name"]
+        self._alive[row] = True
+        self._row_by_id[record["id"]] = row
+        if record["doc_id"] is not None:
+            self._rows_by_doc_id.setdefault(record["doc_id"], set()).add(row)
+        if record["file_name"] is not None:
+            self._rows_by_file_name.setdefault(record["file_name"], set()).add(row)
+
+    def _delete_row(self, row: int) -> None:
+        if row >= len(self._ids) or not self._alive[row]:
+            return
+        self._alive[row] = False
+        node_id = self._ids[row]
+        if node_id is not None and self._row_by_id.get(node_id) == row:
+            del self._row_by_id[node_id]
+        for index, key in (
+            (self._rows_by_doc_id, self._doc_ids[row]),
+            (self._rows_by_file_name, self._file_names[row]),
+        ):
+            if key is not None:
+                index[key].discard(row)
+                if not index[key]:
+                    del index[key]
+        self._ids[row] = None
+        self._nodes[row] = None
+
+    def _map_matrix(self) -> None:
+        count_rows = len(self._ids)
+        if self._dim is None or count_rows == len(self._matrix):
+            return
+        self._matrix = np.memmap(
+            self._file(EMBEDDINGS_FILE),
+            dtype=self._dtype,
+            mode="r",
+            shape=(count_rows, self._dim),
+        )
+        if self._centroids is not None:
+            self._assign(len(self._assignments))
+
+    def _load_centroids(self) -> None:
+        centroids_path = self.path / CENTROIDS_FILE
+        if self.ivf_lists <= 0 or not centroids_path.exists():
+            return
+        mtime = centroids_path.stat().st_mtime
+        if mtime == self._centroids_mtime:
+            return
+        self._centroids = np.load(centroids_path)
+        self._centroids_mtime = mtime
+        self._trained_count = int(self._alive.sum())
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._assign(0)
+
+    def _assign(self, first_row: int) -> None:
+        """Assign the rows from `first_row` on to their closest centroid."""
+        assert self._centroids is not None
+        assignments = [self._assignments[:first_row]]
+        for start in range(first_row, len(self._matrix), SCORE_BLOCK_SIZE):
+            block = self._matrix[start : start + SCORE_BLOCK_SIZE].astype(np.float32)
+            assignments.append(
+                np.argmax(block @ self._centroids.T, axis=1).astype(np.int32)
+            )
+        self._assignments = np.concatenate(assignments)
@@ -0,0 +1,260 @@
+import http.client
+import json
+import os
+import socket
+import time
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from typing import Any
+
+import structlog.stdlib
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+from llama_index.llms import (
+    ChatMessage,
+    ChatResponse,
+    CompletionResponse,
+    CustomLLM,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.llms.base import (
+    ChatResponseGen,
+    CompletionResponseGen,
+    llm_chat_callback,
+    llm_completion_callback,
+)
+
+from app.config.settings import ModelServerSettings, get_model_server_settings
+from app.dependencies.components.llm_scheduler import LLMBusyError
+from app.paths import model_server_socket_path
+
+logger = structlog.stdlib.get_logger(__name__)
+
+
+class ModelServerError(RuntimeError):
+    """The model server failed to answer a request."""
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: Path, timeout: float) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(str(self._path))
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class ModelServerClient:
+    """Client of the model server, over its Unix socket.
+
+    Every request opens its own connection, which is cheap on a Unix socket,
+    so the client can be used by several threads.
+    """
+
+    def __init__(
+        self,
+        path: Path = model_server_socket_path,
+        settings: ModelServerSettings = get_model_server_settings(),
+    ) -> None:
+        self.path = path
+        self.settings = settings
+        # Requests are fair between the workers
+        self.client_id = str(os.getpid())
+
+    def post(self, url: str, body: dict[str, Any]) -> Any:
+        return self._read(self._request("POST", url, body))
+
+    def stream(self, url: str, body: dict[str, Any]) -> Iterator[Any]:
+        """Post a request, and yield the lines of its JSON lines response.
+
+        Closing the iterator closes the connection, which stops the
+        generation on the server.
+        """
+        response = self._request("POST", url, body)
+        try:
+            for line in response:
+                yield json.loads(line)
+        finally:
+            response.close()
+
+    def _request(
+        self, method: str, url: str, body: dict[str, Any]
+    ) -> http.client.HTTPResponse:
+        deadline = time.monotonic() + self.settings.startup_timeout
+        while True:
+            connection = _UnixHTTPConnection(self.path, self.settings.timeout)
+            try:
+                connection.request(
+                    method,
+                    url,
+                    body=json.dumps(body),
+                    headers={"Content-Type": "application/json"},
+                )
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The server is still loading the models
+                connection.close()
+                if time.monotonic() > deadline:
+                    raise ModelServerError(
+                        f"The model server does not listen on {self.path}"
+                    )
+                logger.info("Waiting for the model server", path=str(self.path))
+                time.sleep(1)
+
+        response = connection.getresponse()
+        if response.status == 429:
+            response.close()
+            raise LLMBusyError(int(response.getheader("Retry-After", "1")))
+        if response.status != 200:
+            detail = response.read().decode(errors="replace")
+            response.close()
+            raise ModelServerError(f"{method} {url}: {response.status} {detail}")
+        return response
+
+    @staticmethod
+    def _read(response: http.client.HTTPResponse) -> Any:
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+
+
+def _dump_messages(messages: Sequence[ChatMessage]) -> list[dict[str, Any]]:
+    return [message.dict() for message in messages]
+
+
+class RemoteLLM(CustomLLM):
+    """LLM of the model server.
+
+    The chats are sent as messages, so they are formatted into a prompt by
+    the LLM of the server. The metadata, read when the services are created,
+    must be the one of the LLM of the server.
+    """
+
+    _client: ModelServerClient = PrivateAttr()
+    _metadata: LLMMetadata = PrivateAttr()
+
+    def __init__(
+        self, client: ModelServerClient, metadata: LLMMetadata, **kwargs: Any
+    ) -> None:
+        super().__init__(**kwargs)
+        self._client = client
+        self._metadata = metadata
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RemoteLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self._metadata
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        response = self._client.post("/llm/chat", self._chat_body(messages, False))
+        return ChatResponse(
+            message=ChatMessage(role=MessageRole.ASSISTANT, content=response["content"])
+        )
+
+    @llm_chat_callback()
+    def stream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseGen:
+        def gen() -> ChatResponseGen:
+            content = ""
+            for chunk in self._client.stream(
+                "/llm/chat", self._chat_body(messages, True)
+            ):
+                content += chunk["delta"]
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=content),
+                    delta=chunk["delta"],
+                )
+
+        return gen()
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        response = self._client.post(
+            "/llm/complete", self._complete_body(prompt, False, **kwargs)
+        )
+        return CompletionResponse(text=response["text"])
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
+        def gen() -> CompletionResponseGen:
+            text = ""
+            for chunk in self._client.stream(
+                "/llm/complete", self._complete_body(prompt, True, **kwargs)
+            ):
+                text += chunk["delta"]
+                yield CompletionResponse(text=text, delta=chunk["delta"])
+
+        return gen()
+
+    def _chat_body(
+        self, messages: Sequence[ChatMessage], stream: bool
+    ) -> dict[str, Any]:
+        return {
+            "messages": _dump_messages(messages),
+            "stream": stream,
+            "client": self._client.client_id,
+        }
+
+    def _complete_body(
+        self, prompt: str, stream: bool, formatted: bool = False, **kwargs: Any
+    ) -> dict[str, Any]:
+        return {
+            "prompt": prompt,
+            "formatted": formatted,
+            "stream": stream,
+            "client": self._client.client_id,
+        }
+
+
+class RemoteEmbedding(BaseEmbedding):
+    """Embedding model of the model server."""
+
+    _client: ModelServerClient = PrivateAttr()
+
+    def __init__(
+        self, client: ModelServerClient, model_name: str, **kwargs: Any
+    ) -> None:
+        # The server batches the texts itself
+        kwargs.setdefault("embed_batch_size", 256)
+        super().__init__(model_name=model_name, **kwargs)
+        self._client = client
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RemoteEmbedding"
+
+    def get_query_embedding_batch(self, queries: list[str]) -> list[Embedding]:
+        return self._post(queries, query=True)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._post([query], query=True)[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._post([text], query=False)[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: list[str]) -> list[Embedding]:
+        return self._post(texts, query=False)
+
+    def _post(self, texts: list[str], query: bool) -> list[Embedding]:
+        response = self._client.post("/embeddings", {"texts": texts, "query": query})
+        return response["embeddings"]
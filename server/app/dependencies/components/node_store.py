@@ -1,22 +1,31 @@
+import json
 from functools import lru_cache
 
 import structlog.stdlib
+from llama_index.schema import BaseNode
 from llama_index.storage.docstore import (
     BaseDocumentStore,
     RedisDocumentStore,
     SimpleDocumentStore,
 )
+from llama_index.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.storage.docstore.utils import json_to_doc
 from llama_index.storage.index_store import RedisIndexStore, SimpleIndexStore
 from llama_index.storage.index_store.types import BaseIndexStore
+from llama_index.storage.kvstore import RedisKVStore, SimpleKVStore
+from llama_index.storage.kvstore.types import BaseKVStore
 
 from app.config.settings import RedisSettings, get_redis_settings
 
 logger = structlog.stdlib.get_logger(__name__)
 
+GET_BATCH_SIZE = 1000
+
 
 class NodeStoreComponent:
     index_store: BaseIndexStore
     doc_store: BaseDocumentStore
+    kv_store: BaseKVStore
 
     def __init__(self, settings: RedisSettings = get_redis_settings()) -> None:
         try:
@@ -35,6 +44,42 @@ class NodeStoreComponent:
             logger.debug("Local document store not found, creating a new one")
             self.doc_store = SimpleDocumentStore()
 
+        try:
+            self.kv_store = RedisKVStore.from_host_and_port(
+                host=settings.host, port=settings.port
+            )
+        except FileNotFoundError:
+            logger.debug("Local key-value store not found, creating a new one")
+            self.kv_store = SimpleKVStore()
+
+
+def get_nodes(docstore: BaseDocumentStore, node_ids: list[str]) -> dict[str, BaseNode]:
+    """Fetch several nodes at once, by id, leaving out the missing ones.
+
+    From Redis, all the nodes are fetched in a single round trip.
+    """
+    if isinstance(docstore, KVDocumentStore) and isinstance(
+        docstore._kvstore, RedisKVStore
+    ):
+        pipeline = docstore._kvstore._redis_client.pipeline(transaction=False)
+        for start in range(0, len(node_ids), GET_BATCH_SIZE):
+            pipeline.hmget(
+                docstore._node_collection, node_ids[start : start + GET_BATCH_SIZE]
+            )
+        values = [value for batch in pipeline.execute() for value in batch]
+        return {
+            node_id: json_to_doc(json.loads(value))
+            for node_id, value in zip(node_ids, values)
+            if value is not None
+        }
+
+    nodes = {}
+    for node_id in node_ids:
+        node = docstore.get_document(node_id, raise_error=False)
+        if node is not None:
+            nodes[node_id] = node
+    return nodes
+
 
 @lru_cache
 def get_node_store_component() -> NodeStoreComponent:
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import threading
+from array import array
+from functools import lru_cache
+from typing import Any
+
+import structlog.stdlib
+from llama_index.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+from pydantic import BaseModel
+from redis import Redis, RedisError
+
+from app.config.settings import CacheSettings, get_cache_settings, get_redis_settings
+
+logger = structlog.stdlib.get_logger(__name__)
+
+GENERATION_KEY = "retrieval-cache:generation"
+
+
+class RetrievalCache:
+    """Cache of the vector searches, in Redis.
+
+    A search is keyed by its query embedding, its top k and its filters. Every
+    cached result records the generation of the corpus it was computed on: the
+    ingestions and deletions bump the generation, which makes all the cached
+    results stale at once.
+    """
+
+    def __init__(
+        self, redis: Redis, settings: CacheSettings = get_cache_settings()
+    ) -> None:
+        self._redis = redis
+        self.settings = settings
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(query: VectorStoreQuery, **kwargs: Any) -> str:
+        """The key of a search, made with the arguments of `VectorStore.query`."""
+        digest = hashlib.sha256(array("d", query.query_embedding or []).tobytes())
+        options = [
+            query.similarity_top_k,
+            query.doc_ids,
+            query.node_ids,
+            query.filters.json() if query.filters is not None else None,
+            str(query.mode),
+            {
+                name: value.model_dump() if isinstance(value, BaseModel) else value
+                for name, value in sorted(kwargs.items())
+            },
+        ]
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+        return f"retrieval-cache:{digest.hexdigest()}"
+
+    def get(self, key: str) -> tuple[VectorStoreQueryResult | None, int | None]:
+        """Get a cached search, and the current generation of the corpus.
+
+        The generation is None when Redis is not reachable: the result must
+        then not be cached.
+        """
+        try:
+            pipeline = self._redis.pipeline(transaction=False)
+            pipeline.get(GENERATION_KEY)
+            pipeline.get(key)
+            raw_generation, raw_entry = pipeline.execute()
+        except RedisError:
+            logger.warning("Could not read the retrieval cache from Redis")
+            return None, None
+
+        generation = int(raw_generation or 0)
+        result = None
+        if raw_entry is not None:
+            entry = json.loads(raw_entry)
+            if entry["generation"] == generation:
+                result = VectorStoreQueryResult(
+                    nodes=[json_to_doc(node) for node in entry["nodes"]],
+                    similarities=entry["similarities"],
+                    ids=entry["ids"],
+                )
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result, generation
+
+    def put(self, key: str, generation: int, result: VectorStoreQueryResult) -> None:
+        """Cache a search computed on the given generation of the corpus."""
+        if result.nodes is None:
+            return
+        entry = {
+            "generation": generation,
+            "nodes": [doc_to_json(node) for node in result.nodes],
+            "similarities": result.similarities,
+            "ids": result.ids,
+        }
+        try:
+            self._redis.set(key, json.dumps(entry), ex=self.settings.retrieval_ttl)
+        except RedisError:
+            logger.warning("Could not write the retrieval cache to Redis")
+
+    def invalidate(self) -> None:
+        """Make all the cached searches stale, once the corpus changed."""
+        try:
+            self._redis.incr(GENERATION_KEY)
+        except RedisError:
+            # The cached results can not be trusted anymore
+            logger.exception("Could not invalidate the retrieval cache")
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+@lru_cache
+def get_retrieval_cache() -> RetrievalCache | None:
+    settings = get_cache_settings()
+    if not settings.retrieval_enabled:
+        return None
+    return RetrievalCache(Redis.from_url(str(get_redis_settings().dsn)), settings)
@@ -0,0 +1,327 @@
+import json
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+
+import structlog.stdlib
+from llama_index.schema import BaseNode, MetadataMode
+from llama_index.storage.kvstore import RedisKVStore
+from llama_index.storage.kvstore.types import BaseKVStore
+
+from app.config.settings import RetrievalSettings, get_retrieval_settings
+from app.dependencies.base import ContextFilter
+from app.dependencies.components.node_store import get_node_store_component
+
+logger = structlog.stdlib.get_logger(__name__)
+
+# node id -> length, doc id and file name of the node
+NODES_COLLECTION = "bm25/nodes"
+# node id -> terms of the node, to delete its postings
+TERMS_COLLECTION = "bm25/terms"
+# Number of nodes and total length: the "count" and "length" fields of the
+# hash in Redis, the "corpus" key of the collection in the other stores
+STATS_COLLECTION = "bm25/stats"
+# One collection per term: node id -> BM25 weight of the term in the node, a
+# sorted set in Redis
+POSTINGS_COLLECTION = "bm25/postings/{term}"
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Identifiers such as part numbers and error codes are kept whole
+_TOKEN_RE = re.compile(r"\w+(?:[-./:]\w+)*")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have if in into is it its of on "
+    "or that the their there these they this to was were what when where which "
+    "who will with".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Split a text into lowercase terms, without the stopwords.
+
+    A compound identifier, such as `ERR-404`, gives both the whole identifier
+    and its parts, so it is matched whether the query splits it or not.
+    """
+    terms = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token in _STOPWORDS:
+            continue
+        terms.append(token)
+        parts = re.split(r"[-./:]", token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part and part not in _STOPWORDS)
+    return terms
+
+
+@dataclass
+class _NodeInfo:
+    length: int
+    doc_id: str | None
+    file_name: str | None
+
+    def matches(self, context_filter: ContextFilter | None) -> bool:
+        if context_filter is None:
+            return True
+        if context_filter.docs_ids is not None:
+            if self.doc_id not in context_filter.docs_ids:
+                return False
+        if context_filter.file_names is not None:
+            if self.file_name not in context_filter.file_names:
+                return False
+        return True
+
+
+class SparseIndex:
+    """BM25 index of the text of the nodes, stored in a key-value store.
+
+    The index is inverted: each term has its own collection of postings, so
+    a query only reads the postings of its own terms. In Redis, all the reads
+    and writes of an operation are pipelined, and the statistics of the
+    corpus are incremented atomically, as several workers may index nodes at
+    the same time.
+
+    The postings are scored when the nodes are indexed, with the average
+    length of the corpus at that time, and kept sorted in Redis, so a query
+    only reads the `hybrid_postings_per_term` best postings of each term.
+
+    The index is updated by the ingest component, with its index lock held.
+    """
+
+    def __init__(
+        self,
+        kv_store: BaseKVStore,
+        settings: RetrievalSettings = get_retrieval_settings(),
+    ) -> None:
+        self._kv_store = kv_store
+        self.settings = settings
+
+    def add(self, nodes: list[BaseNode]) -> None:
+        """Index the text of the nodes, replacing the nodes indexed before."""
+        if not nodes:
+            return
+        self.delete([node.node_id for node in nodes])
+        node_terms = [
+            Counter(tokenize(node.get_content(metadata_mode=MetadataMode.NONE)))
+            for node in nodes
+        ]
+        self._update_stats(len(nodes), sum(sum(terms.values()) for terms in node_terms))
+        count_nodes, total_length = self._get_stats()
+        average_length = max(total_length / max(count_nodes, 1), 1.0)
+
+        entries = []
+        postings = []
+        for node, terms in zip(nodes, node_terms):
+            length = sum(terms.values())
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            entries.append(
+                (
+                    NODES_COLLECTION,
+                    node.node_id,
+                    {
+                        "length": length,
+                        "doc_id": node.ref_doc_id,
+                        "file_name": node.metadata.get("file_name"),
+                    },
+                )
+            )
+            entries.append((TERMS_COLLECTION, node.node_id, {"terms": list(terms)}))
+            postings.extend(
+                (
+                    POSTINGS_COLLECTION.format(term=term),
+                    node.node_id,
+                    tf * (BM25_K1 + 1) / (tf + norm),
+                )
+                for term, tf in terms.items()
+            )
+        _put_many(self._kv_store, entries)
+        _add_postings(self._kv_store, postings)
+
+    def delete(self, node_ids: list[str]) -> None:
+        """Remove the nodes from the index. Unknown nodes are ignored."""
+        if not node_ids:
+            return
+        infos = _get_many(self._kv_store, NODES_COLLECTION, node_ids)
+        terms = _get_many(self._kv_store, TERMS_COLLECTION, node_ids)
+        entries = []
+        postings = []
+        count_deleted = 0
+        deleted_length = 0
+        for node_id, info, node_terms in zip(node_ids, infos, terms):
+            if info is None:
+                continue
+            count_deleted += 1
+            deleted_length += info["length"]
+            entries.append((NODES_COLLECTION, node_id))
+            entries.append((TERMS_COLLECTION, node_id))
+            for term in (node_terms or {}).get("terms", []):
+                postings.append((POSTINGS_COLLECTION.format(term=term), node_id))
+        _delete_many(self._kv_store, entries)
+        _delete_postings(self._kv_store, postings)
+        if count_deleted:
+            self._update_stats(-count_deleted, -deleted_length)
+
+    def query(
+        self,
+        text: str,
+        top_k: int,
+        context_filter: ContextFilter | None = None,
+    ) -> list[tuple[str, float]]:
+        """The ids of the `top_k` best matching nodes, with their BM25 score.
+
+        With a context filter, the nodes are filtered among the best postings
+        of each term, so a term frequent in the other documents may miss some.
+        """
+        terms = list(dict.fromkeys(tokenize(text)))
+        count_nodes, _ = self._get_stats()
+        if not terms or count_nodes <= 0:
+            return []
+
+        postings = _get_postings(
+            self._kv_store,
+            [POSTINGS_COLLECTION.format(term=term) for term in terms],
+            self.settings.hybrid_postings_per_term,
+        )
+        scores: Counter[str] = Counter()
+        for count_term_nodes, term_postings in postings:
+            idf = math.log(
+                1 + (count_nodes - count_term_nodes + 0.5) / (count_term_nodes + 0.5)
+            )
+            for node_id, weight in term_postings:
+                scores[node_id] += idf * weight
+
+        if context_filter is not None:
+            candidate_ids = list(scores)
+            for node_id, info in zip(
+                candidate_ids,
+                _get_many(self._kv_store, NODES_COLLECTION, candidate_ids),
+            ):
+                if info is None or not _NodeInfo(**info).matches(context_filter):
+                    del scores[node_id]
+        return scores.most_common(top_k)
+
+    def count_nodes(self) -> int:
+        return self._get_stats()[0]
+
+    def _get_stats(self) -> tuple[int, int]:
+        """The number of nodes of the corpus, and their total length."""
+        if isinstance(self._kv_store, RedisKVStore):
+            values = self._kv_store._redis_client.hmget(
+                STATS_COLLECTION, ["count", "length"]
+            )
+            count, length = (int(value or 0) for value in values)
+            return count, length
+        stats = self._kv_store.get("corpus", collection=STATS_COLLECTION) or {}
+        return stats.get("count", 0), stats.get("length", 0)
+
+    def _update_stats(self, count_nodes: int, length: int) -> None:
+        if isinstance(self._kv_store, RedisKVStore):
+            # Incremented in Redis, a read-modify-write would lose the updates
+            # made by the other workers in between
+            pipeline = self._kv_store._redis_client.pipeline(transaction=True)
+            pipeline.hincrby(STATS_COLLECTION, "count", count_nodes)
+            pipeline.hincrby(STATS_COLLECTION, "length", length)
+            pipeline.execute()
+            return
+        count, total_length = self._get_stats()
+        self._kv_store.put(
+            "corpus",
+            {
+                "count": max(count + count_nodes, 0),
+                "length": max(total_length + length, 0),
+            },
+            collection=STATS_COLLECTION,
+        )
+
+
+def _put_many(kv_store: BaseKVStore, entries: list[tuple[str, str, dict]]) -> None:
+    if isinstance(kv_store, RedisKVStore):
+        # Same encoding as RedisKVStore.put, in a single round trip
+        pipeline = kv_store._redis_client.pipeline(transaction=False)
+        for collection, key, val in entries:
+            pipeline.hset(collection, key, json.dumps(val))
+        pipeline.execute()
+        return
+    for collection, key, val in entries:
+        kv_store.put(key, val, collection=collection)
+
+
+def _get_many(
+    kv_store: BaseKVStore, collection: str, keys: list[str]
+) -> list[dict | None]:
+    if not keys:
+        return []
+    if isinstance(kv_store, RedisKVStore):
+        values = kv_store._redis_client.hmget(collection, keys)
+        return [json.loads(value) if value is not None else None for value in values]
+    return [kv_store.get(key, collection=collection) for key in keys]
+
+
+def _add_postings(
+    kv_store: BaseKVStore, postings: list[tuple[str, str, float]]
+) -> None:
+    if isinstance(kv_store, RedisKVStore):
+        pipeline = kv_store._redis_client.pipeline(transaction=False)
+        for collection, node_id, weight in postings:
+            pipeline.zadd(collection, {node_id: weight})
+        pipeline.execute()
+        return
+    for collection, node_id, weight in postings:
+        kv_store.put(node_id, {"weight": weight}, collection=collection)
+
+
+def _get_postings(
+    kv_store: BaseKVStore, collections: list[str], limit: int
+) -> list[tuple[int, list[tuple[str, float]]]]:
+    """The number of postings of each collection, and its `limit` best ones."""
+    if isinstance(kv_store, RedisKVStore):
+        pipeline = kv_store._redis_client.pipeline(transaction=False)
+        for collection in collections:
+            pipeline.zcard(collection)
+            pipeline.zrevrange(collection, 0, limit - 1, withscores=True)
+        results = pipeline.execute()
+        return [
+            (count, [(node_id.decode(), weight) for node_id, weight in postings])
+            for count, postings in zip(results[::2], results[1::2])
+        ]
+    postings = []
+    for collection in collections:
+        values = kv_store.get_all(collection=collection)
+        best = sorted(
+            ((node_id, value["weight"]) for node_id, value in values.items()),
+            key=lambda posting: posting[1],
+            reverse=True,
+        )
+        postings.append((len(values), best[:limit]))
+    return postings
+
+
+def _delete_postings(kv_store: BaseKVStore, postings: list[tuple[str, str]]) -> None:
+    if isinstance(kv_store, RedisKVStore):
+        pipeline = kv_store._redis_client.pipeline(transaction=False)
+        for collection, node_id in postings:
+            pipeline.zrem(collection, node_id)
+        pipeline.execute()
+        return
+    for collection, node_id in postings:
+        kv_store.delete(node_id, collection=collection)
+
+
+def _delete_many(kv_store: BaseKVStore, entries: list[tuple[str, str]]) -> None:
+    if isinstance(kv_store, RedisKVStore):
+        pipeline = kv_store._redis_client.pipeline(transaction=False)
+        for collection, key in entries:
+            pipeline.hdel(collection, key)
+        pipeline.execute()
+        return
+    for collection, key in entries:
+        kv_store.delete(key, collection=collection)
+
+
+@lru_cache
+def get_sparse_index() -> SparseIndex | None:
+    if not get_retrieval_settings().hybrid:
+        return None
+    return SparseIndex(get_node_store_component().kv_store)
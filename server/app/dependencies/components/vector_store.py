@@ -1,19 +1,516 @@
+import asyncio
+import json
 import typing
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
 from functools import lru_cache
+from typing import Any, Iterator
 
 import structlog.stdlib
 from fastapi import Depends
 from llama_index import VectorStoreIndex
 from llama_index.indices.vector_store import VectorIndexRetriever
-from llama_index.vector_stores.milvus import MilvusVectorStore
-from llama_index.vector_stores.types import VectorStore
+from llama_index.schema import BaseNode, NodeWithScore, QueryBundle, TextNode
+from llama_index.storage.docstore import BaseDocumentStore
+from llama_index.vector_stores.milvus import MILVUS_ID_FIELD, MilvusVectorStore
+from llama_index.vector_stores.types import (
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
 from pydantic import BaseModel
+from pymilvus import DataType, MilvusClient
 
-from app.config.settings import MilvusSettings, get_milvus_settings
+from app.config.settings import (
+    MilvusSettings,
+    RetrievalSettings,
+    VectorStoreSettings,
+    get_milvus_settings,
+    get_retrieval_settings,
+    get_vector_store_settings,
+)
 from app.dependencies.base import ContextFilter
+from app.dependencies.components.embedding_cache import CachedQueryEmbedding
+from app.dependencies.components.mmap_vector_store import MmapVectorStore
+from app.dependencies.components.node_store import get_nodes
+from app.dependencies.components.retrieval_cache import RetrievalCache
+from app.dependencies.components.sparse_index import SparseIndex
+from app.paths import vectors_path
 
 logger = structlog.stdlib.get_logger(__name__)
 
+# Metadata stored in their own scalar fields, indexed, so they can be filtered on
+FILE_NAME_FIELD = "file_name"
+SCALAR_FIELD_MAX_LENGTH = 65_535
+SCALAR_INDEX_TYPE = "Trie"
+
+
+@dataclass(frozen=True)
+class RetrievalOptions:
+    context_filter: ContextFilter | None = None
+    similarity_top_k: int | None = None
+    consistency_level: str | None = None
+
+
+_retrieval_options: ContextVar[RetrievalOptions] = ContextVar(
+    "retrieval_options", default=RetrievalOptions()
+)
+
+
+@contextmanager
+def retrieval_options(
+    context_filter: ContextFilter | None = None,
+    similarity_top_k: int | None = None,
+    consistency_level: str | None = None,
+) -> Iterator[None]:
+    """Set the filter, top k and consistency of the retrievals of the request.
+
+    The consistency level defaults to the one of the collection.
+    """
+    token = _retrieval_options.set(
+        RetrievalOptions(context_filter, similarity_top_k, consistency_level)
+    )
+    try:
+        yield
+    finally:
+        _retrieval_options.reset(token)
+
+
+def _in_expr(field: str, values: list[str]) -> str:
+    # JSON string literals are valid Milvus string literals, quotes escaped
+    literals = ", ".join(json.dumps(value, ensure_ascii=False) for value in values)
+    return f"{field} in [{literals}]"
+
+
+def context_filter_expr(
+    context_filter: ContextFilter | None, doc_id_field: str = "doc_id"
+) -> str | None:
+    """Translate a context filter into a Milvus boolean expression.
+
+    Returns None when nothing is filtered on.
+    """
+    if context_filter is None:
+        return None
+    expr = []
+    if context_filter.docs_ids is not None:
+        expr.append(_in_expr(doc_id_field, context_filter.docs_ids))
+    if context_filter.file_names is not None:
+        expr.append(_in_expr(FILE_NAME_FIELD, context_filter.file_names))
+    return " and ".join(expr) or None
+
+
+class FilteredMilvusVectorStore(MilvusVectorStore):
+    """Milvus vector store filtering the search on indexed scalar fields.
+
+    The collections created by llama_index only declare the id and the
+    embedding: all the metadata end up in the dynamic field, which can be
+    filtered on but not indexed. This store creates its collection with the
+    doc id and the file name as VARCHAR fields, each with a scalar index, so
+    Milvus filters on them inside the vector search.
+
+    Collections created before keep working: the same expressions are then
+    evaluated on the dynamic field.
+    """
+
+    def __init__(
+        self,
+        uri: str = "http://localhost:19530",
+        token: str = "",
+        collection_name: str = "llamalection",
+        dim: int | None = None,
+        overwrite: bool = False,
+        index_type: str = "AUTOINDEX",
+        index_params: dict[str, Any] | None = None,
+        search_params: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        self.search_params = search_params or {}
+        client = MilvusClient(uri=uri, token=token)
+        try:
+            if overwrite and collection_name in client.list_collections():
+                client.drop_collection(collection_name)
+            if collection_name not in client.list_collections():
+                if dim is None:
+                    raise ValueError("Dim argument required for collection creation.")
+                self._create_collection(
+                    client,
+                    collection_name,
+                    dim,
+                    index_type=index_type,
+                    index_params=index_params,
+                    **kwargs,
+                )
+        finally:
+            client.close()
+
+        super().__init__(
+            uri=uri,
+            token=token,
+            collection_name=collection_name,
+            dim=dim,
+            overwrite=False,
+            **kwargs,
+        )
+        fields = self.milvusclient.describe_collection(collection_name)["fields"]
+        self.scalar_fields = {
+            field["name"]
+            for field in fields
+            if field["name"] in (self.doc_id_field, FILE_NAME_FIELD)
+        }
+        if not self.scalar_fields:
+            logger.warning(
+                "The collection %s has no indexed scalar fields, "
+                "filters are evaluated on its dynamic field",
+                collection_name,
+            )
+
+    def _create_collection(
+        self,
+        client: MilvusClient,
+        collection_name: str,
+        dim: int,
+        embedding_field: str = "embedding",
+        doc_id_field: str = "doc_id",
+        similarity_metric: str = "IP",
+        consistency_level: str = "Strong",
+        index_type: str = "AUTOINDEX",
+        index_params: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        schema = MilvusClient.create_schema(enable_dynamic_field=True)
+        schema.add_field(
+            MILVUS_ID_FIELD,
+            DataType.VARCHAR,
+            is_primary=True,
+            max_length=SCALAR_FIELD_MAX_LENGTH,
+        )
+        schema.add_field(embedding_field, DataType.FLOAT_VECTOR, dim=dim)
+        for field in (doc_id_field, FILE_NAME_FIELD):
+            schema.add_field(
+                field, DataType.VARCHAR, max_length=SCALAR_FIELD_MAX_LENGTH
+            )
+        schema.verify()
+
+        conn = client._get_connection()
+        conn.create_collection(
+            collection_name, schema, consistency_level=consistency_level
+        )
+        metric_type = "L2" if similarity_metric.lower() in ("l2", "euclidean") else "IP"
+        conn.create_index(
+            collection_name,
+            embedding_field,
+            {
+                "metric_type": metric_type,
+                "index_type": index_type,
+                "params": index_params or {},
+            },
+        )
+        for field in (doc_id_field, FILE_NAME_FIELD):
+            conn.create_index(
+                collection_name,
+                field,
+                {"index_type": SCALAR_INDEX_TYPE},
+                index_name=f"{field}_index",
+            )
+        client._load(collection_name)
+        logger.info(
+            "Created the collection %s with a %s index", collection_name, index_type
+        )
+
+    def add(self, nodes: list[BaseNode], **add_kwargs: Any) -> list[str]:
+        insert_list = []
+        for node in nodes:
+            entry = node_to_metadata_dict(node)
+            entry[MILVUS_ID_FIELD] = node.node_id
+            entry[self.embedding_field] = node.embedding
+            # The scalar fields are not nullable
+            for field in self.scalar_fields:
+                entry[field] = str(entry.get(field) or "")
+            insert_list.append(entry)
+
+        self.milvusclient.insert(self.collection_name, insert_list)
+        return [node.node_id for node in nodes]
+
+    def query(
+        self,
+        query: VectorStoreQuery,
+        context_filter: ContextFilter | None = None,
+        consistency_level: str | None = None,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        """Search the top k most similar nodes matching the context filter."""
+        return self.query_batch([query], context_filter, consistency_level)[0]
+
+    def query_batch(
+        self,
+        queries: list[VectorStoreQuery],
+        context_filter: ContextFilter | None = None,
+        consistency_level: str | None = None,
+        **kwargs: Any,
+    ) -> list[VectorStoreQueryResult]:
+        """Search several query embeddings at once, with a single Milvus search.
+
+        The queries share the filters and output fields of the first one, only
+        their embedding and their top k differ. The consistency level defaults
+        to the one of the collection.
+        """
+        if not queries:
+            return []
+        query = queries[0]
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Milvus does not support {query.mode} yet.")
+        if context_filter is not None and (
+            context_filter.docs_ids == [] or context_filter.file_names == []
+        ):
+            # Filtering on no document at all
+            return [
+                VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+                for _ in queries
+            ]
+
+        expr = []
+        filter_expr = context_filter_expr(context_filter, self.doc_id_field)
+        if filter_expr is not None:
+            expr.append(filter_expr)
+        if query.doc_ids:
+            expr.append(_in_expr(self.doc_id_field, query.doc_ids))
+        if query.node_ids:
+            expr.append(_in_expr(MILVUS_ID_FIELD, query.node_ids))
+        if query.filters is not None:
+            for metadata_filter in query.filters.filters:
+                value = json.dumps(metadata_filter.value, ensure_ascii=False)
+                expr.append(f"{metadata_filter.key} == {value}")
+
+        search_kwargs = {}
+        if consistency_level is not None:
+            search_kwargs["consistency_level"] = consistency_level
+        res = self.milvusclient.search(
+            collection_name=self.collection_name,
+            data=[query.query_embedding for query in queries],
+            filter=" and ".join(expr),
+            limit=max(query.similarity_top_k for query in queries),
+            search_params={"params": self.search_params},
+            # The embeddings are returned with the nodes, for the diversity
+            output_fields=[*(query.output_fields or ["*"]), self.embedding_field],
+            **search_kwargs,
+        )
+        return [
+            self._to_query_result(hits[: query.similarity_top_k])
+            for query, hits in zip(queries, res)
+        ]
+
+    def _to_query_result(self, hits: list[dict[str, Any]]) -> VectorStoreQueryResult:
+        nodes = []
+        similarities = []
+        ids = []
+        for hit in hits:
+            if self.text_key:
+                node = TextNode(text=hit["entity"].get(self.text_key))
+            else:
+                node = metadata_dict_to_node(
+                    {"_node_content": hit["entity"].get("_node_content")}
+                )
+            node.embedding = hit["entity"].get(self.embedding_field)
+            nodes.append(node)
+            similarities.append(hit["distance"])
+            ids.append(hit["id"])
+        return VectorStoreQueryResult(nodes=nodes, similarities=similarities, ids=ids)
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[NodeWithScore]], k: int = 60
+) -> list[NodeWithScore]:
+    """Fuse rankings of nodes, scoring each node `sum(1 / (k + rank))`."""
+    scores: dict[str, float] = {}
+    nodes: dict[str, NodeWithScore] = {}
+    for ranking in rankings:
+        for rank, node in enumerate(ranking, start=1):
+            scores[node.node_id] = scores.get(node.node_id, 0.0) + 1 / (k + rank)
+            nodes.setdefault(node.node_id, node)
+    return [
+        NodeWithScore(node=nodes[node_id].node, score=score)
+        for node_id, score in sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    ]
+
+
+class SharedVectorIndexRetriever(VectorIndexRetriever):
+    """Vector index retriever shared between the requests.
+
+    The top k and the context filter set with `retrieval_options` by the
+    current request take precedence over the ones it was created with, so a
+    single retriever, and a single index, serve all the requests.
+
+    With a retrieval cache, a search made again on an unchanged corpus, by
+    `retrieve` or `aretrieve`, is answered from the cache, without querying
+    the vector store. Only the
+    results of the searches made at Strong consistency are cached, as a
+    weaker search may miss the last changes of the corpus.
+
+    With a sparse index, the best `hybrid_candidates` results of the vector
+    search and of the BM25 index are fused with reciprocal rank fusion, and
+    the top k of the fused ranking is returned.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        retrieval_cache: RetrievalCache | None = None,
+        sparse_index: SparseIndex | None = None,
+        docstore: BaseDocumentStore | None = None,
+        settings: RetrievalSettings = get_retrieval_settings(),
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._retrieval_cache = retrieval_cache
+        self._sparse_index = sparse_index
+        # The nodes found by the sparse index are read from there
+        self._nodes_docstore = docstore or self._docstore
+        self.settings = settings
+
+    def _build_vector_store_query(self, query_bundle: QueryBundle) -> VectorStoreQuery:
+        query = super()._build_vector_store_query(query_bundle)
+        options = _retrieval_options.get()
+        if options.similarity_top_k is not None:
+            query.similarity_top_k = options.similarity_top_k
+        return query
+
+    def _vector_store_kwargs(self) -> dict[str, Any]:
+        options = _retrieval_options.get()
+        kwargs = dict(self._kwargs)
+        if options.context_filter is not None:
+            kwargs["context_filter"] = options.context_filter
+        if options.consistency_level is not None:
+            kwargs["consistency_level"] = options.consistency_level
+        return kwargs
+
+    def _dense_query_batch(
+        self, queries: list[VectorStoreQuery], vector_store_kwargs: dict[str, Any]
+    ) -> list[VectorStoreQueryResult]:
+        results: list[VectorStoreQueryResult | None] = [None] * len(queries)
+        keys: list[str] = []
+        generation = None
+        consistency_level = vector_store_kwargs.get("consistency_level") or getattr(
+            self._vector_store, "consistency_level", "Strong"
+        )
+        if self._retrieval_cache is not None:
+            # The cached results are all Strong ones, whatever the search asks
+            key_kwargs = {
+                name: value
+                for name, value in vector_store_kwargs.items()
+                if name != "consistency_level"
+            }
+            for i, query in enumerate(queries):
+                keys.append(self._retrieval_cache.key(query, **key_kwargs))
+                results[i], generation = self._retrieval_cache.get(keys[i])
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            missing_queries = [queries[i] for i in missing]
+            if isinstance(
+                self._vector_store, (FilteredMilvusVectorStore, MmapVectorStore)
+            ):
+                computed = self._vector_store.query_batch(
+                    missing_queries, **vector_store_kwargs
+                )
+            else:
+                computed = [
+                    self._vector_store.query(query, **vector_store_kwargs)
+                    for query in missing_queries
+                ]
+            for i, result in zip(missing, computed):
+                results[i] = result
+                if (
+                    self._retrieval_cache is not None
+                    and generation is not None
+                    and consistency_level == "Strong"
+                ):
+                    self._retrieval_cache.put(keys[i], generation, result)
+        return typing.cast(list[VectorStoreQueryResult], results)
+
+    def _sparse_query(
+        self, query_str: str, top_k: int, context_filter: ContextFilter | None
+    ) -> list[NodeWithScore]:
+        assert self._sparse_index is not None
+        scores = self._sparse_index.query(query_str, top_k, context_filter)
+        nodes = get_nodes(self._nodes_docstore, [node_id for node_id, _ in scores])
+        return [
+            NodeWithScore(node=nodes[node_id], score=score)
+            for node_id, score in scores
+            if node_id in nodes
+        ]
+
+    def retrieve_batch(self, query_strs: list[str]) -> list[list[NodeWithScore]]:
+        """Retrieve the nodes of several queries, embedded and searched together."""
+        embed_model = self._service_context.embed_model
+        if isinstance(embed_model, CachedQueryEmbedding):
+            embeddings = embed_model.get_query_embedding_batch(query_strs)
+        else:
+            embeddings = [embed_model.get_query_embedding(q) for q in query_strs]
+        return self._get_nodes_with_embeddings_batch(
+            [
+                QueryBundle(query_str=query_str, embedding=embedding)
+                for query_str, embedding in zip(query_strs, embeddings)
+            ]
+        )
+
+    def _get_nodes_with_embeddings(
+        self, query_bundle: QueryBundle
+    ) -> list[NodeWithScore]:
+        return self._get_nodes_with_embeddings_batch([query_bundle])[0]
+
+    def _get_nodes_with_embeddings_batch(
+        self, query_bundles: list[QueryBundle]
+    ) -> list[list[NodeWithScore]]:
+        queries = [self._build_vector_store_query(bundle) for bundle in query_bundles]
+        vector_store_kwargs = self._vector_store_kwargs()
+        if self._sparse_index is None:
+            return [
+                self._build_node_list_from_query_result(query_result)
+                for query_result in self._dense_query_batch(
+                    queries, vector_store_kwargs
+                )
+            ]
+
+        top_ks = [query.similarity_top_k for query in queries]
+        for query in queries:
+            query.similarity_top_k = max(
+                query.similarity_top_k, self.settings.hybrid_candidates
+            )
+        dense_results = self._dense_query_batch(queries, vector_store_kwargs)
+        nodes = []
+        for bundle, query, top_k, dense_result in zip(
+            query_bundles, queries, top_ks, dense_results
+        ):
+            dense_nodes = self._build_node_list_from_query_result(dense_result)
+            sparse_nodes = self._sparse_query(
+                bundle.query_str,
+                query.similarity_top_k,
+                vector_store_kwargs.get("context_filter"),
+            )
+            fused_nodes = reciprocal_rank_fusion(
+                [dense_nodes, sparse_nodes], self.settings.rrf_k
+            )
+            nodes.append(fused_nodes[:top_k])
+        return nodes
+
+    async def _aget_nodes_with_embeddings(
+        self, query_bundle: QueryBundle
+    ) -> list[NodeWithScore]:
+        # The same search as the sync path, with the hybrid fusion, out of the
+        # event loop. The thread runs in a copy of the request's context, so
+        # it sees its retrieval options.
+        return (
+            await asyncio.to_thread(
+                self._get_nodes_with_embeddings_batch, [query_bundle]
+            )
+        )[0]
+
 
 class VectorStoreComponent:
     vector_store: VectorStore
@@ -21,24 +518,41 @@ class VectorStoreComponent:
     def __init__(
         self,
         milvus_settings: MilvusSettings = get_milvus_settings(),
+        settings: VectorStoreSettings = get_vector_store_settings(),
     ) -> None:
-        self.vector_store = typing.cast(
-            VectorStore,
-            MilvusVectorStore(
-                uri=str(milvus_settings.uri),
-                **milvus_settings.model_dump(exclude_none=True, exclude={"uri"}),
-            ),
-        )
+        if settings.mode == "mmap":
+            self.vector_store = MmapVectorStore(
+                vectors_path,
+                dtype=settings.dtype,
+                ivf_lists=settings.ivf_lists,
+                ivf_probes=settings.ivf_probes,
+                compact_dead_fraction=settings.compact_dead_fraction,
+            )
+        else:
+            self.vector_store = typing.cast(
+                VectorStore,
+                FilteredMilvusVectorStore(
+                    uri=str(milvus_settings.uri),
+                    **milvus_settings.model_dump(exclude_none=True, exclude={"uri"}),
+                ),
+            )
 
     @staticmethod
     def get_retriever(
         index: VectorStoreIndex,
         context_filter: ContextFilter | None = None,
         similarity_top_k: int = 2,
-    ) -> VectorIndexRetriever:
-        return VectorIndexRetriever(
+        retrieval_cache: RetrievalCache | None = None,
+        sparse_index: SparseIndex | None = None,
+        docstore: BaseDocumentStore | None = None,
+    ) -> SharedVectorIndexRetriever:
+        return SharedVectorIndexRetriever(
             index=index,
             similarity_top_k=similarity_top_k,
+            vector_store_kwargs={"context_filter": context_filter},
+            retrieval_cache=retrieval_cache,
+            sparse_index=sparse_index,
+            docstore=docstore,
         )
 
 
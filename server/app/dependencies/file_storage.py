@@ -47,6 +47,14 @@ class S3Client:
     def bucket(self) -> Bucket:
         return self.client.Bucket(s3_settings.bucket)
 
+    def list_keys(self, prefix: str = "") -> list[str]:
+        """List the keys of the objects of the bucket, leaving out folders."""
+        return [
+            object_summary.key
+            for object_summary in self.bucket.objects.filter(Prefix=prefix)
+            if not object_summary.key.endswith("/")
+        ]
+
     def download(self, file_name: str) -> Iterator[bytes]:
         file = io.BytesIO()
         self.bucket.download_fileobj(file_name, file)
@@ -1,6 +1,7 @@
 import time
 import uuid
-from collections.abc import Iterator
+from collections.abc import AsyncGenerator, Iterator
+from contextlib import aclosing
 from typing import Literal
 
 from llama_index.llms import ChatResponse, CompletionResponse
@@ -120,3 +121,15 @@ def to_openai_sse_stream(
             yield f"data: {OpenAICompletion.json_from_delta(text=response, sources=sources)}\n\n"
     yield f"data: {OpenAICompletion.json_from_delta(text=None, finish_reason='stop')}\n\n"
     yield "data: [DONE]\n\n"
+
+
+async def to_openai_sse_astream(
+    response_generator: AsyncGenerator[str, None],
+    sources: list[Chunk] | None = None,
+) -> AsyncGenerator[str, None]:
+    # Closing the stream, as on a disconnect, closes the generation
+    async with aclosing(response_generator):
+        async for response in response_generator:
+            yield f"data: {OpenAICompletion.json_from_delta(text=response, sources=sources)}\n\n"
+    yield f"data: {OpenAICompletion.json_from_delta(text=None, finish_reason='stop')}\n\n"
+    yield "data: [DONE]\n\n"
@@ -1,15 +1,19 @@
+import asyncio
+from collections.abc import AsyncGenerator
 from dataclasses import dataclass
 from functools import lru_cache
 
 import structlog.stdlib
 from llama_index import ServiceContext, StorageContext, VectorStoreIndex
-from llama_index.chat_engine import ContextChatEngine, SimpleChatEngine
-from llama_index.chat_engine.types import BaseChatEngine
+from llama_index.chat_engine.context import DEFAULT_CONTEXT_TEMPLATE
 from llama_index.indices.postprocessor import MetadataReplacementPostProcessor
 from llama_index.llms import ChatMessage, MessageRole
-from llama_index.types import TokenGen
+from llama_index.memory import ChatMemoryBuffer
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle
 from pydantic import BaseModel
 
+from app.config.settings import RetrievalSettings, get_retrieval_settings
 from app.dependencies.base import ContextFilter
 from app.dependencies.components import (
     EmbeddingComponent,
@@ -21,6 +25,13 @@ from app.dependencies.components import (
     get_node_store_component,
     get_vector_store_component,
 )
+from app.dependencies.components.diversity import DiversityPostProcessor
+from app.dependencies.components.retrieval_cache import (
+    RetrievalCache,
+    get_retrieval_cache,
+)
+from app.dependencies.components.sparse_index import SparseIndex, get_sparse_index
+from app.dependencies.components.vector_store import retrieval_options
 from app.dependencies.services.chunks import Chunk
 
 logger = structlog.stdlib.get_logger(__name__)
@@ -31,10 +42,12 @@ class Completion(BaseModel):
     sources: list[Chunk] | None = None
 
 
-class CompletionGen(BaseModel):
-    response: TokenGen
+class AsyncCompletionGen(BaseModel):
+    response: AsyncGenerator[str, None]
     sources: list[Chunk] | None = None
 
+    model_config = {"arbitrary_types_allowed": True}
+
 
 @dataclass
 class ChatEngineInput:
@@ -77,8 +90,12 @@ class ChatService:
         vector_store_component: VectorStoreComponent = get_vector_store_component(),
         embedding_component: EmbeddingComponent = get_embeddings_component(),
         node_store_component: NodeStoreComponent = get_node_store_component(),
+        retrieval_cache: RetrievalCache | None = get_retrieval_cache(),
+        sparse_index: SparseIndex | None = get_sparse_index(),
+        retrieval_settings: RetrievalSettings = get_retrieval_settings(),
     ) -> None:
         self.llm_service = llm_component
+        self.retrieval_settings = retrieval_settings
         self.vector_store_component = vector_store_component
         self.storage_context = StorageContext.from_defaults(
             vector_store=vector_store_component.vector_store,
@@ -86,7 +103,7 @@ class ChatService:
             index_store=node_store_component.index_store,
         )
         self.service_context = ServiceContext.from_defaults(
-            llm=llm_component.llm, embed_model=embedding_component.embedding_model
+            llm=llm_component.llm, embed_model=embedding_component.query_embedding_model
         )
         self.index = VectorStoreIndex.from_vector_store(
             vector_store=vector_store_component.vector_store,
@@ -94,37 +111,82 @@ class ChatService:
             service_context=self.service_context,
             show_progress=True,
         )
+        # Shared by all the requests, which set their own context filter
+        self.retriever = vector_store_component.get_retriever(
+            index=self.index,
+            retrieval_cache=retrieval_cache,
+            sparse_index=sparse_index,
+            docstore=node_store_component.doc_store,
+        )
+        self.context_template = DEFAULT_CONTEXT_TEMPLATE
+        # The diversity runs on the embedded sentences, before they are
+        # replaced by their windows
+        self.node_postprocessors: list[BaseNodePostprocessor] = [
+            MetadataReplacementPostProcessor(target_metadata_key="window"),
+        ]
+        if retrieval_settings.diversity:
+            self.node_postprocessors.insert(
+                0,
+                DiversityPostProcessor(
+                    embedding_component.query_embedding_model, retrieval_settings
+                ),
+            )
 
-    def _chat_engine(
+    def _llm_messages(
         self,
-        system_prompt: str | None = None,
-        use_context: bool = False,
-        context_filter: ContextFilter | None = None,
-    ) -> BaseChatEngine:
+        message: str,
+        system_prompt: str | None,
+        chat_history: list[ChatMessage] | None,
+        use_context: bool,
+    ) -> tuple[list[ChatMessage], list[NodeWithScore]]:
+        """The messages to send to the LLM, and the context nodes.
+
+        Built as the chat engines of llama_index build them, retrieval
+        included, but without starting the generation: the context, if any,
+        goes first in the system message, and the chat history is truncated
+        to fit in the context window of the LLM.
+        """
+        memory = ChatMemoryBuffer.from_defaults(
+            chat_history=chat_history, llm=self.llm_service.llm
+        )
+        memory.put(ChatMessage(content=message, role=MessageRole.USER))
+        nodes: list[NodeWithScore] = []
+        prefix_messages: list[ChatMessage] = []
         if use_context:
-            vector_index_retriever = self.vector_store_component.get_retriever(
-                index=self.index, context_filter=context_filter
+            nodes = self.retriever.retrieve(message)
+            for postprocessor in self.node_postprocessors:
+                nodes = postprocessor.postprocess_nodes(
+                    nodes, query_bundle=QueryBundle(message)
+                )
+            context_str = "\n\n".join(
+                node.node.get_content(metadata_mode=MetadataMode.LLM).strip()
+                for node in nodes
             )
-            return ContextChatEngine.from_defaults(
-                system_prompt=system_prompt,
-                retriever=vector_index_retriever,
-                service_context=self.service_context,
-                node_postprocessors=[
-                    MetadataReplacementPostProcessor(target_metadata_key="window"),
-                ],
+            prefix_messages.append(
+                ChatMessage(
+                    content=self.context_template.format(context_str=context_str)
+                    + (system_prompt or "").strip(),
+                    role=MessageRole.SYSTEM,
+                )
             )
-        else:
-            return SimpleChatEngine.from_defaults(
-                system_prompt=system_prompt,
-                service_context=self.service_context,
+        elif system_prompt is not None:
+            prefix_messages.append(
+                ChatMessage(content=system_prompt, role=MessageRole.SYSTEM)
             )
+        initial_token_count = len(
+            memory.tokenizer_fn(" ".join([(m.content or "") for m in prefix_messages]))
+        )
+        all_messages = prefix_messages + memory.get(
+            initial_token_count=initial_token_count
+        )
+        return all_messages, nodes
 
-    def stream_chat(
+    async def _aprepare_chat(
         self,
         messages: list[ChatMessage],
-        use_context: bool = False,
-        context_filter: ContextFilter | None = None,
-    ) -> CompletionGen:
+        use_context: bool,
+        context_filter: ContextFilter | None,
+    ) -> tuple[list[ChatMessage], list[NodeWithScore]]:
         chat_engine_input = ChatEngineInput.from_messages(messages)
         last_message = (
             chat_engine_input.last_message.content
@@ -136,58 +198,70 @@ class ChatService:
             if chat_engine_input.system_message
             else None
         )
-        chat_history = (
-            chat_engine_input.chat_history if chat_engine_input.chat_history else None
-        )
-
-        chat_engine = self._chat_engine(
-            system_prompt=system_prompt,
-            use_context=use_context,
+        with retrieval_options(
             context_filter=context_filter,
-        )
-        streaming_response = chat_engine.stream_chat(
-            message=last_message if last_message is not None else "",
-            chat_history=chat_history,
-        )
-        sources = [Chunk.from_node(node) for node in streaming_response.source_nodes]
-        completion_gen = CompletionGen(
-            response=streaming_response.response_gen, sources=sources
-        )
-        return completion_gen
+            consistency_level=self.retrieval_settings.chat_consistency_level,
+        ):
+            # The retrieval options are copied to the thread with the context
+            return await asyncio.to_thread(
+                self._llm_messages,
+                last_message if last_message is not None else "",
+                system_prompt,
+                chat_engine_input.chat_history or None,
+                use_context,
+            )
 
-    def chat(
+    async def astream_chat(
         self,
         messages: list[ChatMessage],
         use_context: bool = False,
         context_filter: ContextFilter | None = None,
-    ) -> Completion:
-        chat_engine_input = ChatEngineInput.from_messages(messages)
-        last_message = (
-            chat_engine_input.last_message.content
-            if chat_engine_input.last_message
-            else None
-        )
-        system_prompt = (
-            chat_engine_input.system_message.content
-            if chat_engine_input.system_message
-            else None
-        )
-        chat_history = (
-            chat_engine_input.chat_history if chat_engine_input.chat_history else None
-        )
+        user: str = "",
+    ) -> AsyncCompletionGen:
+        """Stream a chat completion without holding a thread of the server.
 
-        chat_engine = self._chat_engine(
-            system_prompt=system_prompt,
-            use_context=use_context,
-            context_filter=context_filter,
+        The retrieval runs in a worker thread, and the tokens are generated one
+        at a time in the generation executor of the LLM component, once the
+        scheduler gives the `user` their turn. Closing the response stops the
+        generation, or gives back its place in the queue if not started.
+
+        :raises LLMBusyError: if the scheduler does not admit the request
+        """
+        # Admitted first, so a busy server rejects before the retrieval runs
+        admission = self.llm_service.scheduler.admit()
+        try:
+            all_messages, nodes = await self._aprepare_chat(
+                messages, use_context, context_filter
+            )
+            sources = [Chunk.from_node(node) for node in nodes]
+        except BaseException:
+            admission.cancel()
+            raise
+        return AsyncCompletionGen(
+            response=self.llm_service.astream_chat(all_messages, user, admission),
+            sources=sources,
         )
-        wrapped_response = chat_engine.chat(
-            message=last_message if last_message is not None else "",
-            chat_history=chat_history,
+
+    async def achat(
+        self,
+        messages: list[ChatMessage],
+        use_context: bool = False,
+        context_filter: ContextFilter | None = None,
+        user: str = "",
+    ) -> Completion:
+        admission = self.llm_service.scheduler.admit()
+        try:
+            all_messages, nodes = await self._aprepare_chat(
+                messages, use_context, context_filter
+            )
+        except BaseException:
+            admission.cancel()
+            raise
+        chat_response = await self.llm_service.achat(all_messages, user, admission)
+        return Completion(
+            response=str(chat_response.message.content),
+            sources=[Chunk.from_node(node) for node in nodes],
         )
-        sources = [Chunk.from_node(node) for node in wrapped_response.source_nodes]
-        completion = Completion(response=wrapped_response.response, sources=sources)
-        return completion
 
 
 @lru_cache
@@ -1,7 +1,8 @@
+from functools import lru_cache
 from typing import TYPE_CHECKING, Literal
 
 from llama_index import ServiceContext, StorageContext, VectorStoreIndex
-from llama_index.schema import NodeWithScore
+from llama_index.schema import BaseNode, NodeWithScore
 from pydantic import BaseModel, Field
 
 from app.dependencies.base import ContextFilter
@@ -15,6 +16,13 @@ from app.dependencies.components import (
     get_node_store_component,
     get_vector_store_component,
 )
+from app.dependencies.components.node_store import get_nodes
+from app.dependencies.components.retrieval_cache import (
+    RetrievalCache,
+    get_retrieval_cache,
+)
+from app.dependencies.components.sparse_index import SparseIndex, get_sparse_index
+from app.dependencies.components.vector_store import retrieval_options
 from app.dependencies.services.ingest import IngestedDoc
 
 if TYPE_CHECKING:
@@ -62,6 +70,8 @@ class ChunksService:
         vector_store_component: VectorStoreComponent = get_vector_store_component(),
         embedding_component: EmbeddingComponent = get_embeddings_component(),
         node_store_component: NodeStoreComponent = get_node_store_component(),
+        retrieval_cache: RetrievalCache | None = get_retrieval_cache(),
+        sparse_index: SparseIndex | None = get_sparse_index(),
     ) -> None:
         self.vector_store_component = vector_store_component
         self.storage_context = StorageContext.from_defaults(
@@ -70,27 +80,57 @@ class ChunksService:
             index_store=node_store_component.index_store,
         )
         self.query_service_context = ServiceContext.from_defaults(
-            llm=llm_component.llm, embed_model=embedding_component.embedding_model
+            llm=llm_component.llm, embed_model=embedding_component.query_embedding_model
+        )
+        self.index = VectorStoreIndex.from_vector_store(
+            vector_store_component.vector_store,
+            storage_context=self.storage_context,
+            service_context=self.query_service_context,
+            show_progress=True,
+        )
+        # Shared by all the requests, which set their own top k and filter
+        self.retriever = vector_store_component.get_retriever(
+            index=self.index,
+            retrieval_cache=retrieval_cache,
+            sparse_index=sparse_index,
+            docstore=node_store_component.doc_store,
         )
 
-    def _get_sibling_nodes_text(
-        self, node_with_score: NodeWithScore, related_number: int, forward: bool = True
-    ) -> list[str]:
-        explored_nodes_texts = []
-        current_node = node_with_score.node
+    def _get_sibling_nodes_texts(
+        self, nodes: list[NodeWithScore], related_number: int, forward: bool = True
+    ) -> list[list[str]]:
+        """Follow the next (or previous) nodes of each node, `related_number` hops.
+
+        The siblings of all the nodes are fetched together, one hop at a time, so
+        the docstore is queried `related_number` times at most.
+        """
+        explored_nodes_texts: list[list[str]] = [[] for _ in nodes]
+        current_nodes: list[BaseNode | None] = [node.node for node in nodes]
         for _ in range(related_number):
-            explored_node_info: RelatedNodeInfo | None = (
-                current_node.next_node if forward else current_node.prev_node
-            )
-            if explored_node_info is None:
+            explored_node_ids: list[str | None] = []
+            for current_node in current_nodes:
+                explored_node_info: RelatedNodeInfo | None = None
+                if current_node is not None:
+                    explored_node_info = (
+                        current_node.next_node if forward else current_node.prev_node
+                    )
+                explored_node_ids.append(
+                    explored_node_info.node_id if explored_node_info else None
+                )
+            if not any(explored_node_ids):
                 break
 
-            explored_node = self.storage_context.docstore.get_node(
-                explored_node_info.node_id
+            explored_nodes = get_nodes(
+                self.storage_context.docstore,
+                list(dict.fromkeys(filter(None, explored_node_ids))),
             )
-
-            explored_nodes_texts.append(explored_node.get_content())
-            current_node = explored_node
+            current_nodes = [
+                explored_nodes.get(node_id) if node_id else None
+                for node_id in explored_node_ids
+            ]
+            for texts, explored_node in zip(explored_nodes_texts, current_nodes):
+                if explored_node is not None:
+                    texts.append(explored_node.get_content())
 
         return explored_nodes_texts
 
@@ -101,25 +141,45 @@ class ChunksService:
         limit: int = 10,
         prev_next_chunks: int = 0,
     ) -> list[Chunk]:
-        index = VectorStoreIndex.from_vector_store(
-            self.vector_store_component.vector_store,
-            storage_context=self.storage_context,
-            service_context=self.query_service_context,
-            show_progress=True,
-        )
-        vector_index_retriever = self.vector_store_component.get_retriever(
-            index=index, context_filter=context_filter, similarity_top_k=limit
+        return self.retrieve_relevant_batch(
+            [text], context_filter, limit, prev_next_chunks
+        )[0]
+
+    def retrieve_relevant_batch(
+        self,
+        texts: list[str],
+        context_filter: ContextFilter | None = None,
+        limit: int = 10,
+        prev_next_chunks: int = 0,
+    ) -> list[list[Chunk]]:
+        """Retrieve the chunks relevant to each of the texts.
+
+        The texts are embedded in a single batch and searched together, and the
+        siblings of all the retrieved nodes are fetched together.
+        """
+        with retrieval_options(context_filter=context_filter, similarity_top_k=limit):
+            nodes_per_text = self.retriever.retrieve_batch(texts)
+        for nodes in nodes_per_text:
+            nodes.sort(key=lambda n: n.score or 0.0, reverse=True)
+
+        all_nodes = [node for nodes in nodes_per_text for node in nodes]
+        previous_texts = iter(
+            self._get_sibling_nodes_texts(all_nodes, prev_next_chunks, False)
         )
-        nodes = vector_index_retriever.retrieve(text)
-        nodes.sort(key=lambda n: n.score or 0.0, reverse=True)
-
-        retrieved_nodes = []
-        for node in nodes:
-            chunk = Chunk.from_node(node)
-            chunk.previous_texts = self._get_sibling_nodes_text(
-                node, prev_next_chunks, False
-            )
-            chunk.next_texts = self._get_sibling_nodes_text(node, prev_next_chunks)
-            retrieved_nodes.append(chunk)
+        next_texts = iter(self._get_sibling_nodes_texts(all_nodes, prev_next_chunks))
+        retrieved_chunks = []
+        for nodes in nodes_per_text:
+            chunks = []
+            for node in nodes:
+                chunk = Chunk.from_node(node)
+                chunk.previous_texts = next(previous_texts)
+                chunk.next_texts = next(next_texts)
+                chunks.append(chunk)
+            retrieved_chunks.append(chunks)
+
+        return retrieved_chunks
+
 
-        return retrieved_nodes
+@lru_cache
+def get_chunks_service() -> ChunksService:
+    return ChunksService()
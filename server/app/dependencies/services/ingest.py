@@ -1,20 +1,12 @@
 import tempfile
 from functools import lru_cache
 from pathlib import Path
-from typing import TYPE_CHECKING, Annotated, Any, AnyStr, Literal
+from typing import Annotated, Any, AnyStr, Literal
 
 import structlog.stdlib
 from fastapi import Depends
-from llama_index import (
-    Document,
-    ServiceContext,
-    StorageContext,
-    VectorStoreIndex,
-    load_index_from_storage,
-)
+from llama_index import Document, ServiceContext, StorageContext
 from llama_index.node_parser import SentenceWindowNodeParser
-from llama_index.readers import JSONReader, StringIterableReader
-from llama_index.readers.file.base import DEFAULT_FILE_READER_CLS
 from pydantic import BaseModel, Field
 
 from app.dependencies.components import (
@@ -29,18 +21,15 @@ from app.dependencies.components import (
     get_node_store_component,
     get_vector_store_component,
 )
-from app.paths import local_data_path
-
-if TYPE_CHECKING:
-    from llama_index.readers.base import BaseReader
-
-# Patching the default file reader to support other file types
-FILE_READER_CLS = DEFAULT_FILE_READER_CLS.copy()
-FILE_READER_CLS.update(
-    {
-        ".json": JSONReader,
-    }
+from app.dependencies.components.ingest_scheduler import (
+    IngestScheduler,
+    get_ingest_scheduler,
+)
+from app.dependencies.components.retrieval_cache import (
+    RetrievalCache,
+    get_retrieval_cache,
 )
+from app.dependencies.components.sparse_index import SparseIndex, get_sparse_index
 
 logger = structlog.stdlib.get_logger(__name__)
 
@@ -65,6 +54,14 @@ class IngestedDoc(BaseModel):
         metadata.pop("original_text", None)
         return metadata
 
+    @classmethod
+    def from_document(cls, document: Document) -> "IngestedDoc":
+        return cls(
+            object="ingest.document",
+            doc_id=document.doc_id,
+            doc_metadata=cls.curate_metadata(dict(document.metadata)),
+        )
+
 
 class IngestService:
     def __init__(
@@ -79,7 +76,15 @@ class IngestService:
         node_store_component: Annotated[
             NodeStoreComponent, Depends()
         ] = get_node_store_component(),
+        scheduler: Annotated[IngestScheduler, Depends()] = get_ingest_scheduler(),
+        retrieval_cache: Annotated[
+            RetrievalCache | None, Depends(get_retrieval_cache)
+        ] = get_retrieval_cache(),
+        sparse_index: Annotated[
+            SparseIndex | None, Depends(get_sparse_index)
+        ] = get_sparse_index(),
     ) -> None:
+        self.scheduler = scheduler
         node_parser = SentenceWindowNodeParser.from_defaults()
         self.llm_service = llm_component
         self.storage_context = StorageContext.from_defaults(
@@ -98,88 +103,39 @@ class IngestService:
             self.storage_context,
             self.ingest_service_context,
             settings=get_embeddings_settings(),
+            kv_store=node_store_component.kv_store,
+            retrieval_cache=retrieval_cache,
+            sparse_index=sparse_index,
         )
 
     def ingest(self, file_name: str, file_data: AnyStr | Path) -> list[IngestedDoc]:
         logger.info("Ingesting", file_name=file_name)
-        extension = Path(file_name).suffix
-        reader_cls = FILE_READER_CLS.get(extension)
-        documents: list[Document]
-        if reader_cls is None:
-            logger.debug(
-                "No reader found, using default string reader",
-                extension=extension,
-            )
-            # Read as a plain text
-            string_reader = StringIterableReader()
-            if isinstance(file_data, Path):
-                text = file_data.read_text()
-                documents = string_reader.load_data([text])
-            elif isinstance(file_data, bytes):
-                documents = string_reader.load_data([file_data.decode("utf-8")])
-            elif isinstance(file_data, str):
-                documents = string_reader.load_data([file_data])
-            else:
-                raise ValueError(f"Unsupported data type {type(file_data)}")
-        else:
-            logger.debug("Specific reader found", extension=extension)
-            reader: BaseReader = reader_cls()
-            if isinstance(file_data, Path):
-                # Already a path, nothing to do
-                documents = reader.load_data(file_data)
+        if isinstance(file_data, Path):
+            # Already a path, nothing to do
+            return self.ingest_file(file_name, file_data)
+        # llama-index mainly supports reading from files, so
+        # we have to create a tmp file to read for it to work
+        with tempfile.NamedTemporaryFile(suffix=Path(file_name).suffix) as tmp:
+            path_to_tmp = Path(tmp.name)
+            if isinstance(file_data, bytes):
+                path_to_tmp.write_bytes(file_data)
             else:
-                # llama-index mainly supports reading from files, so
-                # we have to create a tmp file to read for it to work
-                with tempfile.NamedTemporaryFile() as tmp:
-                    path_to_tmp = Path(tmp.name)
-                    if isinstance(file_data, bytes):
-                        path_to_tmp.write_bytes(file_data)
-                    else:
-                        path_to_tmp.write_text(str(file_data))
-                    documents = reader.load_data(path_to_tmp)
-        logger.info("Transformed into documents", file=file_name, count=len(documents))
-        for document in documents:
-            document.metadata["file_name"] = file_name
-        return self._save_docs(documents)
-
-    def _save_docs(self, documents: list[Document]) -> list[IngestedDoc]:
-        for document in documents:
-            document.metadata["doc_id"] = document.doc_id
-            # We don't want the Embeddings search to receive this metadata
-            document.excluded_embed_metadata_keys = ["doc_id"]
-            # We don't want the LLM to receive these metadata in the context
-            document.excluded_llm_metadata_keys = ["file_name", "doc_id", "page_label"]
-
-        try:
-            # Load the index from storage and insert new documents,
-            index = load_index_from_storage(
-                storage_context=self.storage_context,
-                service_context=self.ingest_service_context,
-                store_nodes_override=True,  # Force store nodes in index and document stores
-                show_progress=True,
-            )
-            for doc in documents:
-                index.insert(doc)
-        except ValueError:
-            # Or create a new one if there is none
-            VectorStoreIndex.from_documents(
-                documents,
-                storage_context=self.storage_context,
-                service_context=self.ingest_service_context,
-                store_nodes_override=True,  # Force store nodes in index and document stores
-                show_progress=True,
-            )
-
-        # persist the index and nodes
-        self.storage_context.persist(persist_dir=local_data_path)
-        return [
-            IngestedDoc(
-                object="ingest.document",
-                doc_id=document.doc_id,
-                doc_metadata=IngestedDoc.curate_metadata(document.metadata),
-            )
-            for document in documents
-        ]
+                path_to_tmp.write_text(str(file_data))
+            return self.ingest_file(file_name, path_to_tmp)
+
+    def ingest_file(self, file_name: str, file_data: Path) -> list[IngestedDoc]:
+        with self.scheduler.interactive():
+            documents = self.ingest_component.ingest(file_name, file_data)
+        logger.info("Finished ingestion", file_name=file_name, count=len(documents))
+        return [IngestedDoc.from_document(document) for document in documents]
+
+    def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[IngestedDoc]:
+        logger.info("Ingesting files", count=len(files))
+        # Runs in the bulk lane, giving way to the single file ingestions
+        with self.scheduler.bulk():
+            documents = self.ingest_component.bulk_ingest(files)
+        logger.info("Finished bulk ingestion", files=len(files), count=len(documents))
+        return [IngestedDoc.from_document(document) for document in documents]
 
     def list_ingested(self) -> list[IngestedDoc]:
         ingested_docs = []
@@ -212,20 +168,16 @@ class IngestService:
     def delete(self, doc_id: str) -> None:
         """Delete an ingested document.
 
-        :raises ValueError: if the document does not exist
+        A document that does not exist, or was already deleted, is ignored.
         """
         logger.info(
-            "Deleting the ingested document=%s in the doc and index store", doc_id
+            "Deleting the ingested document in the doc and index store", doc_id=doc_id
         )
+        self.ingest_component.delete(doc_id)
 
-        # Load the index with store_nodes_override=True to be able to delete them
-        index = load_index_from_storage(self.storage_context, store_nodes_override=True)
-
-        # Delete the document from the index
-        index.delete_ref_doc(doc_id, delete_from_docstore=True)
-
-        # Save the index
-        self.storage_context.persist(persist_dir=local_data_path)
+    def close(self) -> None:
+        """Persist the pending changes to the index, on shutdown."""
+        self.ingest_component.close()
 
 
 @lru_cache
@@ -0,0 +1,201 @@
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Literal
+
+import structlog.stdlib
+from pydantic import BaseModel, Field
+from redis import Redis
+
+from app.config.settings import (
+    IngestSettings,
+    RedisSettings,
+    get_ingest_settings,
+    get_redis_settings,
+)
+from app.dependencies.components.ingest_tracking import (
+    IngestCancelledError,
+    IngestTracker,
+    track_ingestion,
+)
+from app.dependencies.services.ingest import (
+    IngestedDoc,
+    IngestService,
+    get_ingest_service,
+)
+
+logger = structlog.stdlib.get_logger(__name__)
+
+JobStatus = Literal["queued", "running", "succeeded", "failed", "cancelled"]
+
+
+class IngestQueueFullError(Exception):
+    pass
+
+
+class IngestJob(BaseModel):
+    object: Literal["ingest.job"] = "ingest.job"
+    job_id: str = Field(examples=["8f14e45f-ceea-467f-a0e6-b1a9d2f0c1e3"])
+    status: JobStatus = Field(examples=["running"])
+    file_names: list[str] = Field(examples=[["Sales Report Q3 2023.pdf"]])
+    created_at: float
+    started_at: float | None = None
+    finished_at: float | None = None
+    timings: dict[str, float] = Field(
+        default_factory=dict,
+        examples=[{"queued": 0.02, "parse": 1.3, "transform": 12.4, "insert": 0.8}],
+    )
+    error: str | None = None
+    data: list[IngestedDoc] | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+
+class IngestJobService:
+    """Run ingestions in the background and keep track of them in Redis.
+
+    Jobs run on a bounded pool of threads, each going through the configured
+    ingest component. The job state is stored in Redis so any process can
+    report it, and cancellation is requested through Redis as well, which
+    lets the process running the job pick it up between ingestion stages.
+    """
+
+    def __init__(
+        self,
+        ingest_service: IngestService | None = None,
+        settings: IngestSettings = get_ingest_settings(),
+        redis_settings: RedisSettings = get_redis_settings(),
+    ) -> None:
+        self._ingest_service = ingest_service
+        self.settings = settings
+        self._redis = Redis.from_url(str(redis_settings.dsn))
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.job_workers, thread_name_prefix="ingest-job"
+        )
+        self._slots = threading.BoundedSemaphore(settings.job_max_pending)
+        self._futures: dict[str, Future] = {}
+        self._futures_lock = threading.Lock()
+
+    @property
+    def ingest_service(self) -> IngestService:
+        # Resolved on first use, as building it loads the index and the workers
+        if self._ingest_service is None:
+            self._ingest_service = get_ingest_service()
+        return self._ingest_service
+
+    @staticmethod
+    def _job_key(job_id: str) -> str:
+        return f"ingest:job:{job_id}"
+
+    @staticmethod
+    def _cancel_key(job_id: str) -> str:
+        return f"ingest:job:{job_id}:cancel"
+
+    def _save(self, job: IngestJob) -> None:
+        self._redis.set(
+            self._job_key(job.job_id), job.model_dump_json(), ex=self.settings.job_ttl
+        )
+
+    def _is_cancel_requested(self, job_id: str) -> bool:
+        return bool(self._redis.exists(self._cancel_key(job_id)))
+
+    def get(self, job_id: str) -> IngestJob | None:
+        raw_job = self._redis.get(self._job_key(job_id))
+        if raw_job is None:
+            return None
+        return IngestJob.model_validate_json(raw_job)
+
+    def submit(self, files: list[tuple[str, Path]]) -> IngestJob:
+        """Queue the ingestion of the given files.
+
+        The job takes ownership of the files, and deletes them once done.
+
+        :raises IngestQueueFullError: if too many jobs are already pending
+        """
+        if not self._slots.acquire(blocking=False):
+            raise IngestQueueFullError(
+                f"There are already {self.settings.job_max_pending} pending jobs"
+            )
+
+        job = IngestJob(
+            job_id=str(uuid.uuid4()),
+            status="queued",
+            file_names=[file_name for file_name, _ in files],
+            created_at=time.time(),
+        )
+        self._save(job)
+        future = self._executor.submit(self._run, job, files)
+        with self._futures_lock:
+            self._futures[job.job_id] = future
+        future.add_done_callback(lambda _: self._release(job.job_id, files))
+        logger.info("Queued ingest job", job_id=job.job_id, files=job.file_names)
+        return job
+
+    def cancel(self, job_id: str) -> IngestJob | None:
+        """Cancel a job.
+
+        A queued job is dropped right away. A running job stops before its next
+        stage, unless it is already writing to the index, in which case it runs
+        to completion.
+        """
+        job = self.get(job_id)
+        if job is None or job.is_finished:
+            return job
+
+        self._redis.set(self._cancel_key(job_id), 1, ex=self.settings.job_ttl)
+        with self._futures_lock:
+            future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            self._save(job)
+        logger.info("Requested ingest job cancellation", job_id=job_id)
+        return job
+
+    def _release(self, job_id: str, files: list[tuple[str, Path]]) -> None:
+        with self._futures_lock:
+            self._futures.pop(job_id, None)
+        for _, file_data in files:
+            file_data.unlink(missing_ok=True)
+        self._slots.release()
+
+    def _run(self, job: IngestJob, files: list[tuple[str, Path]]) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        tracker = IngestTracker(
+            is_cancelled=lambda: self._is_cancel_requested(job.job_id),
+            timings={"queued": job.started_at - job.created_at},
+        )
+        job.timings = tracker.timings
+        self._save(job)
+
+        try:
+            with track_ingestion(tracker):
+                if tracker.is_cancelled():
+                    raise IngestCancelledError("Ingestion cancelled before starting")
+                if len(files) == 1:
+                    job.data = self.ingest_service.ingest_file(*files[0])
+                else:
+                    job.data = self.ingest_service.bulk_ingest(files)
+            job.status = "succeeded"
+        except IngestCancelledError:
+            logger.info("Ingest job cancelled", job_id=job.job_id)
+            job.status = "cancelled"
+        except Exception as e:
+            logger.exception("Ingest job failed", job_id=job.job_id)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            job.timings = tracker.timings
+            self._save(job)
+
+
+@lru_cache
+def get_ingest_job_service() -> IngestJobService:
+    return IngestJobService()
@@ -0,0 +1,350 @@
+import asyncio
+import itertools
+import tarfile
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from pathlib import Path, PurePosixPath
+from typing import IO, Any, AsyncIterator, Iterator
+
+import structlog.stdlib
+from botocore.exceptions import ClientError
+from fastapi import HTTPException, Request, status
+from multipart.multipart import (
+    MultipartParseError,
+    MultipartParser,
+    parse_options_header,
+)
+
+from app.config.settings import IngestSettings, get_ingest_settings
+from app.dependencies.file_storage import S3Client
+from app.paths import uploads_path
+
+logger = structlog.stdlib.get_logger(__name__)
+
+ARCHIVE_SUFFIXES = (
+    ".zip",
+    ".tar",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".tbz2",
+    ".tar.xz",
+    ".txz",
+)
+
+
+def is_archive(file_name: str) -> bool:
+    return file_name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def _too_large(max_size: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File is larger than the maximum allowed size of {max_size} bytes",
+    )
+
+
+class _MultipartFiles:
+    """Write the files of a multipart body to disk, while it is parsed.
+
+    The files of the other fields, and the fields that are not files, are
+    skipped without being kept.
+    """
+
+    def __init__(
+        self, field_name: str, max_files: int | None, settings: IngestSettings
+    ) -> None:
+        self.field_name = field_name
+        self.max_files = max_files
+        self.settings = settings
+        self.files: list[tuple[str, Path]] = []
+        self._headers: dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._file: IO[bytes] | None = None
+        self._size = 0
+
+    def callbacks(self) -> dict[str, Any]:
+        return {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        }
+
+    def close(self) -> None:
+        """Close the file being written, after a failure."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition"))
+        if options.get(b"name", b"").decode() != self.field_name:
+            return
+        if b"filename" not in options:
+            return
+        file_name = options[b"filename"].decode()
+        if not file_name:
+            raise HTTPException(400, "No file name provided")
+        if self.max_files is not None and len(self.files) >= self.max_files:
+            raise HTTPException(400, f"At most {self.max_files} file(s) expected")
+        self._file = tempfile.NamedTemporaryFile(
+            dir=uploads_path, suffix=Path(file_name).suffix, delete=False
+        )
+        self._size = 0
+        self.files.append((file_name, Path(self._file.name)))
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._file is None:
+            return
+        self._size += end - start
+        max_size = self.settings.max_upload_size
+        if max_size and self._size > max_size:
+            raise _too_large(max_size)
+        self._file.write(data[start:end])
+
+    def _on_part_end(self) -> None:
+        if self._file is not None:
+            logger.debug(
+                "Received upload", file_name=self.files[-1][0], size=self._size
+            )
+            self._file.close()
+            self._file = None
+
+
+@asynccontextmanager
+async def receive_uploads(
+    request: Request,
+    field_name: str,
+    max_files: int | None = None,
+    settings: IngestSettings = get_ingest_settings(),
+    delete: bool = True,
+) -> AsyncIterator[list[tuple[str, Path]]]:
+    """Stream the files of a multipart request to disk, as the body arrives.
+
+    Each file of the `field_name` field is written to its own temporary file,
+    which keeps its extension so the readers can pick the right parser. The
+    body is not spooled by Starlette before, so a file going over
+    `max_upload_size` fails the request before the rest of the body is read.
+
+    The files are removed when the context exits, unless `delete` is False,
+    in which case the caller owns them.
+
+    :raises HTTPException: 400 if the body is not multipart, if it has no
+        file or more than `max_files`, 413 if a file goes over
+        `max_upload_size`
+    """
+    content_type, params = parse_options_header(request.headers.get("Content-Type"))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(400, "Expected a multipart/form-data body")
+
+    uploads_path.mkdir(parents=True, exist_ok=True)
+    files = _MultipartFiles(field_name, max_files, settings)
+    parser = MultipartParser(params[b"boundary"], files.callbacks())
+    try:
+        try:
+            async for chunk in request.stream():
+                # The parser writes the files, out of the event loop
+                await asyncio.to_thread(parser.write, chunk)
+            parser.finalize()
+        except MultipartParseError:
+            raise HTTPException(400, "Invalid multipart/form-data body")
+        finally:
+            files.close()
+        if not files.files:
+            raise HTTPException(400, f"No file provided in the {field_name} field")
+    except BaseException:
+        for _, path in files.files:
+            path.unlink(missing_ok=True)
+        raise
+
+    try:
+        yield files.files
+    finally:
+        if delete:
+            for _, path in files.files:
+                path.unlink(missing_ok=True)
+
+
+def _archive_members(archive: Path) -> Iterator[tuple[str, int, IO[bytes]]]:
+    """Yield the name, declared size and content of each file of an archive."""
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zip_file:
+            for info in zip_file.infolist():
+                if not info.is_dir():
+                    with zip_file.open(info) as content:
+                        yield info.filename, info.file_size, content
+    elif tarfile.is_tarfile(archive):
+        with tarfile.open(archive, "r:*") as tar_file:
+            for member in tar_file:
+                # Links and special files are never extracted
+                if member.isfile():
+                    content = tar_file.extractfile(member)
+                    if content is not None:
+                        yield member.name, member.size, content
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{archive.name} is not a valid zip or tar archive",
+        )
+
+
+def extract_archive(
+    archive: Path,
+    extract_dir: Path,
+    settings: IngestSettings = get_ingest_settings(),
+) -> list[tuple[str, Path]]:
+    """Extract the files of a zip or tar archive into `extract_dir`.
+
+    Files are written under a generated name, so entries such as
+    `../../etc/passwd` can never escape `extract_dir`. The returned file
+    names are the paths of the files inside the archive.
+
+    :raises HTTPException: 400 for an invalid archive, 413 if it contains too
+        many files or too much data
+    """
+    max_size = settings.max_archive_size
+    extracted: list[tuple[str, Path]] = []
+    total_size = 0
+    for name, declared_size, content in _archive_members(archive):
+        member_path = PurePosixPath(name)
+        if member_path.is_absolute() or ".." in member_path.parts:
+            logger.warning("Skipping unsafe archive member", name=name)
+            continue
+        if member_path.parts[0] == "__MACOSX" or member_path.name.startswith("."):
+            continue
+        if len(extracted) >= settings.max_archive_files:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Archive has more than {settings.max_archive_files} files",
+            )
+        if max_size and total_size + declared_size > max_size:
+            raise _too_large(max_size)
+
+        file_path = extract_dir / f"{len(extracted)}{member_path.suffix}"
+        with file_path.open("wb") as file:
+            # The declared size can't be trusted, so count what is written
+            while chunk := content.read(settings.upload_chunk_size):
+                total_size += len(chunk)
+                if max_size and total_size > max_size:
+                    raise _too_large(max_size)
+                file.write(chunk)
+        extracted.append((str(member_path), file_path))
+
+    logger.debug("Extracted archive", archive=archive.name, count=len(extracted))
+    return extracted
+
+
+@contextmanager
+def expand_archives(
+    files: list[tuple[str, Path]],
+    settings: IngestSettings = get_ingest_settings(),
+) -> Iterator[list[tuple[str, Path]]]:
+    """Replace the zip and tar archives among the files by their files.
+
+    The extracted files are removed when the context exits.
+    """
+    with ExitStack() as stack:
+        expanded: list[tuple[str, Path]] = []
+        for file_name, file_path in files:
+            if is_archive(file_name):
+                extract_dir = stack.enter_context(
+                    tempfile.TemporaryDirectory(dir=uploads_path)
+                )
+                expanded.extend(extract_archive(file_path, Path(extract_dir), settings))
+            else:
+                expanded.append((file_name, file_path))
+        yield expanded
+
+
+def _download_object(
+    s3_client: S3Client, key: str, file_path: Path, settings: IngestSettings
+) -> Path:
+    bucket_object = s3_client.bucket.Object(key)
+    try:
+        max_size = settings.max_upload_size
+        if max_size and bucket_object.content_length > max_size:
+            raise _too_large(max_size)
+        with file_path.open("wb") as file:
+            bucket_object.download_fileobj(file)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Object {key} not found in the bucket",
+            )
+        raise
+    return file_path
+
+
+def spool_objects(
+    s3_client: S3Client,
+    keys: list[str],
+    settings: IngestSettings = get_ingest_settings(),
+) -> Iterator[list[tuple[str, Path]]]:
+    """Download objects of the bucket to disk, and yield them in batches.
+
+    Up to `bucket_prefetch` objects are downloaded at the same time, and the
+    next batch is downloaded while the caller processes the current one. The
+    files of a batch are removed once the caller asks for the next one.
+
+    :raises HTTPException: 404 if an object does not exist, 413 if it is
+        larger than `max_upload_size`
+    """
+    uploads_path.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=uploads_path) as download_dir:
+        executor = ThreadPoolExecutor(
+            max_workers=settings.bucket_prefetch, thread_name_prefix="s3-download"
+        )
+        pending: deque[tuple[str, Future[Path]]] = deque()
+        remaining_keys = enumerate(keys)
+
+        def prefetch(count: int) -> None:
+            for index, key in itertools.islice(remaining_keys, count):
+                file_path = Path(download_dir) / f"{index}{PurePosixPath(key).suffix}"
+                pending.append(
+                    (
+                        key,
+                        executor.submit(
+                            _download_object, s3_client, key, file_path, settings
+                        ),
+                    )
+                )
+
+        try:
+            prefetch(2 * settings.bucket_batch_size)
+            while pending:
+                batch = []
+                while pending and len(batch) < settings.bucket_batch_size:
+                    key, download = pending.popleft()
+                    batch.append((key, download.result()))
+                prefetch(len(batch))
+                logger.debug("Downloaded bucket objects", count=len(batch))
+                try:
+                    yield batch
+                finally:
+                    for _, file_path in batch:
+                        file_path.unlink(missing_ok=True)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -13,6 +13,7 @@ from app.config.settings import (
     get_app_settings,
 )
 from app.database.init_db import close_mongo_connection, connect_to_mongo
+from app.dependencies.services.ingest import get_ingest_service
 from app.dependencies.session import RedisClient
 from app.routes import (
     auth_ui,
@@ -22,6 +23,7 @@ from app.routes import (
     users_api,
     upload_api,
     chat_api,
+    chunks_api,
     ingest_api,
 )
 from app.middleware.session import SessionMiddleware
@@ -36,6 +38,9 @@ async def lifespan(app: FastAPI):
     yield
     await close_mongo_connection(db_client)
     await red.close()
+    # Only built by the first ingestion
+    if get_ingest_service.cache_info().currsize:
+        get_ingest_service().close()
 
 
 current_dir = pathlib.Path(__file__).parent
@@ -83,5 +88,6 @@ def init_app(app_settings: AppSettings = get_app_settings()):
     fast_app.include_router(upload_api)
     fast_app.include_router(ingest_api)
     fast_app.include_router(chat_api)
+    fast_app.include_router(chunks_api)
 
     return fast_app
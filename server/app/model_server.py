@@ -0,0 +1,129 @@
+"""Serve the LLM and the embedding model to the workers, over a Unix socket.
+
+With `MODEL_SERVER_ENABLED`, the workers do not load the models, their
+components call this server instead. It is started once per host, before the
+workers, by `gunicorn.conf.py`, or by hand:
+
+    python -m app.model_server
+"""
+import json
+from collections.abc import AsyncGenerator
+from contextlib import aclosing
+from typing import Any
+
+import structlog.stdlib
+import uvicorn
+from fastapi import FastAPI
+from llama_index.llms import ChatMessage
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
+
+from app.config.logging import setup_logging
+from app.config.settings import (
+    ModelServerSettings,
+    get_app_settings,
+    get_cache_settings,
+    get_llm_settings,
+    get_redis_settings,
+)
+from app.dependencies.components.embedding import EmbeddingComponent
+from app.dependencies.components.embedding_cache import embed_queries
+from app.dependencies.components.llm import LLMComponent
+from app.paths import model_server_socket_path
+
+logger = structlog.stdlib.get_logger(__name__)
+
+
+class ChatBody(BaseModel):
+    messages: list[dict[str, Any]]
+    stream: bool = False
+    client: str = ""
+
+
+class CompleteBody(BaseModel):
+    prompt: str
+    formatted: bool = False
+    stream: bool = False
+    client: str = ""
+
+
+class EmbeddingsBody(BaseModel):
+    texts: list[str]
+    query: bool = False
+
+
+async def _json_lines(deltas: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+    async with aclosing(deltas):
+        async for delta in deltas:
+            yield json.dumps({"delta": delta}) + "\n"
+
+
+def _stream(deltas: AsyncGenerator[str, None]) -> StreamingResponse:
+    stream = _json_lines(deltas)
+    # Closed when the worker disconnects, which stops the generation
+    return StreamingResponse(
+        stream,
+        media_type="application/x-ndjson",
+        background=BackgroundTask(stream.aclose),
+    )
+
+
+def create_model_server(
+    llm_component: LLMComponent, embedding_component: EmbeddingComponent
+) -> FastAPI:
+    """The API of the models, for the components of the workers.
+
+    The generations are queued by the scheduler of the LLM component, without
+    admission control, which is left to the workers.
+    """
+    server = FastAPI(openapi_url=None)
+
+    @server.post("/llm/chat", response_model=None)
+    async def llm_chat(body: ChatBody) -> dict[str, Any] | StreamingResponse:
+        messages = [ChatMessage.parse_obj(message) for message in body.messages]
+        if body.stream:
+            return _stream(llm_component.astream_chat(messages, body.client))
+        response = await llm_component.achat(messages, body.client)
+        return {"content": response.message.content}
+
+    @server.post("/llm/complete", response_model=None)
+    async def llm_complete(body: CompleteBody) -> dict[str, Any] | StreamingResponse:
+        if body.stream:
+            return _stream(
+                llm_component.astream_complete(body.prompt, body.formatted, body.client)
+            )
+        response = await llm_component.acomplete(
+            body.prompt, body.formatted, body.client
+        )
+        return {"text": response.text}
+
+    @server.post("/embeddings")
+    def embeddings(body: EmbeddingsBody) -> dict[str, Any]:
+        embedding_model = embedding_component.embedding_model
+        if body.query:
+            return {"embeddings": embed_queries(embedding_model, body.texts)}
+        return {"embeddings": embedding_model.get_text_embedding_batch(body.texts)}
+
+    return server
+
+
+def main() -> None:
+    app_settings = get_app_settings()
+    setup_logging(json_logs=app_settings.json_logs, log_level=app_settings.log_level)
+    # This process loads the models
+    settings = ModelServerSettings(enabled=False)
+    logger.info("Loading the models")
+    server = create_model_server(
+        LLMComponent(app_settings, get_llm_settings(), settings),
+        EmbeddingComponent(
+            app_settings, get_cache_settings(), get_redis_settings(), settings
+        ),
+    )
+    model_server_socket_path.parent.mkdir(parents=True, exist_ok=True)
+    model_server_socket_path.unlink(missing_ok=True)
+    uvicorn.run(server, uds=str(model_server_socket_path), log_config=None)
+
+
+if __name__ == "__main__":
+    main()
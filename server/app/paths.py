@@ -13,3 +13,9 @@ models_path: Path = PROJECT_ROOT_PATH / "llm"
 models_cache_path: Path = models_path / "cache"
 docs_path: Path = PROJECT_ROOT_PATH / "docs"
 local_data_path: Path = _absolute_or_from_project_root("local_data/private_gpt")
+uploads_path: Path = _absolute_or_from_project_root("local_data/uploads")
+ingest_log_path: Path = _absolute_or_from_project_root("local_data/ingest_log")
+vectors_path: Path = _absolute_or_from_project_root("local_data/vectors")
+model_server_socket_path: Path = _absolute_or_from_project_root(
+    "local_data/model_server.sock"
+)
@@ -6,6 +6,7 @@ from .ui.chat import router as chat_ui
 # API routes
 from .auth import router as auth_api
 from .chat import chat_router as chat_api
+from .chunks import router as chunks_api
 from .ingest import router as ingest_api
 from .upload import router as upload_api
 from .users import router as users_api
@@ -16,6 +17,7 @@ __all__ = [
     "chat_ui",
     "auth_api",
     "chat_api",
+    "chunks_api",
     "ingest_api",
     "upload_api",
     "users_api",
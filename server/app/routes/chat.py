@@ -1,23 +1,29 @@
 from typing import Annotated
 
 import structlog.stdlib
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from llama_index.llms import ChatMessage, MessageRole
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 from starlette.responses import StreamingResponse
 
 from app.dependencies.base import ContextFilter
+from app.dependencies.components.llm_scheduler import LLMBusyError
 from app.dependencies.open_ai.openai_models import (
     OpenAICompletion,
     OpenAIMessage,
     to_openai_response,
-    to_openai_sse_stream,
+    to_openai_sse_astream,
 )
 from app.dependencies.services.chat import ChatService, get_chat_service
 
 chat_router = APIRouter(prefix="/api/v1")
 logger = structlog.stdlib.get_logger(__name__)
 
+# The queue user of the requests without a session nor a client address, such
+# as the ones made over a Unix socket
+UNKNOWN_CLIENT = "unknown"
+
 
 class ChatBody(BaseModel):
     messages: list[OpenAIMessage]
@@ -51,7 +57,7 @@ class ChatBody(BaseModel):
     responses={200: {"model": OpenAICompletion}},
     tags=["Contextual Completions"],
 )
-def chat_completion(
+async def chat_completion(
     request: Request,
     body: ChatBody,
     service: Annotated[ChatService, Depends(get_chat_service)],
@@ -60,13 +66,22 @@ def chat_completion(
 
     If `use_context` is set to `true`, the model will use context coming
     from the ingested documents to create the response. The documents being used can
-    be filtered using the `context_filter` and passing the document IDs to be used.
-    Ingested documents IDs can be found using `/ingest/list` endpoint. If you want
+    be filtered using the `context_filter` and passing the document IDs or the file
+    names to be used. Ingested documents IDs can be found using `/ingest/list` endpoint.
+    The filter is applied inside the vector search. If you want
     all ingested documents to be used, remove `context_filter` altogether.
 
     When using `'include_sources': true`, the API will return the source Chunks used
     to create the response, which come from the context provided.
 
+    The retrieval and the generation run outside of the event loop, and a stream
+    only holds a thread while a token is generated, so idle streams are cheap.
+    The generation stops when the client of a stream disconnects.
+
+    The generations wait for the LLM in a queue, where the users are served in
+    turn. When the queue is full, or its wait is too long, the API returns a
+    429 with a `Retry-After` header.
+
     When using `'stream': true`, the API will return data chunks following [OpenAI's
     streaming model](https://platform.openai.com/docs/api-reference/chat/streaming):
     ```
@@ -80,20 +95,43 @@ def chat_completion(
     all_messages = [
         ChatMessage(content=m.content, role=MessageRole(m.role)) for m in body.messages
     ]
-    if body.stream:
-        logger.debug("Streaming messages")
-        completion_gen = service.stream_chat(
-            all_messages, body.use_context, body.context_filter
-        )
-        return StreamingResponse(
-            to_openai_sse_stream(
+    # The queue is fair between the sessions, or the clients without one
+    client = request.client.host if request.client is not None else UNKNOWN_CLIENT
+    user = str(request.session.get("user_id") or client)
+    try:
+        if body.stream:
+            logger.debug("Streaming messages")
+            completion_gen = await service.astream_chat(
+                all_messages, body.use_context, body.context_filter, user
+            )
+            stream = to_openai_sse_astream(
                 completion_gen.response,
                 completion_gen.sources if body.include_sources else None,
-            ),
-            media_type="text/event-stream",
-        )
-    else:
-        completion = service.chat(all_messages, body.use_context, body.context_filter)
-        return to_openai_response(
-            completion.response, completion.sources if body.include_sources else None
+            )
+
+            async def close() -> None:
+                # A disconnect cancels the response, the stream is then left
+                # suspended until closed, which stops the generation. The
+                # generation is closed too, in case the stream was not started.
+                await stream.aclose()
+                await completion_gen.response.aclose()
+
+            return StreamingResponse(
+                stream,
+                media_type="text/event-stream",
+                background=BackgroundTask(close),
+            )
+        else:
+            completion = await service.achat(
+                all_messages, body.use_context, body.context_filter, user
+            )
+            return to_openai_response(
+                completion.response,
+                completion.sources if body.include_sources else None,
+            )
+    except LLMBusyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
         )
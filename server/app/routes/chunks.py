@@ -0,0 +1,58 @@
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends
+from pydantic import BaseModel, Field
+
+from app.dependencies.base import ContextFilter
+from app.dependencies.services.chunks import Chunk, ChunksService, get_chunks_service
+
+router = APIRouter(prefix="/api/v1")
+
+
+class ChunksBody(BaseModel):
+    texts: list[str] = Field(min_length=1, max_length=64, examples=[["Q3 2023 sales"]])
+    context_filter: ContextFilter | None = None
+    limit: int = Field(10, ge=1, le=100)
+    prev_next_chunks: int = Field(0, ge=0, le=10, examples=[2])
+
+
+class QueryChunks(BaseModel):
+    index: int
+    text: str
+    chunks: list[Chunk]
+
+
+class ChunksResponse(BaseModel):
+    object: Literal["list"]
+    model: Literal["private-gpt"]
+    data: list[QueryChunks]
+
+
+@router.post("/chunks", tags=["Context Chunks"])
+def chunks_retrieval(
+    body: ChunksBody,
+    service: Annotated[ChunksService, Depends(get_chunks_service)],
+) -> ChunksResponse:
+    """Given several texts, return the most relevant chunks for each of them.
+
+    All the texts are embedded in a single batch and searched in a single
+    vector search, so sending many queries at once is much cheaper than
+    sending them one by one. The results are returned in the order of the
+    texts, each with its `index` in the request.
+
+    Each chunk has a `score` and the `document` it comes from. The `limit`
+    applies to each text (at most 100), and `prev_next_chunks` adds the texts of
+    up to 10 chunks on each side of each result. The search can be restricted with `context_filter`,
+    as in `/chat/completions`.
+    """
+    results = service.retrieve_relevant_batch(
+        body.texts, body.context_filter, body.limit, body.prev_next_chunks
+    )
+    return ChunksResponse(
+        object="list",
+        model="private-gpt",
+        data=[
+            QueryChunks(index=index, text=text, chunks=chunks)
+            for index, (text, chunks) in enumerate(zip(body.texts, results))
+        ],
+    )
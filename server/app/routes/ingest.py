@@ -1,13 +1,24 @@
+from contextlib import closing
 from typing import Annotated, Literal
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 
+from app.config.settings import IngestSettings, get_ingest_settings
+from app.dependencies.file_storage import S3Client
 from app.dependencies.services.ingest import (
     IngestedDoc,
     IngestService,
     get_ingest_service,
 )
+from app.dependencies.services.ingest_jobs import (
+    IngestJob,
+    IngestJobService,
+    IngestQueueFullError,
+    get_ingest_job_service,
+)
+from app.dependencies.upload import expand_archives, receive_uploads, spool_objects
 
 router = APIRouter(prefix="/api/v1")
 
@@ -18,9 +29,37 @@ class IngestResponse(BaseModel):
     data: list[IngestedDoc]
 
 
-@router.post("/ingest", tags=["Ingestion"])
-def ingest(
-    file: UploadFile,
+class IngestBucketBody(BaseModel):
+    keys: list[str] = Field(
+        default_factory=list, examples=[["reports/Sales Report Q3 2023.pdf"]]
+    )
+    prefix: str | None = Field(None, examples=["reports/"])
+
+
+def _files_body(field_name: str, multiple: bool = False) -> dict:
+    """Document a multipart body of files read from the request stream."""
+    schema: dict = {"type": "string", "format": "binary"}
+    if multiple:
+        schema = {"type": "array", "items": schema}
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {field_name: schema},
+                        "required": [field_name],
+                    }
+                }
+            },
+        }
+    }
+
+
+@router.post("/ingest", tags=["Ingestion"], openapi_extra=_files_body("file"))
+async def ingest(
+    request: Request,
     service: Annotated[IngestService, Depends(get_ingest_service)],
 ) -> IngestResponse:
     """Ingests and processes a file, storing its chunks to be used as context.
@@ -37,13 +76,131 @@ def ingest(
     extracted Metadata (which is later used to improve context retrieval). Those IDs
     can be used to filter the context used to create responses in
     `/chat/completions`, `/completions`, and `/chunks` APIs.
+
+    The upload is streamed to disk as it is received, and a file going over the
+    configured `INGEST_MAX_UPLOAD_SIZE` is rejected with a 413 right away.
     """
-    if file.filename is None:
-        raise HTTPException(400, "No file name provided")
-    ingested_documents = service.ingest(file.filename, file.file.read())
+    async with receive_uploads(request, "file", max_files=1) as files:
+        [(file_name, file_path)] = files
+        ingested_documents = await run_in_threadpool(
+            service.ingest, file_name, file_path
+        )
     return IngestResponse(object="list", model="private-gpt", data=ingested_documents)
 
 
+@router.post(
+    "/ingest/bulk", tags=["Ingestion"], openapi_extra=_files_body("files", True)
+)
+async def bulk_ingest(
+    request: Request,
+    service: Annotated[IngestService, Depends(get_ingest_service)],
+) -> IngestResponse:
+    """Ingests several files at once, storing their chunks to be used as context.
+
+    Files can be sent individually, or packed in zip or tar archives (optionally
+    compressed), whose files are all ingested. The file name of a file coming
+    from an archive is its path inside the archive.
+
+    The whole set is handed over to the ingest component in one go, so that, in
+    the `batch` and `parallel` ingest modes, files are parsed in parallel and
+    their embeddings computed in large batches. This is much faster than one
+    call to `/ingest` per file.
+    """
+    async with receive_uploads(request, "files") as files:
+        with expand_archives(files) as expanded_files:
+            ingested_documents = await run_in_threadpool(
+                service.bulk_ingest, expanded_files
+            )
+    return IngestResponse(object="list", model="private-gpt", data=ingested_documents)
+
+
+@router.post("/ingest/bucket", tags=["Ingestion"])
+def ingest_from_bucket(
+    body: IngestBucketBody,
+    service: Annotated[IngestService, Depends(get_ingest_service)],
+    s3_client: Annotated[S3Client, Depends()],
+    settings: Annotated[IngestSettings, Depends(get_ingest_settings)],
+) -> IngestResponse:
+    """Ingests files already uploaded to the bucket with `/files/upload`.
+
+    The files are given by their object `keys`, and/or by a `prefix` matching
+    all the objects under it. They are downloaded by the server, several at a
+    time, and ingested in batches as with `/ingest/bulk`; the file name of a
+    Document is the key of its object.
+    """
+    keys = list(body.keys)
+    if body.prefix is not None:
+        keys.extend(key for key in s3_client.list_keys(body.prefix) if key not in keys)
+    if not keys:
+        raise HTTPException(400, "No object keys provided, or none under the prefix")
+    if len(keys) > settings.bucket_max_objects:
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"More than {settings.bucket_max_objects} objects to ingest",
+        )
+
+    ingested_documents = []
+    with closing(spool_objects(s3_client, keys, settings)) as batches:
+        for files in batches:
+            ingested_documents.extend(service.bulk_ingest(files))
+    return IngestResponse(object="list", model="private-gpt", data=ingested_documents)
+
+
+@router.post(
+    "/ingest/jobs",
+    tags=["Ingestion"],
+    status_code=status.HTTP_202_ACCEPTED,
+    openapi_extra=_files_body("file"),
+)
+async def submit_ingest_job(
+    request: Request,
+    service: Annotated[IngestJobService, Depends(get_ingest_job_service)],
+) -> IngestJob:
+    """Queue the ingestion of a file and return the job tracking it.
+
+    The file is processed in the background, the same way as `/ingest` does.
+    Use `GET /ingest/jobs/{job_id}` to follow the job; once it has succeeded,
+    its `data` holds the ingested Documents.
+
+    A 429 is returned when too many jobs are already pending.
+    """
+    async with receive_uploads(request, "file", max_files=1, delete=False) as files:
+        try:
+            return await run_in_threadpool(service.submit, files)
+        except IngestQueueFullError as e:
+            for _, file_path in files:
+                file_path.unlink(missing_ok=True)
+            raise HTTPException(status.HTTP_429_TOO_MANY_REQUESTS, str(e))
+
+
+@router.get("/ingest/jobs/{job_id}", tags=["Ingestion"])
+def get_ingest_job(
+    job_id: str,
+    service: Annotated[IngestJobService, Depends(get_ingest_job_service)],
+) -> IngestJob:
+    """Get the status, stage timings and, once done, the result of a job."""
+    job = service.get(job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Job not found")
+    return job
+
+
+@router.post("/ingest/jobs/{job_id}/cancel", tags=["Ingestion"])
+def cancel_ingest_job(
+    job_id: str,
+    service: Annotated[IngestJobService, Depends(get_ingest_job_service)],
+) -> IngestJob:
+    """Cancel a queued or running job.
+
+    A running job stops before its next stage. A job that is already writing
+    to the index runs to completion.
+    """
+    job = service.cancel(job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Job not found")
+    return job
+
+
 @router.get("/ingest/list", tags=["Ingestion"])
 def list_ingested(
     service: Annotated[IngestService, Depends(get_ingest_service)],
@@ -0,0 +1,173 @@
+"""Measure the recall and the latency of the Milvus vector indexes.
+
+Builds each index type on the same vectors, in a temporary collection, and
+runs the same queries with each set of search parameters. The recall@k is
+measured against an exact search in NumPy, and the latency of one query at
+a time, as the retrieval of a request does.
+
+The vectors default to random ones. Pass the embeddings of your corpus, as a
+`.npy` matrix, for a recall closer to production:
+
+    python -m benchmarks.milvus_index --vectors embeddings.npy --top-k 10
+
+Run from the `server` directory, with Milvus reachable at `MILVUS_URI`.
+"""
+import argparse
+import statistics
+import time
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+from pymilvus import DataType, MilvusClient
+
+from app.config.settings import get_milvus_settings
+
+COLLECTION_NAME = "benchmarkIndexes"
+INSERT_BATCH_SIZE = 1000
+
+# Index type, build parameters, then the search parameters to try on it
+CONFIGURATIONS: list[tuple[str, dict[str, Any], list[dict[str, Any]]]] = [
+    ("FLAT", {}, [{}]),
+    ("IVF_FLAT", {"nlist": 128}, [{"nprobe": 8}, {"nprobe": 16}, {"nprobe": 32}]),
+    ("IVF_SQ8", {"nlist": 128}, [{"nprobe": 16}, {"nprobe": 32}]),
+    # m must divide the dimension, 48 fits the 384 of the default model
+    ("IVF_PQ", {"nlist": 128, "m": 48, "nbits": 8}, [{"nprobe": 16}, {"nprobe": 32}]),
+    (
+        "HNSW",
+        {"M": 16, "efConstruction": 200},
+        [{"ef": 16}, {"ef": 32}, {"ef": 64}, {"ef": 128}],
+    ),
+]
+
+
+def _normalize(vectors: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _load_vectors(args: argparse.Namespace) -> npt.NDArray[np.float32]:
+    if args.vectors:
+        return _normalize(np.load(args.vectors).astype(np.float32))
+    rng = np.random.default_rng(0)
+    return _normalize(rng.standard_normal((args.count, args.dim), dtype=np.float32))
+
+
+def _exact_top_k(
+    vectors: npt.NDArray[np.float32], queries: npt.NDArray[np.float32], top_k: int
+) -> list[set[int]]:
+    scores = queries @ vectors.T
+    top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    return [set(row.tolist()) for row in top]
+
+
+def _percentile(timings: list[float], percentile: float) -> float:
+    return sorted(timings)[min(len(timings) - 1, int(len(timings) * percentile))]
+
+
+def _create_collection(
+    client: MilvusClient,
+    vectors: npt.NDArray[np.float32],
+    index_type: str,
+    index_params: dict[str, Any],
+) -> None:
+    if COLLECTION_NAME in client.list_collections():
+        client.drop_collection(COLLECTION_NAME)
+    schema = MilvusClient.create_schema()
+    schema.add_field("id", DataType.INT64, is_primary=True)
+    schema.add_field("embedding", DataType.FLOAT_VECTOR, dim=vectors.shape[1])
+    conn = client._get_connection()
+    conn.create_collection(COLLECTION_NAME, schema, consistency_level="Strong")
+    for start in range(0, len(vectors), INSERT_BATCH_SIZE):
+        batch = vectors[start : start + INSERT_BATCH_SIZE]
+        client.insert(
+            COLLECTION_NAME,
+            [
+                {"id": start + i, "embedding": vector.tolist()}
+                for i, vector in enumerate(batch)
+            ],
+        )
+    # The index is built on the sealed segments
+    conn.flush([COLLECTION_NAME])
+    conn.create_index(
+        COLLECTION_NAME,
+        "embedding",
+        {"metric_type": "IP", "index_type": index_type, "params": index_params},
+    )
+    client._load(COLLECTION_NAME)
+
+
+def _measure(
+    client: MilvusClient,
+    queries: npt.NDArray[np.float32],
+    truth: list[set[int]],
+    top_k: int,
+    search_params: dict[str, Any],
+) -> tuple[float, list[float]]:
+    def search(query: npt.NDArray[np.float32]) -> list[dict]:
+        return client.search(
+            COLLECTION_NAME,
+            [query.tolist()],
+            limit=top_k,
+            search_params={"metric_type": "IP", "params": search_params},
+        )[0]
+
+    for query in queries[: min(20, len(queries))]:
+        search(query)
+    recalls = []
+    timings = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        hits = search(query)
+        timings.append((time.perf_counter() - start) * 1000)
+        recalls.append(len({hit["id"] for hit in hits} & expected) / top_k)
+    return statistics.mean(recalls), timings
+
+
+def main() -> None:
+    settings = get_milvus_settings()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uri", default=str(settings.uri))
+    parser.add_argument("--token", default=settings.token)
+    parser.add_argument("--vectors", help="A .npy matrix of embeddings")
+    parser.add_argument("--count", type=int, default=20_000)
+    parser.add_argument("--dim", type=int, default=settings.dim)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    vectors = _load_vectors(args)
+    # Queries close to, but not exactly, vectors of the corpus
+    rng = np.random.default_rng(1)
+    picked = vectors[rng.choice(len(vectors), args.queries, replace=False)]
+    queries = _normalize(
+        picked + 0.1 * rng.standard_normal(picked.shape, dtype=np.float32)
+    )
+    truth = _exact_top_k(vectors, queries, args.top_k)
+
+    client = MilvusClient(uri=args.uri, token=args.token)
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions, top {args.top_k}")
+    try:
+        for index_type, index_params, all_search_params in CONFIGURATIONS:
+            start = time.perf_counter()
+            _create_collection(client, vectors, index_type, index_params)
+            print(
+                f"{index_type} {index_params}: "
+                f"built in {time.perf_counter() - start:.1f}s"
+            )
+            for search_params in all_search_params:
+                recall, timings = _measure(
+                    client, queries, truth, args.top_k, search_params
+                )
+                print(
+                    f"  {str(search_params):<16} recall@{args.top_k}={recall:.3f} "
+                    f"p50={_percentile(timings, 0.5):.2f}ms "
+                    f"p99={_percentile(timings, 0.99):.2f}ms"
+                )
+    finally:
+        if COLLECTION_NAME in client.list_collections():
+            client.drop_collection(COLLECTION_NAME)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Measure the cost of setting up the retrieval on every request.
+
+Compares building the index (chunks) and the retriever (chunks and chat) on
+each request, as the services used to, with sharing them between requests. The vector
+store is an in-memory stand-in returning fixed nodes, so only the setup cost
+is measured, not the search itself.
+
+Run from the `server` directory:
+
+    python -m benchmarks.retrieval_setup --requests 2000
+"""
+import argparse
+import statistics
+import time
+from typing import Any, Callable
+
+from llama_index import MockEmbedding, ServiceContext, VectorStoreIndex
+from llama_index.chat_engine import ContextChatEngine
+from llama_index.llms import MockLLM
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import (
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from app.dependencies.base import ContextFilter
+from app.dependencies.components.vector_store import (
+    VectorStoreComponent,
+    retrieval_options,
+)
+
+
+class FixedVectorStore(VectorStore):
+    stores_text: bool = True
+
+    def __init__(self, count_nodes: int = 10) -> None:
+        self.nodes = [TextNode(text=f"chunk {i}") for i in range(count_nodes)]
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def add(self, nodes: list[Any], **add_kwargs: Any) -> list[str]:
+        return []
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        pass
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        nodes = self.nodes[: query.similarity_top_k]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=[1.0] * len(nodes),
+            ids=[node.node_id for node in nodes],
+        )
+
+
+def _percentile(timings: list[float], percentile: float) -> float:
+    return sorted(timings)[min(len(timings) - 1, int(len(timings) * percentile))]
+
+
+def _measure(name: str, request: Callable[[], None], count_requests: int) -> None:
+    for _ in range(min(100, count_requests)):
+        request()
+    timings = []
+    for _ in range(count_requests):
+        start = time.perf_counter()
+        request()
+        timings.append((time.perf_counter() - start) * 1000)
+    print(
+        f"{name:<26} mean={statistics.mean(timings):.3f}ms "
+        f"p50={_percentile(timings, 0.5):.3f}ms p99={_percentile(timings, 0.99):.3f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    vector_store = FixedVectorStore()
+    service_context = ServiceContext.from_defaults(
+        llm=MockLLM(), embed_model=MockEmbedding(embed_dim=384)
+    )
+    context_filter = ContextFilter(docs_ids=["a-document"])
+    question = "What were the sales in Q3?"
+
+    def chunks_per_request() -> None:
+        index = VectorStoreIndex.from_vector_store(
+            vector_store, service_context=service_context
+        )
+        retriever = VectorStoreComponent.get_retriever(
+            index, context_filter=context_filter, similarity_top_k=args.top_k
+        )
+        retriever.retrieve(question)
+
+    index = VectorStoreIndex.from_vector_store(
+        vector_store, service_context=service_context
+    )
+
+    def chat_per_request() -> None:
+        # The chat service already kept its index
+        retriever = VectorStoreComponent.get_retriever(
+            index, context_filter=context_filter
+        )
+        ContextChatEngine.from_defaults(
+            retriever=retriever, service_context=service_context
+        )._generate_context(question)
+
+    retriever = VectorStoreComponent.get_retriever(index)
+
+    def chunks_shared() -> None:
+        with retrieval_options(context_filter, similarity_top_k=args.top_k):
+            retriever.retrieve(question)
+
+    def chat_shared() -> None:
+        engine = ContextChatEngine.from_defaults(
+            retriever=retriever, service_context=service_context
+        )
+        with retrieval_options(context_filter):
+            engine._generate_context(question)
+
+    _measure("chunks, per request", chunks_per_request, args.requests)
+    _measure("chunks, shared", chunks_shared, args.requests)
+    _measure("chat context, per request", chat_per_request, args.requests)
+    _measure("chat context, shared", chat_shared, args.requests)
+
+
+if __name__ == "__main__":
+    main()
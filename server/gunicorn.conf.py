@@ -0,0 +1,33 @@
+"""Gunicorn configuration of the production server.
+
+With `MODEL_SERVER_ENABLED`, the master starts the model server before the
+workers, so the models are loaded once instead of once per worker.
+"""
+import os
+import subprocess
+import sys
+
+bind = "0.0.0.0:80"
+workers = 4
+worker_class = "uvicorn.workers.UvicornWorker"
+
+model_server: subprocess.Popen | None = None
+
+
+def _model_server_enabled() -> bool:
+    # Not read with the settings, importing `app` would load it in the master
+    value = os.environ.get("MODEL_SERVER_ENABLED", "false")
+    return value.lower() in {"1", "true", "yes", "on"}
+
+
+def on_starting(server) -> None:
+    global model_server
+    if _model_server_enabled():
+        server.log.info("Starting the model server")
+        model_server = subprocess.Popen([sys.executable, "-m", "app.model_server"])
+
+
+def on_exit(server) -> None:
+    if model_server is not None:
+        model_server.terminate()
+        model_server.wait()
@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+import pytest
+from llama_index.chat_engine.context import DEFAULT_CONTEXT_TEMPLATE
+from llama_index.llms import ChatMessage, MessageRole, MockLLM
+from llama_index.schema import NodeWithScore, TextNode
+
+from app.config.settings import AppSettings, LLMSettings
+from app.dependencies.components.llm import LLMComponent
+from app.dependencies.components.llm_scheduler import LLMBusyError
+from app.dependencies.services.chat import ChatService
+
+
+def _chat_service(prepared: list[bool], fail: bool = False) -> ChatService:
+    llm_component = LLMComponent(
+        AppSettings(fastapi_env="testing"),
+        LLMSettings(concurrent_generations=1, max_queue=0),
+    )
+    llm_component.llm = MockLLM(max_tokens=2)
+    service = ChatService.__new__(ChatService)
+    service.llm_service = llm_component
+
+    async def aprepare_chat(messages, use_context, context_filter):
+        prepared.append(True)
+        if fail:
+            raise RuntimeError("retrieval failed")
+        return messages, []
+
+    service._aprepare_chat = aprepare_chat  # type: ignore[method-assign]
+    return service
+
+
+@pytest.mark.anyio
+async def test_a_busy_server_rejects_the_chat_before_the_retrieval():
+    prepared: list[bool] = []
+    service = _chat_service(prepared)
+    acquired = await service.llm_service.scheduler.acquire("alice")
+
+    with pytest.raises(LLMBusyError):
+        await service.astream_chat([ChatMessage(content="Hello")], user="bob")
+    with pytest.raises(LLMBusyError):
+        await service.achat([ChatMessage(content="Hello")], user="bob")
+
+    assert prepared == []
+    service.llm_service.scheduler.release(acquired)
+
+
+@pytest.mark.anyio
+async def test_a_failed_retrieval_gives_back_the_place_of_the_chat():
+    prepared: list[bool] = []
+    service = _chat_service(prepared, fail=True)
+
+    with pytest.raises(RuntimeError):
+        await service.astream_chat([ChatMessage(content="Hello")], user="bob")
+    with pytest.raises(RuntimeError):
+        await service.achat([ChatMessage(content="Hello")], user="bob")
+
+    assert prepared == [True, True]
+    assert service.llm_service.scheduler.stats()["queued"] == 0
+
+
+def test_llm_messages_put_the_context_in_the_system_message():
+    nodes = [
+        NodeWithScore(node=TextNode(text="Sales went up. "), score=1.0),
+        NodeWithScore(node=TextNode(text="The pump failed."), score=0.5),
+    ]
+    retrieved: list[str] = []
+    service = ChatService.__new__(ChatService)
+    service.llm_service = SimpleNamespace(llm=MockLLM())
+    service.retriever = SimpleNamespace(
+        retrieve=lambda message: retrieved.append(message) or nodes
+    )
+    service.node_postprocessors = []
+    service.context_template = DEFAULT_CONTEXT_TEMPLATE
+    history = [
+        ChatMessage(content="Hi", role=MessageRole.USER),
+        ChatMessage(content="Hello", role=MessageRole.ASSISTANT),
+    ]
+
+    messages, context_nodes = service._llm_messages(
+        "What failed?", " Be brief. ", list(history), use_context=True
+    )
+
+    assert retrieved == ["What failed?"]
+    assert context_nodes == nodes
+    assert messages == [
+        ChatMessage(
+            content=DEFAULT_CONTEXT_TEMPLATE.format(
+                context_str="Sales went up.\n\nThe pump failed."
+            )
+            + "Be brief.",
+            role=MessageRole.SYSTEM,
+        ),
+        *history,
+        ChatMessage(content="What failed?", role=MessageRole.USER),
+    ]
+
+    messages, context_nodes = service._llm_messages(
+        "Hi", "Be brief.", None, use_context=False
+    )
+
+    assert context_nodes == []
+    assert [message.role for message in messages] == [
+        MessageRole.SYSTEM,
+        MessageRole.USER,
+    ]
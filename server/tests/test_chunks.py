@@ -0,0 +1,131 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+from llama_index.llms import MockLLM
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.storage.docstore import SimpleDocumentStore
+from llama_index.storage.index_store import SimpleIndexStore
+
+from app.dependencies.components.mmap_vector_store import MmapVectorStore
+from app.dependencies.components.vector_store import SharedVectorIndexRetriever
+from app.dependencies.services.chunks import ChunksService, get_chunks_service
+from app.routes.chunks import router
+
+
+class KeywordEmbedding(BaseEmbedding):
+    """Counts of a few keywords, so the scores are predictable."""
+
+    def _embed(self, text: str) -> Embedding:
+        words = text.lower().split()
+        return [float(words.count("sales")), float(words.count("pump")), 1.0]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed(text)
+
+
+def _nodes(texts: list[str]) -> list[TextNode]:
+    nodes = [
+        TextNode(
+            id_=f"n{i}",
+            text=text,
+            metadata={"file_name": "report.txt"},
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id="doc")},
+        )
+        for i, text in enumerate(texts)
+    ]
+    for previous, node in zip(nodes, nodes[1:]):
+        previous.relationships[NodeRelationship.NEXT] = RelatedNodeInfo(
+            node_id=node.node_id
+        )
+        node.relationships[NodeRelationship.PREVIOUS] = RelatedNodeInfo(
+            node_id=previous.node_id
+        )
+    return nodes
+
+
+@pytest.fixture
+def client(tmp_path: Path) -> TestClient:
+    embed_model = KeywordEmbedding()
+    nodes = _nodes(
+        [
+            "Sales report 2023",
+            "Sales and sales leads increased",
+            "Pump maintenance",
+        ]
+    )
+    for node in nodes:
+        node.embedding = embed_model.get_text_embedding(node.get_content())
+    vector_store = MmapVectorStore(tmp_path)
+    vector_store.add(nodes)
+    doc_store = SimpleDocumentStore()
+    doc_store.add_documents(nodes)
+
+    service = ChunksService(
+        llm_component=SimpleNamespace(llm=MockLLM()),
+        vector_store_component=SimpleNamespace(
+            vector_store=vector_store,
+            get_retriever=lambda **kwargs: SharedVectorIndexRetriever(**kwargs),
+        ),
+        embedding_component=SimpleNamespace(query_embedding_model=embed_model),
+        node_store_component=SimpleNamespace(
+            doc_store=doc_store, index_store=SimpleIndexStore()
+        ),
+        retrieval_cache=None,
+        sparse_index=None,
+    )
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[get_chunks_service] = lambda: service
+    return TestClient(app)
+
+
+def test_chunks_are_returned_in_the_order_of_the_texts(client: TestClient):
+    response = client.post(
+        "/api/v1/chunks",
+        json={"texts": ["pump", "sales"], "limit": 2, "prev_next_chunks": 1},
+    )
+
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert [(query["index"], query["text"]) for query in data] == [
+        (0, "pump"),
+        (1, "sales"),
+    ]
+    pump, sales = data[0]["chunks"], data[1]["chunks"]
+    assert pump[0]["text"] == "Pump maintenance"
+    assert pump[0]["previous_texts"] == ["Sales and sales leads increased"]
+    assert pump[0]["next_texts"] == []
+    assert [chunk["text"] for chunk in sales] == [
+        "Sales and sales leads increased",
+        "Sales report 2023",
+    ]
+    assert sales[0]["score"] > sales[1]["score"]
+    assert sales[0]["previous_texts"] == ["Sales report 2023"]
+    assert sales[0]["next_texts"] == ["Pump maintenance"]
+    assert sales[1]["previous_texts"] == []
+    assert sales[0]["document"]["doc_id"] == "doc"
+
+
+def test_chunks_request_is_bounded(client: TestClient):
+    assert client.post("/api/v1/chunks", json={"texts": []}).status_code == 422
+    assert client.post("/api/v1/chunks", json={"texts": ["a"] * 65}).status_code == 422
+    assert (
+        client.post("/api/v1/chunks", json={"texts": ["a"], "limit": 101}).status_code
+        == 422
+    )
+    assert (
+        client.post(
+            "/api/v1/chunks", json={"texts": ["a"], "prev_next_chunks": 11}
+        ).status_code
+        == 422
+    )
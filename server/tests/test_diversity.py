@@ -0,0 +1,38 @@
+from llama_index import MockEmbedding
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+
+from app.config.settings import RetrievalSettings
+from app.dependencies.components.diversity import DiversityPostProcessor, mmr_select
+
+
+def test_mmr_select_prefers_novel_rows_and_drops_near_duplicates():
+    query = [1.0, 0.0, 0.0]
+    embeddings = [
+        [1.0, 0.1, 0.0],
+        [1.0, 0.1, 0.001],  # near duplicate of the first one
+        [0.9, 0.0, 0.5],
+        [0.0, 0.0, 1.0],
+    ]
+
+    assert mmr_select(query, embeddings, mmr_lambda=0.5) == [0, 2, 3]
+    assert mmr_select(query, embeddings, mmr_lambda=1.0, top_n=2) == [0, 2]
+    assert mmr_select(query, embeddings, duplicate_threshold=1.1) == [0, 1, 2, 3]
+    assert mmr_select(query, []) == []
+
+
+def test_diversity_post_processor_embeds_the_nodes_without_embedding():
+    nodes = [
+        NodeWithScore(node=TextNode(text="a", embedding=[1.0, 0.0]), score=1.0),
+        NodeWithScore(node=TextNode(text="b", embedding=[1.0, 0.0]), score=0.9),
+        NodeWithScore(node=TextNode(text="c"), score=0.5),
+    ]
+    post_processor = DiversityPostProcessor(
+        MockEmbedding(embed_dim=2), RetrievalSettings()
+    )
+
+    result = post_processor.postprocess_nodes(
+        nodes, query_bundle=QueryBundle("q", embedding=[1.0, 0.0])
+    )
+
+    assert [n.node.get_content() for n in result] == ["a", "c"]
+    assert nodes[2].node.embedding == [0.5, 0.5]
@@ -0,0 +1,81 @@
+from llama_index import MockEmbedding
+
+from app.config.settings import CacheSettings
+from app.dependencies.components.embedding_cache import (
+    CachedQueryEmbedding,
+    EmbeddingCache,
+)
+
+
+class CountingEmbedding(MockEmbedding):
+    embedded_queries: int = 0
+
+    def _get_query_embedding(self, query: str) -> list[float]:
+        self.embedded_queries += 1
+        return super()._get_query_embedding(query)
+
+
+def test_cached_query_embedding_embeds_a_query_once():
+    embedding_model = CountingEmbedding(embed_dim=8)
+    cached = CachedQueryEmbedding(
+        embedding_model, EmbeddingCache("mock", CacheSettings())
+    )
+
+    first = cached.get_query_embedding("What were the sales?")
+    second = cached.get_query_embedding("  What were   the sales?\n")
+    cached.get_text_embedding("What were the sales?")
+
+    assert first == second
+    assert embedding_model.embedded_queries == 1
+    assert cached.cache.stats()["hits"] == 1
+    assert cached.cache.stats()["misses"] == 1
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = EmbeddingCache("mock", CacheSettings(embedding_max_entries=2))
+    cache.put("a", [1.0])
+    cache.put("b", [2.0])
+    cache.get("a")
+    cache.put("c", [3.0])
+
+    assert cache.get("a") == [1.0]
+    assert cache.get("b") is None
+    assert cache.get("c") == [3.0]
+
+
+def test_embedding_cache_bounds_bytes_and_expires():
+    cache = EmbeddingCache("mock", CacheSettings(embedding_max_bytes=3 * 8 * 2))
+    cache.put("a", [1.0, 2.0, 3.0])
+    cache.put("b", [1.0, 2.0, 3.0])
+    cache.put("c", [1.0, 2.0, 3.0])
+    assert cache.stats()["entries"] == 2
+    assert cache.get("a") is None
+
+    expired = EmbeddingCache("mock", CacheSettings(embedding_ttl=0))
+    expired.put("a", [1.0])
+    assert expired.get("a") is None
+
+
+class BatchEmbedding(MockEmbedding):
+    query_instruction: str | None = "Represent this sentence:"
+    batches: list[list[str]] = []
+
+    def _embed(self, sentences: list[str]) -> list[list[float]]:
+        self.batches.append(sentences)
+        return [[float(len(sentence))] for sentence in sentences]
+
+
+def test_cached_query_embedding_embeds_the_missing_queries_in_one_batch():
+    embedding_model = BatchEmbedding(embed_dim=1, batches=[])
+    cached = CachedQueryEmbedding(
+        embedding_model, EmbeddingCache("mock", CacheSettings())
+    )
+    cached.get_query_embedding_batch(["sales"])
+
+    embeddings = cached.get_query_embedding_batch(["sales", "leads", "ads"])
+
+    assert embedding_model.batches == [
+        ["Represent this sentence: sales"],
+        ["Represent this sentence: leads", "Represent this sentence: ads"],
+    ]
+    assert embeddings == [[30.0], [30.0], [28.0]]
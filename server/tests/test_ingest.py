@@ -0,0 +1,295 @@
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from llama_index import MockEmbedding, ServiceContext, StorageContext
+from llama_index.llms import MockLLM
+from llama_index.node_parser import SentenceSplitter
+from llama_index.schema import NodeRelationship
+from llama_index.storage.kvstore import SimpleKVStore
+
+from app.config.settings import IngestSettings
+from app.dependencies.components import ingest
+from app.dependencies.components.ingest import (
+    ParallelizedIngestComponent,
+    SimpleIngestComponent,
+)
+from app.dependencies.components.ingest_persist import IndexPersister
+from app.dependencies.components.ingest_scheduler import (
+    IngestScheduler,
+    parse_workers,
+    preemption_point,
+)
+from app.dependencies.components.sparse_index import SparseIndex
+
+
+class CountingEmbedding(MockEmbedding):
+    embedded_texts: int = 0
+
+    def _get_text_embeddings(self, texts: list[str]) -> list[list[float]]:
+        self.embedded_texts += len(texts)
+        return super()._get_text_embeddings(texts)
+
+
+@pytest.fixture
+def embed_model() -> CountingEmbedding:
+    return CountingEmbedding(embed_dim=8)
+
+
+@pytest.fixture
+def service_context(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, embed_model: CountingEmbedding
+) -> ServiceContext:
+    monkeypatch.setattr(ingest, "local_data_path", tmp_path / "index")
+    monkeypatch.setattr(ingest, "ingest_log_path", tmp_path / "ingest_log")
+    node_parser = SentenceSplitter(chunk_size=32, chunk_overlap=0)
+    return ServiceContext.from_defaults(
+        llm=MockLLM(),
+        embed_model=embed_model,
+        node_parser=node_parser,
+        transformations=[node_parser, embed_model],
+    )
+
+
+@pytest.fixture
+def component(service_context: ServiceContext) -> SimpleIngestComponent:
+    return SimpleIngestComponent(StorageContext.from_defaults(), service_context)
+
+
+def test_reingesting_unchanged_file_skips_embeddings(
+    tmp_path: Path, component: SimpleIngestComponent, embed_model: CountingEmbedding
+):
+    file_data = tmp_path / "report.txt"
+    file_data.write_text("The quarterly sales went up.")
+
+    first = component.ingest("report.txt", file_data)
+    embedded_texts = embed_model.embedded_texts
+    second = component.ingest("report.txt", file_data)
+
+    assert embedded_texts > 0
+    assert embed_model.embedded_texts == embedded_texts
+    assert [doc.doc_id for doc in second] == [doc.doc_id for doc in first]
+    assert second[0].metadata["file_name"] == "report.txt"
+
+
+def test_reingesting_changed_file_replaces_its_nodes(
+    tmp_path: Path, component: SimpleIngestComponent, embed_model: CountingEmbedding
+):
+    file_data = tmp_path / "report.txt"
+    file_data.write_text("The quarterly sales went up.")
+    other_file_data = tmp_path / "other.txt"
+    other_file_data.write_text("Unrelated notes.")
+    component.ingest("other.txt", other_file_data)
+    component.ingest("report.txt", file_data)
+    docstore = component.storage_context.docstore
+    count_nodes = len(docstore.docs)
+
+    file_data.write_text("The quarterly sales went down.")
+    embedded_texts = embed_model.embedded_texts
+    documents = component.bulk_ingest(
+        [("other.txt", other_file_data), ("report.txt", file_data)]
+    )
+
+    # Only the changed file is embedded again, and its old nodes are gone
+    assert embed_model.embedded_texts == embedded_texts + 1
+    assert len(docstore.docs) == count_nodes
+    assert {doc.metadata["file_name"] for doc in documents} == {
+        "other.txt",
+        "report.txt",
+    }
+    texts = [node.get_content() for node in docstore.docs.values()]
+    assert "The quarterly sales went down." in texts
+    assert "The quarterly sales went up." not in texts
+
+
+def test_reingesting_changed_file_only_embeds_changed_chunks(
+    tmp_path: Path, component: SimpleIngestComponent, embed_model: CountingEmbedding
+):
+    paragraphs = [
+        f"Chapter {i} talks about topic number {i}, " + "in great detail. " * 8
+        for i in range(6)
+    ]
+    file_data = tmp_path / "manual.txt"
+    file_data.write_text("\n\n".join(paragraphs))
+    component.ingest("manual.txt", file_data)
+    docstore = component.storage_context.docstore
+    count_nodes = len(docstore.docs)
+
+    paragraphs[2] = "Chapter 2 was rewritten entirely, " + "in less detail. " * 8
+    file_data.write_text("\n\n".join(paragraphs))
+    embedded_texts = embed_model.embedded_texts
+    (document,) = component.ingest("manual.txt", file_data)
+
+    assert count_nodes > 2
+    assert 0 < embed_model.embedded_texts - embedded_texts < count_nodes
+    node_ids = docstore.get_ref_doc_info(document.doc_id).node_ids
+    assert len(node_ids) == len(docstore.docs) == count_nodes
+    assert len(component.storage_context.vector_store._data.embedding_dict) == len(
+        node_ids
+    )
+    # The kept nodes are linked to the new one
+    nodes = docstore.get_nodes(node_ids)
+    for previous_node, next_node in zip(nodes, nodes[1:]):
+        assert previous_node.relationships[NodeRelationship.NEXT].node_id == (
+            next_node.node_id
+        )
+        assert next_node.relationships[NodeRelationship.PREVIOUS].node_id == (
+            previous_node.node_id
+        )
+    assert "rewritten" in " ".join(node.get_content() for node in nodes)
+
+
+def test_changes_invalidate_the_retrieval_cache(
+    tmp_path: Path, service_context: ServiceContext
+):
+    retrieval_cache = SimpleNamespace(count_invalidations=0)
+
+    def invalidate() -> None:
+        retrieval_cache.count_invalidations += 1
+
+    retrieval_cache.invalidate = invalidate
+    component = SimpleIngestComponent(
+        StorageContext.from_defaults(),
+        service_context,
+        retrieval_cache=retrieval_cache,
+    )
+    file_data = tmp_path / "report.txt"
+    file_data.write_text("Sales increased.")
+
+    documents = component.ingest("report.txt", file_data)
+    component.delete(documents[0].doc_id)
+
+    assert retrieval_cache.count_invalidations == 2
+
+
+def test_changes_are_indexed_in_the_sparse_index(
+    tmp_path: Path, service_context: ServiceContext
+):
+    sparse_index = SparseIndex(SimpleKVStore())
+    component = SimpleIngestComponent(
+        StorageContext.from_defaults(), service_context, sparse_index=sparse_index
+    )
+    file_data = tmp_path / "report.txt"
+    file_data.write_text("The pump failed with ERR-404.")
+
+    documents = component.ingest("report.txt", file_data)
+    node_ids = [node_id for node_id, _ in sparse_index.query("ERR-404", 5)]
+    assert node_ids == list(component._index.index_struct.nodes_dict.values())
+
+    component.delete(documents[0].doc_id)
+    assert sparse_index.query("ERR-404", 5) == []
+    assert sparse_index.count_nodes() == 0
+
+
+def test_parallel_bulk_ingest_pipeline(
+    tmp_path: Path, service_context: ServiceContext, embed_model: CountingEmbedding
+):
+    component = ParallelizedIngestComponent(
+        StorageContext.from_defaults(),
+        service_context,
+        count_workers=2,
+        queue_size=1,
+        embed_batch_size=8,
+    )
+    files = []
+    for i in range(6):
+        file_data = tmp_path / f"{i}.txt"
+        file_data.write_text(f"File {i} is about topic {i}. " * 10)
+        files.append((file_data.name, file_data))
+
+    documents = component.bulk_ingest(files)
+    embedded_texts = embed_model.embedded_texts
+    reingested_documents = component.bulk_ingest(files)
+
+    assert sorted(doc.metadata["file_name"] for doc in documents) == [
+        f"{i}.txt" for i in range(6)
+    ]
+    assert len(component.storage_context.docstore.docs) == embedded_texts
+    assert embed_model.embedded_texts == embedded_texts
+    assert len(reingested_documents) == len(documents)
+
+
+def test_logged_changes_are_replayed_after_a_crash(
+    tmp_path: Path, service_context: ServiceContext, embed_model: CountingEmbedding
+):
+    settings = IngestSettings(persist_every=100, persist_interval=0)
+    component = SimpleIngestComponent(
+        StorageContext.from_defaults(), service_context, ingest_settings=settings
+    )
+    file_data = tmp_path / "report.txt"
+    file_data.write_text("The quarterly sales went up.")
+    component.ingest("report.txt", file_data)
+    embedded_texts = embed_model.embedded_texts
+    nodes = component.storage_context.docstore.docs
+    # Crash before the index is persisted, releasing the lock of the log
+    component._persister._log_file.close()
+
+    restarted = SimpleIngestComponent(
+        StorageContext.from_defaults(), service_context, ingest_settings=settings
+    )
+
+    assert restarted.storage_context.docstore.docs.keys() == nodes.keys()
+    assert len(restarted.storage_context.vector_store._data.embedding_dict) == len(
+        nodes
+    )
+    # The replayed changes are persisted, and the crashed process log is gone
+    assert list((tmp_path / "ingest_log").glob("*.jsonl")) == [
+        Path(restarted._persister._log_file.name)
+    ]
+    assert embed_model.embedded_texts == embedded_texts
+    restarted.close()
+    assert list((tmp_path / "ingest_log").glob("*.jsonl")) == []
+
+
+def test_orphan_logs_stay_locked_until_persisted(tmp_path: Path):
+    settings = IngestSettings(persist_interval=0)
+    (tmp_path / "crashed.jsonl").write_text('{"op": "delete"}\n')
+    persister = IndexPersister(lambda: None, threading.Lock(), settings, tmp_path)
+    other = IndexPersister(lambda: None, threading.Lock(), settings, tmp_path)
+
+    assert list(persister.orphan_records()) == [{"op": "delete"}]
+    # Not replayed twice while the first replay is not persisted
+    assert list(other.orphan_records()) == []
+
+    persister.persist()
+    assert not (tmp_path / "crashed.jsonl").exists()
+    persister.close()
+    other.close()
+
+
+def test_bulk_ingestion_yields_to_interactive_ones():
+    scheduler = IngestScheduler(IngestSettings(bulk_max_pause=5))
+    events = []
+
+    def bulk_work() -> None:
+        with scheduler.bulk():
+            events.append("bulk batch 1")
+            interactive_started.wait()
+            preemption_point()
+            events.append("bulk batch 2")
+
+    interactive_started = threading.Event()
+    bulk = threading.Thread(target=bulk_work)
+    bulk.start()
+    with scheduler.interactive():
+        interactive_started.set()
+        time.sleep(0.2)
+        events.append("interactive")
+    bulk.join()
+
+    assert events == ["bulk batch 1", "interactive", "bulk batch 2"]
+    assert parse_workers(4) == 4
+
+
+def test_bulk_ingestion_pauses_at_most_bulk_max_pause():
+    scheduler = IngestScheduler(IngestSettings(bulk_max_pause=0.1, bulk_workers=2))
+
+    with scheduler.interactive():
+        with scheduler.bulk():
+            assert parse_workers(4) == 2
+            start = time.perf_counter()
+            preemption_point()
+
+    assert time.perf_counter() - start < 1
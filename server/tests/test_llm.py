@@ -0,0 +1,74 @@
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from llama_index.llms import ChatMessage, MockLLM
+
+from app.config.settings import AppSettings, LLMSettings
+from app.dependencies.components.llm import LLMComponent, iterate_in_executor
+
+
+@pytest.mark.anyio
+async def test_iterate_in_executor_yields_the_items_and_closes_the_iterator():
+    closed = []
+
+    def tokens() -> Iterator[str]:
+        try:
+            yield from ["Hello", " ", "world"]
+        finally:
+            closed.append(True)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert [t async for t in iterate_in_executor(tokens(), executor)] == [
+            "Hello",
+            " ",
+            "world",
+        ]
+
+        stream = iterate_in_executor(tokens(), executor)
+        assert await stream.__anext__() == "Hello"
+        await stream.aclose()
+
+    assert closed == [True, True]
+
+
+@pytest.mark.anyio
+async def test_closing_a_chat_stream_records_the_aborted_generation():
+    component = LLMComponent(
+        AppSettings(fastapi_env="testing"), LLMSettings(generation_workers=1)
+    )
+    component.llm = MockLLM(max_tokens=10)
+    messages = [ChatMessage(content="Hello")]
+
+    assert len([delta async for delta in component.astream_chat(messages)]) == 10
+    assert component.generation_stats.stats()["aborted"] == 0
+
+    stream = component.astream_chat(messages)
+    for _ in range(3):
+        assert await stream.__anext__() == "text "
+    await stream.aclose()
+
+    assert component.generation_stats.stats() == {
+        "aborted": 1,
+        "tokens_generated": 3,
+        "tokens_saved": 7,
+    }
+
+
+@pytest.mark.anyio
+async def test_an_admitted_stream_gives_back_its_place_when_not_started():
+    component = LLMComponent(
+        AppSettings(fastapi_env="testing"),
+        LLMSettings(concurrent_generations=1, max_queue=0),
+    )
+    component.llm = MockLLM(max_tokens=2)
+    messages = [ChatMessage(content="Hello")]
+
+    stream = component.astream_chat(messages, "alice", component.scheduler.admit())
+    assert component.scheduler.stats()["queued"] == 1
+    await stream.aclose()
+    assert component.scheduler.stats()["queued"] == 0
+
+    stream = component.astream_chat(messages, "alice", component.scheduler.admit())
+    assert [delta async for delta in stream] == ["text ", "text "]
+    assert component.scheduler.stats()["queued"] == 0
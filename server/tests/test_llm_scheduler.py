@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from app.config.settings import LLMSettings
+from app.dependencies.components.llm_scheduler import LLMBusyError, LLMScheduler
+
+
+async def _generate(scheduler: LLMScheduler, user: str, served: list[str]) -> None:
+    admission = scheduler.admit()
+    acquired = await scheduler.acquire(user, admission)
+    served.append(user)
+    scheduler.release(acquired)
+
+
+@pytest.mark.anyio
+async def test_scheduler_serves_the_users_in_turn():
+    scheduler = LLMScheduler(LLMSettings(concurrent_generations=1))
+    acquired = await scheduler.acquire("first")
+    served: list[str] = []
+    tasks = [
+        asyncio.create_task(_generate(scheduler, user, served))
+        for user in ["alice", "alice", "alice", "bob", "carol"]
+    ]
+    await asyncio.sleep(0)
+    assert scheduler.stats()["queued"] == 5
+
+    scheduler.release(acquired)
+    await asyncio.gather(*tasks)
+
+    assert served == ["alice", "bob", "carol", "alice", "alice"]
+    assert scheduler.stats()["running"] == 0
+
+
+@pytest.mark.anyio
+async def test_scheduler_rejects_when_its_queue_is_full():
+    scheduler = LLMScheduler(LLMSettings(concurrent_generations=1, max_queue=1))
+    acquired = await scheduler.acquire("alice")
+    waiting = asyncio.create_task(scheduler.acquire("bob"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(LLMBusyError) as error:
+        scheduler.admit()
+    assert error.value.retry_after >= 1
+    assert scheduler.stats()["rejected"] == 1
+
+    # A request cancelled while queued gives its place back
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    scheduler.admit().cancel()
+    scheduler.release(acquired)
+    assert scheduler.stats()["running"] == 0
+
+
+@pytest.mark.anyio
+async def test_scheduler_counts_the_admitted_requests_as_queued():
+    scheduler = LLMScheduler(LLMSettings(concurrent_generations=1, max_queue=1))
+    first = scheduler.admit()
+    second = scheduler.admit()
+    assert scheduler.stats()["queued"] == 2
+    with pytest.raises(LLMBusyError):
+        scheduler.admit()
+
+    # A request not started gives its place back
+    second.cancel()
+    second.cancel()
+    acquired = await scheduler.acquire("alice", first)
+    assert scheduler.stats()["queued"] == 0
+    scheduler.admit()
+    with pytest.raises(LLMBusyError):
+        scheduler.admit()
+    scheduler.release(acquired)
@@ -0,0 +1,103 @@
+import numpy as np
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from app.dependencies.base import ContextFilter
+from app.dependencies.components.mmap_vector_store import MmapVectorStore
+
+
+def _node(node_id: str, embedding: list[float], doc_id: str = "doc") -> TextNode:
+    return TextNode(
+        id_=node_id,
+        text=f"text of {node_id}",
+        embedding=embedding,
+        metadata={"file_name": f"{doc_id}.pdf"},
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc_id)},
+    )
+
+
+def _ids(store: MmapVectorStore, embedding: list[float], top_k: int = 10, **kwargs):
+    query = VectorStoreQuery(query_embedding=embedding, similarity_top_k=top_k)
+    return store.query(query, **kwargs).ids
+
+
+def test_mmap_vector_store_searches_filters_and_deletes(tmp_path):
+    store = MmapVectorStore(tmp_path)
+    store.add(
+        [
+            _node("a", [1.0, 0.0], "doc1"),
+            _node("b", [0.8, 0.6], "doc1"),
+            _node("c", [0.0, 1.0], "doc2"),
+        ]
+    )
+
+    result = store.query(
+        VectorStoreQuery(query_embedding=[1.0, 0.0], similarity_top_k=2)
+    )
+    assert result.ids == ["a", "b"]
+    assert result.similarities == [1.0, 0.800000011920929]
+    assert result.nodes[0].get_content() == "text of a"
+    assert result.nodes[0].ref_doc_id == "doc1"
+    assert _ids(store, [1.0, 0.0], context_filter=ContextFilter(docs_ids=["doc2"])) == [
+        "c"
+    ]
+    assert _ids(
+        store, [1.0, 0.0], context_filter=ContextFilter(file_names=["doc1.pdf"])
+    ) == ["a", "b"]
+
+    # Adding a node again replaces it
+    store.add([_node("a", [0.0, 1.0], "doc1")])
+    doc1 = ContextFilter(docs_ids=["doc1"])
+    assert _ids(store, [0.0, 1.0], context_filter=doc1) == ["a", "b"]
+    store.delete("doc2")
+    store.delete_nodes(["b"])
+    assert _ids(store, [1.0, 0.0]) == ["a"]
+
+
+def test_mmap_vector_store_is_shared_through_its_files(tmp_path):
+    writer = MmapVectorStore(tmp_path, dtype="float16")
+    reader = MmapVectorStore(tmp_path, dtype="float16")
+    writer.add([_node("a", [1.0, 0.0]), _node("b", [0.0, 1.0])])
+
+    assert _ids(reader, [0.0, 1.0], top_k=1) == ["b"]
+    writer.delete_nodes(["b"])
+    assert _ids(reader, [0.0, 1.0]) == ["a"]
+    assert _ids(MmapVectorStore(tmp_path), [0.0, 1.0]) == ["a"]
+
+
+def test_mmap_vector_store_compacts_the_deleted_rows(tmp_path):
+    store = MmapVectorStore(tmp_path, compact_dead_fraction=0.5)
+    reader = MmapVectorStore(tmp_path)
+    store.add([_node(name, [1.0, i / 10]) for i, name in enumerate("abcd")])
+    store.delete_nodes(["a", "b"])
+    store.persist("")
+    assert (tmp_path / "rows.jsonl").exists()
+
+    store.add([_node("c", [0.0, 1.0])])
+    store.persist("")
+
+    assert not (tmp_path / "rows.jsonl").exists()
+    assert len(store._ids) == 2
+    assert _ids(store, [0.0, 1.0]) == ["c", "d"]
+    assert _ids(reader, [0.0, 1.0]) == ["c", "d"]
+    assert reader._epoch == 1
+    store.add([_node("e", [2.0, 0.0])])
+    assert _ids(reader, [1.0, 0.0], top_k=1) == ["e"]
+    assert _ids(MmapVectorStore(tmp_path), [1.0, 0.0]) == ["e", "d", "c"]
+    result = reader.query(VectorStoreQuery(query_embedding=[0.0, 1.0]))
+    assert result.nodes[0].get_content() == "text of c"
+
+
+def test_mmap_vector_store_probes_the_closest_ivf_lists(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((400, 8)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    store = MmapVectorStore(tmp_path, ivf_lists=4, ivf_probes=1)
+    store.add([_node(str(i), e.tolist()) for i, e in enumerate(embeddings)])
+    store.persist("")
+
+    assert store._centroids is not None
+    assert _ids(store, embeddings[7].tolist(), top_k=1) == ["7"]
+    exact = MmapVectorStore(tmp_path)
+    assert len(_ids(exact, embeddings[7].tolist(), top_k=400)) == 400
+    assert len(_ids(store, embeddings[7].tolist(), top_k=400)) < 400
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+import uvicorn
+from llama_index.llms import ChatMessage, LLMMetadata, MockLLM
+
+from app.config.settings import AppSettings, LLMSettings, ModelServerSettings
+from app.dependencies.components.embedding import EmbeddingComponent
+from app.dependencies.components.llm import LLMComponent
+from app.dependencies.components.model_server import (
+    ModelServerClient,
+    RemoteEmbedding,
+    RemoteLLM,
+)
+from app.model_server import create_model_server
+
+
+@pytest.fixture
+def client(tmp_path):
+    app_settings = AppSettings(fastapi_env="testing")
+    local = ModelServerSettings(enabled=False)
+    llm_component = LLMComponent(app_settings, LLMSettings(), local)
+    llm_component.llm = MockLLM(max_tokens=5)
+    embedding_component = EmbeddingComponent(app_settings, model_server_settings=local)
+    path = tmp_path / "model_server.sock"
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_model_server(llm_component, embedding_component),
+            uds=str(path),
+            log_config=None,
+        )
+    )
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield ModelServerClient(path, ModelServerSettings(timeout=10, startup_timeout=1))
+    server.should_exit = True
+    thread.join()
+
+
+def test_remote_models_call_the_model_server(client):
+    llm = RemoteLLM(client, LLMMetadata())
+    messages = [ChatMessage(content="Hello")]
+
+    assert llm.chat(messages).message.content == "text text text text text"
+    chats = list(llm.stream_chat(messages))
+    assert [chat.delta for chat in chats] == ["text "] * 5
+    assert chats[-1].message.content == "text " * 5
+    assert llm.complete("Hello").text == "text text text text text"
+
+    stream = llm.stream_complete("Hello")
+    assert next(stream).delta == "text "
+    stream.close()
+
+    embedding = RemoteEmbedding(client, model_name="mock")
+    assert len(embedding.get_query_embedding("Hello")) == 384
+    assert len(embedding.get_query_embedding_batch(["Hello", "World"])) == 2
+    assert len(embedding.get_text_embedding_batch(["Hello", "World"])) == 2
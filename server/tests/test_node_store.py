@@ -0,0 +1,14 @@
+from llama_index.schema import TextNode
+from llama_index.storage.docstore import SimpleDocumentStore
+
+from app.dependencies.components.node_store import get_nodes
+
+
+def test_get_nodes_leaves_out_missing_nodes():
+    docstore = SimpleDocumentStore()
+    docstore.add_documents([TextNode(id_="a", text="first"), TextNode(id_="b")])
+
+    nodes = get_nodes(docstore, ["b", "missing", "a"])
+
+    assert list(nodes) == ["b", "a"]
+    assert nodes["a"].get_content() == "first"
@@ -0,0 +1,138 @@
+import asyncio
+from typing import Any
+
+from llama_index import (
+    MockEmbedding,
+    ServiceContext,
+    StorageContext,
+    VectorStoreIndex,
+)
+from llama_index.llms import MockLLM
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+
+from app.config.settings import CacheSettings
+from app.dependencies.base import ContextFilter
+from app.dependencies.components.mmap_vector_store import MmapVectorStore
+from app.dependencies.components.retrieval_cache import RetrievalCache
+from app.dependencies.components.vector_store import (
+    SharedVectorIndexRetriever,
+    retrieval_options,
+)
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.values: dict[str, Any] = {}
+
+    def get(self, key: str) -> Any:
+        return self.values.get(key)
+
+    def set(self, key: str, value: Any, ex: int | None = None) -> None:
+        self.values[key] = value
+
+    def incr(self, key: str) -> int:
+        self.values[key] = int(self.values.get(key, 0)) + 1
+        return self.values[key]
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis) -> None:
+        self._redis = redis
+        self._keys: list[str] = []
+
+    def get(self, key: str) -> None:
+        self._keys.append(key)
+
+    def execute(self) -> list[Any]:
+        return [self._redis.get(key) for key in self._keys]
+
+
+def _query(similarity_top_k: int = 2) -> VectorStoreQuery:
+    return VectorStoreQuery(
+        query_embedding=[0.1, 0.2], similarity_top_k=similarity_top_k
+    )
+
+
+def test_retrieval_cache_until_the_corpus_changes():
+    cache = RetrievalCache(FakeRedis(), CacheSettings())  # type: ignore[arg-type]
+    context_filter = ContextFilter(docs_ids=["a"])
+    key = cache.key(_query(), context_filter=context_filter)
+
+    assert cache.get(key) == (None, 0)
+    cache.put(
+        key,
+        0,
+        VectorStoreQueryResult(
+            nodes=[TextNode(id_="n", text="chunk")], similarities=[0.9], ids=["n"]
+        ),
+    )
+
+    result, generation = cache.get(key)
+    assert generation == 0
+    assert [node.get_content() for node in result.nodes] == ["chunk"]
+    assert result.similarities == [0.9]
+
+    cache.invalidate()
+    assert cache.get(key) == (None, 1)
+    assert cache.stats() == {"hits": 1, "misses": 2}
+
+
+def test_retrieval_cache_key_depends_on_top_k_and_filter():
+    keys = {
+        RetrievalCache.key(_query()),
+        RetrievalCache.key(_query(similarity_top_k=5)),
+        RetrievalCache.key(_query(), context_filter=ContextFilter(docs_ids=["a"])),
+        RetrievalCache.key(_query(), context_filter=ContextFilter(docs_ids=["b"])),
+    }
+
+    assert len(keys) == 4
+
+
+def _cached_retriever(tmp_path, redis: FakeRedis) -> SharedVectorIndexRetriever:
+    service_context = ServiceContext.from_defaults(
+        llm=MockLLM(), embed_model=MockEmbedding(embed_dim=8)
+    )
+    index = VectorStoreIndex(
+        [TextNode(id_="n", text="chunk")],
+        storage_context=StorageContext.from_defaults(
+            vector_store=MmapVectorStore(tmp_path)
+        ),
+        service_context=service_context,
+    )
+    return SharedVectorIndexRetriever(
+        index, retrieval_cache=RetrievalCache(redis, CacheSettings())  # type: ignore[arg-type]
+    )
+
+
+def test_retriever_only_caches_strong_searches(tmp_path):
+    redis = FakeRedis()
+    retriever = _cached_retriever(tmp_path, redis)
+
+    with retrieval_options(consistency_level="Bounded"):
+        assert [node.node_id for node in retriever.retrieve("chunk")] == ["n"]
+    assert redis.values == {}
+
+    assert [node.node_id for node in retriever.retrieve("chunk")] == ["n"]
+    assert len(redis.values) == 1
+
+    # The Bounded searches read the results of the Strong ones
+    with retrieval_options(consistency_level="Bounded"):
+        retriever.retrieve("chunk")
+    assert retriever._retrieval_cache.stats() == {"hits": 1, "misses": 2}
+
+
+def test_async_retrievals_share_the_cache(tmp_path):
+    redis = FakeRedis()
+    retriever = _cached_retriever(tmp_path, redis)
+
+    nodes = asyncio.run(retriever.aretrieve("chunk"))
+    assert [node.node_id for node in nodes] == ["n"]
+    assert len(redis.values) == 1
+
+    assert [node.node_id for node in retriever.retrieve("chunk")] == ["n"]
+    asyncio.run(retriever.aretrieve("chunk"))
+    assert retriever._retrieval_cache.stats() == {"hits": 2, "misses": 1}
@@ -0,0 +1,82 @@
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.storage.kvstore import SimpleKVStore
+
+from app.config.settings import RetrievalSettings
+from app.dependencies.base import ContextFilter
+from app.dependencies.components.sparse_index import SparseIndex, tokenize
+
+
+def _node(node_id: str, text: str, doc_id: str = "doc") -> TextNode:
+    return TextNode(
+        id_=node_id,
+        text=text,
+        metadata={"file_name": f"{doc_id}.txt"},
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc_id)},
+    )
+
+
+def test_tokenize_keeps_identifiers():
+    assert tokenize("The pump failed with ERR-404 on part A1.2") == [
+        "pump",
+        "failed",
+        "err-404",
+        "err",
+        "404",
+        "part",
+        "a1.2",
+        "a1",
+        "2",
+    ]
+    assert tokenize("max_tokens") == ["max_tokens"]
+
+
+def test_sparse_index_ranks_exact_terms():
+    sparse_index = SparseIndex(SimpleKVStore())
+    sparse_index.add(
+        [
+            _node("a", "The pump failed with error ERR-404."),
+            _node("b", "The pump is running fine, no error."),
+            _node("c", "Sales increased in the third quarter.", doc_id="other"),
+        ]
+    )
+
+    assert [node_id for node_id, _ in sparse_index.query("ERR-404", 5)] == ["a"]
+    assert [node_id for node_id, _ in sparse_index.query("pump error", 5)] == [
+        "b",
+        "a",
+    ]
+    assert sparse_index.query("sales", 5, ContextFilter(docs_ids=["doc"])) == []
+    assert sparse_index.query("sales", 5, ContextFilter(file_names=["other.txt"]))
+
+
+def test_sparse_index_delete_and_replace():
+    sparse_index = SparseIndex(SimpleKVStore())
+    sparse_index.add([_node("a", "first ERR-404"), _node("b", "second")])
+    sparse_index.add([_node("a", "first ERR-500")])
+    sparse_index.delete(["b", "unknown"])
+
+    assert sparse_index.count_nodes() == 1
+    assert sparse_index.query("404 second", 5) == []
+    assert [node_id for node_id, _ in sparse_index.query("ERR-500", 5)] == ["a"]
+
+
+def test_sparse_index_reads_the_best_postings_of_each_term():
+    sparse_index = SparseIndex(
+        SimpleKVStore(), RetrievalSettings(hybrid_postings_per_term=2)
+    )
+    sparse_index.add(
+        [
+            _node("a", "pump pump pump"),
+            _node("b", "pump pump failed"),
+            _node("c", "pump failed, valve stuck, motor stopped"),
+        ]
+    )
+
+    assert [node_id for node_id, _ in sparse_index.query("pump", 1)] == ["a"]
+    # Only the best two postings of "pump" are read
+    assert [node_id for node_id, _ in sparse_index.query("pump", 5)] == ["a", "b"]
+    assert [node_id for node_id, _ in sparse_index.query("pump failed", 5)] == [
+        "b",
+        "c",
+        "a",
+    ]
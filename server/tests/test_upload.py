@@ -0,0 +1,226 @@
+import asyncio
+import io
+import tarfile
+import zipfile
+from pathlib import Path
+from types import SimpleNamespace
+from typing import IO
+
+import pytest
+from botocore.exceptions import ClientError
+from fastapi import HTTPException, Request
+
+from app.config.settings import IngestSettings
+from app.dependencies.file_storage import S3Client
+from app.dependencies.upload import extract_archive, receive_uploads, spool_objects
+from app.paths import uploads_path
+
+BOUNDARY = "upload-boundary"
+
+
+def _multipart_body(files: list[tuple[str, str, bytes]]) -> bytes:
+    body = b""
+    for field_name, file_name, data in files:
+        body += (
+            (
+                f"--{BOUNDARY}\r\n"
+                f'Content-Disposition: form-data; name="{field_name}"; '
+                f'filename="{file_name}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode()
+            + data
+            + b"\r\n"
+        )
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def _request(body: bytes, chunk_size: int, received: list[int]) -> Request:
+    chunks = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+    async def receive() -> dict:
+        received.append(len(chunks[len(received)]))
+        return {
+            "type": "http.request",
+            "body": chunks[len(received) - 1],
+            "more_body": len(received) < len(chunks),
+        }
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "headers": [
+            (b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())
+        ],
+    }
+    return Request(scope, receive)
+
+
+async def _receive(request: Request, field_name: str, **kwargs) -> list[bytes]:
+    async with receive_uploads(request, field_name, **kwargs) as files:
+        paths = [path for _, path in files]
+        assert [path.suffix for path in paths] == [
+            Path(file_name).suffix for file_name, _ in files
+        ]
+        contents = [path.read_bytes() for path in paths]
+    assert not any(path.exists() for path in paths)
+    return contents
+
+
+def test_receive_uploads_writes_the_files_of_the_field():
+    data = b"hello world" * 1000
+    body = _multipart_body(
+        [("file", "report.pdf", data), ("other", "skipped.txt", b"skipped")]
+    )
+    request = _request(body, 1024, [])
+
+    contents = asyncio.run(_receive(request, "file"))
+
+    assert contents == [data]
+
+
+def test_receive_uploads_rejects_before_reading_the_whole_body():
+    body = _multipart_body([("file", "big.txt", b"x" * 50_000)])
+    received: list[int] = []
+    request = _request(body, 1024, received)
+    settings = IngestSettings(max_upload_size=3000)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(_receive(request, "file", settings=settings))
+
+    assert exc_info.value.status_code == 413
+    assert sum(received) < 5000
+    assert not list(uploads_path.glob("*.txt"))
+
+
+@pytest.mark.parametrize(
+    "files",
+    [
+        [],
+        [("file", "a.txt", b"a"), ("file", "b.txt", b"b")],
+    ],
+)
+def test_receive_uploads_checks_the_number_of_files(files):
+    request = _request(_multipart_body(files), 1024, [])
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(_receive(request, "file", max_files=1))
+
+    assert exc_info.value.status_code == 400
+
+
+def _zip_archive(path: Path, members: dict[str, bytes]) -> Path:
+    with zipfile.ZipFile(path, "w") as zip_file:
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+    return path
+
+
+def _tar_archive(path: Path, members: dict[str, bytes]) -> Path:
+    with tarfile.open(path, "w:gz") as tar_file:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar_file.addfile(info, io.BytesIO(data))
+    return path
+
+
+@pytest.mark.parametrize("make_archive", [_zip_archive, _tar_archive])
+def test_extract_archive_skips_unsafe_members(tmp_path: Path, make_archive):
+    archive = make_archive(
+        tmp_path / "archive",
+        {
+            "docs/a.txt": b"first",
+            "b.pdf": b"second",
+            "../escape.txt": b"nope",
+            "__MACOSX/._a.txt": b"nope",
+        },
+    )
+    extract_dir = tmp_path / "extracted"
+    extract_dir.mkdir()
+
+    extracted = extract_archive(archive, extract_dir)
+
+    assert [name for name, _ in extracted] == ["docs/a.txt", "b.pdf"]
+    assert [path.read_bytes() for _, path in extracted] == [b"first", b"second"]
+    assert all(path.parent == extract_dir for _, path in extracted)
+    assert extracted[1][1].suffix == ".pdf"
+
+
+def test_extract_archive_enforces_limits(tmp_path: Path):
+    archive = _zip_archive(
+        tmp_path / "archive.zip", {f"{i}.txt": b"x" * 100 for i in range(5)}
+    )
+
+    with pytest.raises(HTTPException) as exc_info:
+        extract_archive(archive, tmp_path, IngestSettings(max_archive_files=3))
+    assert exc_info.value.status_code == 413
+
+    with pytest.raises(HTTPException) as exc_info:
+        extract_archive(archive, tmp_path, IngestSettings(max_archive_size=250))
+    assert exc_info.value.status_code == 413
+
+
+def test_extract_archive_rejects_invalid_archive(tmp_path: Path):
+    not_an_archive = tmp_path / "archive.zip"
+    not_an_archive.write_bytes(b"definitely not a zip")
+
+    with pytest.raises(HTTPException) as exc_info:
+        extract_archive(not_an_archive, tmp_path)
+    assert exc_info.value.status_code == 400
+
+
+class FakeBucketObject:
+    def __init__(self, objects: dict[str, bytes], key: str):
+        self._objects = objects
+        self.key = key
+
+    @property
+    def content_length(self) -> int:
+        if self.key not in self._objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return len(self._objects[self.key])
+
+    def download_fileobj(self, file: IO[bytes]) -> None:
+        file.write(self._objects[self.key])
+
+
+def _fake_s3_client(objects: dict[str, bytes]) -> S3Client:
+    bucket = SimpleNamespace(Object=lambda key: FakeBucketObject(objects, key))
+    return SimpleNamespace(bucket=bucket)  # type: ignore[return-value]
+
+
+def test_spool_objects_yields_batches_and_cleans_up():
+    objects = {f"docs/{i}.txt": f"content {i}".encode() for i in range(5)}
+    settings = IngestSettings(bucket_batch_size=2, bucket_prefetch=2)
+
+    batches = []
+    for batch in spool_objects(_fake_s3_client(objects), list(objects), settings):
+        batches.append([(key, path.read_bytes(), path) for key, path in batch])
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [(key, data) for batch in batches for key, data, _ in batch] == list(
+        objects.items()
+    )
+    assert all(
+        path.suffix == ".txt" and not path.exists()
+        for batch in batches
+        for _, _, path in batch
+    )
+
+
+def test_spool_objects_checks_the_objects():
+    objects = {"small.txt": b"x", "big.txt": b"x" * 5000}
+
+    with pytest.raises(HTTPException) as exc_info:
+        list(spool_objects(_fake_s3_client(objects), ["missing.txt"]))
+    assert exc_info.value.status_code == 404
+
+    with pytest.raises(HTTPException) as exc_info:
+        list(
+            spool_objects(
+                _fake_s3_client(objects),
+                ["small.txt", "big.txt"],
+                IngestSettings(max_upload_size=3000),
+            )
+        )
+    assert exc_info.value.status_code == 413
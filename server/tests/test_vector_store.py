@@ -0,0 +1,133 @@
+import asyncio
+
+from llama_index import MockEmbedding, ServiceContext, StorageContext, VectorStoreIndex
+from llama_index.llms import MockLLM
+from llama_index.schema import NodeWithScore, TextNode
+from llama_index.storage.docstore import SimpleDocumentStore
+from llama_index.storage.kvstore import SimpleKVStore
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from app.config.settings import RetrievalSettings
+from app.dependencies.base import ContextFilter
+from app.dependencies.components.mmap_vector_store import MmapVectorStore
+from app.dependencies.components.sparse_index import SparseIndex
+from app.dependencies.components.vector_store import (
+    FilteredMilvusVectorStore,
+    SharedVectorIndexRetriever,
+    context_filter_expr,
+    reciprocal_rank_fusion,
+    retrieval_options,
+)
+
+
+def test_context_filter_expr_without_filter():
+    assert context_filter_expr(None) is None
+    assert context_filter_expr(ContextFilter()) is None
+
+
+def test_context_filter_expr_combines_the_filters():
+    context_filter = ContextFilter(
+        docs_ids=["a", "b"], file_names=['Report "Q3".pdf', "Résumé.pdf"]
+    )
+
+    assert context_filter_expr(context_filter, "ref_doc_id") == (
+        'ref_doc_id in ["a", "b"] and '
+        'file_name in ["Report \\"Q3\\".pdf", "Résumé.pdf"]'
+    )
+
+
+def test_reciprocal_rank_fusion_favours_nodes_found_by_both():
+    a, b, c = (NodeWithScore(node=TextNode(id_=i), score=1.0) for i in "abc")
+
+    fused = reciprocal_rank_fusion([[a, b], [c, b]], k=60)
+
+    assert [node.node_id for node in fused] == ["b", "a", "c"]
+    assert fused[0].score == 1 / 62 + 1 / 62
+
+
+def _hybrid_retriever(tmp_path) -> SharedVectorIndexRetriever:
+    nodes = [
+        TextNode(id_="a", text="The pump is running fine."),
+        TextNode(id_="b", text="Sales increased in the third quarter."),
+        TextNode(id_="c", text="The pump failed with error ERR-404."),
+    ]
+    docstore = SimpleDocumentStore()
+    docstore.add_documents(nodes)
+    sparse_index = SparseIndex(SimpleKVStore())
+    sparse_index.add(nodes)
+    index = VectorStoreIndex(
+        nodes,
+        storage_context=StorageContext.from_defaults(
+            vector_store=MmapVectorStore(tmp_path)
+        ),
+        # All the nodes have the same embedding, only BM25 tells them apart
+        service_context=ServiceContext.from_defaults(
+            llm=MockLLM(), embed_model=MockEmbedding(embed_dim=8)
+        ),
+    )
+    return SharedVectorIndexRetriever(
+        index,
+        sparse_index=sparse_index,
+        docstore=docstore,
+        settings=RetrievalSettings(hybrid_candidates=3),
+    )
+
+
+def test_aretrieve_returns_the_nodes_of_retrieve(tmp_path):
+    retriever = _hybrid_retriever(tmp_path)
+
+    with retrieval_options(similarity_top_k=1):
+        nodes = retriever.retrieve("ERR-404")
+        anodes = asyncio.run(retriever.aretrieve("ERR-404"))
+
+    assert [node.node_id for node in nodes] == ["c"]
+    assert [(node.node_id, node.score) for node in anodes] == [
+        (node.node_id, node.score) for node in nodes
+    ]
+
+
+class FakeMilvusClient:
+    def __init__(self, hits: list[list[dict]]) -> None:
+        self.hits = hits
+        self.searches: list[dict] = []
+
+    def search(self, collection_name: str, **kwargs) -> list[list[dict]]:
+        self.searches.append(kwargs)
+        return self.hits
+
+
+def _milvus_store(client: FakeMilvusClient) -> FilteredMilvusVectorStore:
+    store = FilteredMilvusVectorStore.__new__(FilteredMilvusVectorStore)
+    store.milvusclient = client
+    store.collection_name = "collection"
+    store.doc_id_field = "doc_id"
+    store.embedding_field = "embedding"
+    store.text_key = "text"
+    store.search_params = {"ef": 64}
+    return store
+
+
+def test_query_batch_runs_a_single_search_with_the_search_options():
+    hits = [
+        {"id": f"n{i}", "distance": 1.0 - i / 10, "entity": {"text": f"t{i}"}}
+        for i in range(3)
+    ]
+    client = FakeMilvusClient([hits, hits[:2]])
+    store = _milvus_store(client)
+    queries = [
+        VectorStoreQuery(query_embedding=[1.0, 0.0], similarity_top_k=3),
+        VectorStoreQuery(query_embedding=[0.0, 1.0], similarity_top_k=1),
+    ]
+
+    results = store.query_batch(
+        queries, ContextFilter(docs_ids=["a"]), consistency_level="Bounded"
+    )
+
+    assert len(client.searches) == 1
+    search = client.searches[0]
+    assert search["data"] == [[1.0, 0.0], [0.0, 1.0]]
+    assert search["limit"] == 3
+    assert search["filter"] == 'doc_id in ["a"]'
+    assert search["search_params"] == {"params": {"ef": 64}}
+    assert search["consistency_level"] == "Bounded"
+    assert [result.ids for result in results] == [["n0", "n1", "n2"], ["n0"]]